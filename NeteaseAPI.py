@@ -2,8 +2,23 @@ import aiohttp
 import asyncio
 import json
 import os
+import tempfile
+import time
+from collections import OrderedDict
 from qrcode.main import QRCode
 
+from audio_cache import audio_lib_cache
+from cache_utils import SingleFlight, TTLCache
+from library_index import library_index
+from metadata_store import SongMetadataStore, song_metadata_store
+from metrics import metrics
+
+# 下载指标
+download_bytes = metrics.counter('netease_download_bytes_total', "下载的音频字节数", ('kind',))
+download_seconds = metrics.histogram('netease_download_seconds', "下载音频的耗时（秒）", ('kind', 'result'),
+                                     buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
 # API连接错误检测
 def is_api_connection_error(error_msg: str) -> bool:
     """
@@ -37,35 +52,68 @@ def get_api_error_message() -> str:
     return "❌ 网易云音乐API服务未启动！\n请先启动NeteaseCloudMusicApi服务 (localhost:3000)\n如果您是服务器用户，请联系机器人管理员启动API服务。"
 
 # region 网易API部分
+# 搜索结果缓存有效期（秒）
+SEARCH_CACHE_TTL = 300
+
+search_cache = TTLCache(maxsize=256, ttl=SEARCH_CACHE_TTL)
+_search_flight = SingleFlight()
+
+
+def normalize_keyword(keyword: str) -> str:
+    """规范化搜索关键词：去除首尾空白、合并连续空白并忽略大小写"""
+    return " ".join(str(keyword).split()).casefold()
+
+
+async def search_songs(keyword: str) -> list:
+    """
+    搜索歌曲，结果按规范化后的关键词缓存，相同关键词的并发搜索只会调用一次接口
+
+    :param keyword: 搜索关键词
+    :return: 接口返回的歌曲列表（可能为空）
+    :raises Exception: 调用搜索 API 失败时抛出
+    """
+    key = normalize_keyword(keyword)
+    songs = search_cache.get(key)
+    if songs is not None:
+        return songs
+
+    async def fetch():
+        cookies = await load_cookies()
+        async with aiohttp.ClientSession(cookies=cookies) as session:
+            async with session.get("http://localhost:3000/search", params={"keywords": key}) as resp:
+                data = await resp.json()
+        if data.get('code') != 200:
+            raise Exception("调用搜索 API 失败")
+        result = (data.get('result') or {}).get('songs') or []
+        search_cache.set(key, result)
+        return result
+
+    return await _search_flight.do(key, fetch)
+
+
 async def search_netease_music(keyword: str):
-    # aiohttp调用网易云音乐API localhost:3000/search?keywords=keyword
+    # 调用网易云音乐API localhost:3000/search?keywords=keyword（带缓存）
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'http://localhost:3000/search?keywords={keyword}') as resp:
-                data = await resp.json()
-                if data['code'] == 200:
-                    songs = data['result']['songs']
-                    if songs:
-                        # 获取第一首歌曲的ID
-                        first_song_id = str(songs[0]['id'])
-                        
-                        # 格式化为指定的字符串格式，每行一首歌曲
-                        formatted_songs = "\n".join([
-                            # f"歌曲ID:{song['id']} 歌名:{song['name']} 歌手:{song['artists'][0]['name']}"
-                            f"{song['name']} - {song['artists'][0]['name']}"
-                            for song in songs[:15]  # 限制为最多15条
-                        ])
-                        print(songs)
-                        
-                        # 返回包含歌曲列表和第一首歌曲ID的字典
-                        return {
-                            "formatted_list": formatted_songs,
-                            "first_song_id": first_song_id
-                        }
-                    else:
-                        return "未找到相关音乐"
-                else:
-                    raise Exception("调用 API 失败")
+        songs = await search_songs(keyword)
+        if songs:
+            # 获取第一首歌曲的ID
+            first_song_id = str(songs[0]['id'])
+
+            # 格式化为指定的字符串格式，每行一首歌曲
+            formatted_songs = "\n".join([
+                # f"歌曲ID:{song['id']} 歌名:{song['name']} 歌手:{song['artists'][0]['name']}"
+                f"{song['name']} - {song['artists'][0]['name']}"
+                for song in songs[:15]  # 限制为最多15条
+            ])
+            print(songs)
+
+            # 返回包含歌曲列表和第一首歌曲ID的字典
+            return {
+                "formatted_list": formatted_songs,
+                "first_song_id": first_song_id
+            }
+        else:
+            return "未找到相关音乐"
     except Exception as e:
         raise Exception(e)
 
@@ -193,21 +241,120 @@ def parse_cookie_header(cookie_header: str) -> dict:
     return cookies
 
 
+# region Cookie管理
+COOKIE_FILE = "cookie.json"
+
+
+class CookieStore:
+    """
+    Cookie内存存储
+
+    启动时从文件加载一次，之后直接从内存读取；每隔 check_interval 秒检查一次文件的 mtime，
+    以便感知外部修改（例如手动替换 cookie.json）。写入时在线程池中以“临时文件 + 替换”的方式原子落盘，
+    不会阻塞事件循环，也不会留下写了一半的文件。
+    """
+
+    def __init__(self, path: str = COOKIE_FILE, check_interval: float = 5.0):
+        """
+        :param path: Cookie文件路径
+        :param check_interval: 检查文件mtime的最小间隔（秒）
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._cookies = {}
+        self._mtime = None  # 最近一次读取/写入时文件的 mtime (ns)
+        self._last_check = 0.0
+        self._write_lock = asyncio.Lock()
+        self._pending_writes = 0  # 尚未落盘的写入数量，期间不从文件刷新
+
+    def load(self):
+        """同步加载Cookie文件，仅在启动时调用一次"""
+        self._refresh_from_disk()
+        self._last_check = time.monotonic()
+
+    def _refresh_from_disk(self):
+        """如果文件的mtime发生变化，重新读取文件内容"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            # 只有之前存在的文件被删除时才清空；文件还没有写入过时保留内存中的 Cookie
+            if self._mtime is not None:
+                self._cookies = {}
+                self._mtime = None
+            return
+        except OSError as e:
+            print(f"检查 Cookie 文件状态失败：{e}")
+            return
+
+        if mtime == self._mtime:
+            return
+
+        try:
+            with open(self.path, "r") as f:
+                cookies = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            # 文件可能正被外部程序写入，保留内存中的旧值，下次检查时重试
+            print(f"读取 Cookie 文件失败，继续使用内存中的 Cookie：{e}")
+            return
+
+        self._cookies = cookies if isinstance(cookies, dict) else {}
+        self._mtime = mtime
+
+    def _write_atomic(self, cookies: dict):
+        """写入临时文件后替换目标文件，保证文件内容始终完整"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".cookie.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(cookies, f)  # type: ignore
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    async def get(self) -> dict:
+        """获取Cookie（内存副本），必要时在线程池中检查文件是否被外部修改"""
+        now = time.monotonic()
+        # 写入尚未完成时文件内容比内存旧，跳过刷新
+        if now - self._last_check >= self.check_interval and not self._pending_writes:
+            self._last_check = now
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._refresh_from_disk)
+        return dict(self._cookies)
+
+    async def set(self, cookies: dict):
+        """更新内存中的Cookie，并在线程池中原子写入文件"""
+        self._cookies = dict(cookies)
+        self._pending_writes += 1
+        try:
+            async with self._write_lock:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._write_atomic, dict(cookies))
+        finally:
+            self._pending_writes -= 1
+
+
+cookie_store = CookieStore()
+cookie_store.load()
+
+
 # 保存 Cookie 到文件
 async def save_cookies(cookies: dict):
-    """保存 Cookie 到文件"""
-    with open("cookie.json", "w") as f:
-        json.dump(cookies, f)  # type: ignore
+    """保存 Cookie（更新内存并异步落盘）"""
+    await cookie_store.set(cookies)
 
 
-# 从文件加载 Cookie
+# 从内存加载 Cookie
 async def load_cookies() -> dict:
-    """从文件加载 Cookie"""
-    try:
-        with open("cookie.json", "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
+    """加载 Cookie（从内存读取，不再每次读取文件）"""
+    return await cookie_store.get()
+
+
+# endregion
 
 
 # 检查当前保存的 Cookie 是否有效
@@ -262,6 +409,298 @@ def is_song_exists(song_id: str) -> tuple[bool, str]:
     return False, ""
 
 
+# region 歌曲详情批量加载
+class SongDetailLoader:
+    """
+    歌曲详情批量加载器（DataLoader 模式）
+
+    在 batch_window 秒内请求的所有歌曲ID会被合并成一次 /song/detail?ids=a,b,c 请求，
+    同一ID的并发请求共享同一个结果。查询结果按ID缓存，卡片渲染、歌单导入和预加载
+    只需为每一批歌曲付出一次上游请求。
+
+    内存缓存未命中时会先查询持久化的元数据存储（metadata_store），命中则不发起请求；
+    存储中的数据过期时先返回旧数据，同时在后台合并进下一次批量请求中刷新。
+    """
+
+    def __init__(self, batch_window: float = 0.02, max_batch_size: int = 100, cache_size: int = 2000,
+                 store: SongMetadataStore = None):
+        """
+        :param batch_window: 合并请求的时间窗口（秒）
+        :param max_batch_size: 单次请求最多包含的歌曲ID数量
+        :param cache_size: 内存中最多缓存的歌曲详情数量
+        :param store: 持久化的歌曲元数据存储，为 None 时仅使用内存缓存
+        """
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.cache_size = cache_size
+        self.store = store
+        self._cache = OrderedDict()  # song_id -> 网易云返回的原始歌曲详情
+        self._pending = {}  # song_id -> Future，等待下一次批量请求
+        self._flush_handle = None
+
+    def get_cached(self, song_id):
+        """仅从缓存中获取歌曲详情，不发起请求"""
+        song_id = str(song_id)
+        song = self._cache.get(song_id)
+        if song is not None:
+            self._cache.move_to_end(song_id)
+        return song
+
+    def prime(self, song: dict, persist: bool = True):
+        """
+        将已获取到的歌曲详情（例如歌单接口返回的 songs）写入缓存
+
+        :param song: 包含 id/name/ar/al/dt 字段的原始歌曲详情
+        :param persist: 是否同时写入持久化存储
+        """
+        if not song or song.get('id') is None:
+            return
+        if persist and self.store is not None:
+            self.store.put(song)
+        song_id = str(song['id'])
+        self._cache[song_id] = song
+        self._cache.move_to_end(song_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def load(self, song_id):
+        """
+        获取单首歌曲的详情
+
+        :param song_id: 歌曲ID
+        :return: 原始歌曲详情，找不到该歌曲时返回 None
+        :raises Exception: 调用 API 失败时抛出
+        """
+        song_id = str(song_id)
+        cached = self.get_cached(song_id)
+        if cached is not None:
+            return cached
+
+        if self.store is not None:
+            stored, stale = self.store.get(song_id)
+            if stored is not None:
+                self.prime(stored, persist=False)
+                if stale:
+                    # 过期数据先返回，后台刷新
+                    self._enqueue(song_id).add_done_callback(self._ignore_refresh_result)
+                return stored
+
+        # shield: 某个调用方被取消时不影响共享同一结果的其他调用方
+        return await asyncio.shield(self._enqueue(song_id))
+
+    def _enqueue(self, song_id: str):
+        """将歌曲ID加入下一次批量请求，返回对应的 Future"""
+        future = self._pending.get(song_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[song_id] = future
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    @staticmethod
+    def _ignore_refresh_result(future):
+        """后台刷新没有等待方，取出异常避免 "exception was never retrieved" 警告"""
+        if not future.cancelled() and future.exception() is not None:
+            print(f"后台刷新歌曲详情失败: {future.exception()}")
+
+    async def load_many(self, song_ids) -> dict:
+        """
+        批量获取多首歌曲的详情
+
+        :param song_ids: 歌曲ID列表
+        :return: {song_id: 原始歌曲详情或None}
+        """
+        song_ids = [str(song_id) for song_id in song_ids]
+        results = await asyncio.gather(*(self.load(song_id) for song_id in song_ids), return_exceptions=True)
+        return {
+            song_id: (None if isinstance(result, BaseException) else result)
+            for song_id, result in zip(song_ids, results)
+        }
+
+    def _flush(self):
+        """取出当前等待中的ID并发起一次批量请求"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch = self._pending
+        self._pending = {}
+        asyncio.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch: dict):
+        """执行批量请求，并把结果分发给等待中的调用方"""
+        ids = ",".join(batch.keys())
+        try:
+            cookies = await load_cookies()
+            async with aiohttp.ClientSession(cookies=cookies) as session:
+                async with session.get("http://localhost:3000/song/detail", params={"ids": ids}) as resp:
+                    data = await resp.json()
+            if data.get('code') != 200:
+                raise Exception("获取歌曲详情失败")
+
+            for song in data.get('songs', []) or []:
+                self.prime(song)
+
+            for song_id, future in batch.items():
+                if not future.done():
+                    future.set_result(self._cache.get(song_id))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(Exception(str(e)))
+        finally:
+            # 批量任务被取消时仍要结束全部 Future，否则等待方会一直挂起
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(Exception("批量获取歌曲详情的任务已被取消"))
+
+
+song_detail_loader = SongDetailLoader(store=song_metadata_store)
+
+
+def _join_artist_names(song_info: dict) -> str:
+    """将歌曲详情中的艺术家列表拼接为字符串"""
+    return ", ".join(artist['name'] for artist in song_info.get('ar', []) if artist.get('name'))
+
+
+# 批量预取歌曲详情
+async def prefetch_song_details(song_ids):
+    """
+    批量预取歌曲详情到缓存，用于歌单导入和预加载
+
+    :param song_ids: 歌曲ID列表
+    :return: {song_id: 原始歌曲详情或None}
+    """
+    return await song_detail_loader.load_many(song_ids)
+
+
+# endregion
+
+
+# region 歌曲链接缓存
+# 接口没有返回有效期时使用的保守有效期（秒）
+SONG_URL_TTL = 600
+# 提前失效的余量（秒），避免拿到即将过期的链接
+SONG_URL_EXPIRY_MARGIN = 60
+
+song_url_cache = TTLCache(maxsize=500, ttl=SONG_URL_TTL)
+_song_url_flight = SingleFlight()
+
+
+async def _request_song_url(song_id: str, kind: str, cookies: dict):
+    """
+    向本地API请求歌曲链接
+
+    :param song_id: 歌曲ID
+    :param kind: "play" 使用 /song/url，"download" 使用 /song/download/url/v1
+    :param cookies: 登录Cookie
+    :return: (链接, 有效期秒数)，获取不到链接时返回 None
+    """
+    if kind == "play":
+        endpoint = "http://localhost:3000/song/url"
+        params = {"id": song_id, "br": "320000"}
+    else:
+        endpoint = "http://localhost:3000/song/download/url/v1"
+        params = {"id": song_id, "level": "higher"}
+
+    async with aiohttp.ClientSession(cookies=cookies) as session:
+        async with session.get(endpoint, params=params) as resp:
+            data = await resp.json()
+
+    if data.get('code') != 200:
+        return None
+    item = data.get('data')
+    if isinstance(item, list):
+        item = item[0] if item else None
+    if not item or not item.get('url'):
+        return None
+
+    # 接口返回的 expi 为链接剩余有效期（秒）
+    expi = item.get('expi')
+    if isinstance(expi, (int, float)) and expi > SONG_URL_EXPIRY_MARGIN:
+        ttl = expi - SONG_URL_EXPIRY_MARGIN
+    else:
+        ttl = SONG_URL_TTL
+    return item['url'], ttl
+
+
+async def resolve_song_url(song_id: str, kind: str = "play", cookies: dict = None):
+    """
+    获取歌曲链接，优先使用缓存，同一歌曲的并发请求只会调用一次接口
+
+    :param song_id: 歌曲ID
+    :param kind: "play" 播放链接，"download" 下载链接
+    :param cookies: 登录Cookie，为 None 时从内存加载
+    :return: 歌曲链接，获取失败（例如需要VIP）时返回 None
+    """
+    key = (kind, str(song_id))
+    url = song_url_cache.get(key)
+    if url:
+        return url
+
+    async def fetch():
+        result = await _request_song_url(str(song_id), kind, cookies if cookies is not None else await load_cookies())
+        if not result:
+            return None
+        song_url, ttl = result
+        song_url_cache.set(key, song_url, ttl=ttl)
+        return song_url
+
+    return await _song_url_flight.do(key, fetch)
+
+
+def invalidate_song_url(song_id: str):
+    """链接失效（例如下载返回 403）时删除缓存"""
+    for kind in ("play", "download"):
+        song_url_cache.pop((kind, str(song_id)))
+
+
+# endregion
+
+
+def _write_audio_file(file_name: str, data: bytes):
+    """先写入临时文件再替换，避免其他任务读到写了一半的音频文件"""
+    directory = os.path.dirname(file_name)
+    fd, tmp_path = tempfile.mkstemp(prefix=".download.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_name)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    # 登记到缓存管理器，超出容量时淘汰旧文件
+    audio_lib_cache.record_added(file_name)
+
+
+async def _download_audio(session, download_url: str, file_name: str, kind: str) -> int:
+    """
+    下载音频文件并记录下载字节数和耗时
+
+    :param session: aiohttp.ClientSession
+    :param download_url: 下载链接
+    :param file_name: 保存的文件路径
+    :param kind: 下载类型（song/radio），用作指标标签
+    :return: HTTP 状态码，200 表示下载成功
+    """
+    started = time.monotonic()
+    async with session.get(download_url) as music_resp:
+        if music_resp.status != 200:
+            download_seconds.observe(time.monotonic() - started, kind=kind, result="error")
+            return music_resp.status
+        data = await music_resp.read()
+    download_seconds.observe(time.monotonic() - started, kind=kind, result="ok")
+    download_bytes.inc(len(data), kind=kind)
+    _write_audio_file(file_name, data)
+    return music_resp.status
+
+
 # 下载音乐
 async def download_music(keyword: str):
     try:
@@ -273,166 +712,136 @@ async def download_music(keyword: str):
         if not cookies:
             return {"error": "未登录，请通知开发者完成登录操作"}
 
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            # 搜索歌曲
-            async with session.get(f"http://localhost:3000/search?keywords={keyword}") as resp:
-                data = await resp.json()
-                if data['code'] != 200:
-                    raise Exception("调用搜索 API 失败")
-
-                # 检查搜索结果
-                songs = data.get('result', {}).get('songs', [])
-                if not songs:
-                    return {"error": "未找到相关歌曲"}
-
-                # 提取歌曲信息
-                first_song = songs[0]
-                song_id = str(first_song['id'])
-                song_name = first_song['name']
-                artist_name = ", ".join(artist['name'] for artist in first_song['artists'])
-                album_name = first_song['album']['name']
-                
-                print(f"搜索到歌曲: {song_name} - {artist_name} (ID: {song_id})")
-                
-                # 检查歌曲是否已存在
-                is_exists, file_name = is_song_exists(song_id)
-                if is_exists:
-                    print(f"歌曲 {song_name} (ID: {song_id}) 已存在，跳过下载")
-                    return {
-                        "file_name": file_name,
-                        "download_url": "使用本地缓存",
-                        "song_name": song_name,
-                        "artist_name": artist_name,
-                        "album_name": album_name,
-                        "cached": True
-                    }
+        # 搜索歌曲（与 search_netease_music 共用缓存）
+        songs = await search_songs(keyword)
+        if not songs:
+            return {"error": "未找到相关歌曲"}
 
-                # 下载新歌曲
-                print(f"开始下载歌曲 {song_name} (ID: {song_id})")
-                relative_path = "./AudioLib"
-                absolute_path = os.path.abspath(relative_path)
+        # 提取歌曲信息
+        first_song = songs[0]
+        song_id = str(first_song['id'])
+        song_name = first_song['name']
+        artist_name = ", ".join(artist['name'] for artist in first_song['artists'])
+        album_name = first_song['album']['name']
+
+        print(f"搜索到歌曲: {song_name} - {artist_name} (ID: {song_id})")
+
+        # 检查歌曲是否已存在
+        is_exists, file_name = is_song_exists(song_id)
+        if is_exists:
+            print(f"歌曲 {song_name} (ID: {song_id}) 已存在，跳过下载")
+            return {
+                "file_name": file_name,
+                "download_url": "使用本地缓存",
+                "song_name": song_name,
+                "artist_name": artist_name,
+                "album_name": album_name,
+                "cached": True
+            }
 
-                # 直接使用已获取的song_id，不需要再次搜索
-                async with session.get(
-                        f"http://localhost:3000/song/download/url/v1?id={song_id}&level=higher") as download_resp:
-                    download_data = await download_resp.json()
-                    if download_data['code'] != 200 or not download_data['data']['url']:
-                        return {"error": "无法获取下载链接，可能需要 VIP 权限"}
+        # 下载新歌曲
+        print(f"开始下载歌曲 {song_name} (ID: {song_id})")
+        relative_path = "./AudioLib"
+        absolute_path = os.path.abspath(relative_path)
 
-                    download_url = download_data['data']['url']
-                    file_name = os.path.join(absolute_path, f"{song_id}.mp3")
-                    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        # 直接使用已获取的song_id，不需要再次搜索
+        download_url = await resolve_song_url(song_id, "download", cookies)
+        if not download_url:
+            return {"error": "无法获取下载链接，可能需要 VIP 权限"}
 
-                    # 下载文件
-                    file_name = os.path.normpath(file_name)
-                    async with session.get(download_url) as music_resp:
-                        with open(file_name, 'wb') as f:
-                            f.write(await music_resp.read())
+        file_name = os.path.join(absolute_path, f"{song_id}.mp3")
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
 
-                    return {
-                        "file_name": file_name,
-                        "download_url": download_url,
-                        "song_name": song_name,
-                        "artist_name": artist_name,
-                        "album_name": album_name,
-                        "cached": False
-                    }
+        # 下载文件
+        file_name = os.path.normpath(file_name)
+        async with aiohttp.ClientSession(cookies=cookies) as session:
+            status = await _download_audio(session, download_url, file_name, "song")
+            if status != 200:
+                invalidate_song_url(song_id)
+                return {"error": f"下载歌曲失败，状态码: {status}"}
+
+        return {
+            "file_name": file_name,
+            "download_url": download_url,
+            "song_name": song_name,
+            "artist_name": artist_name,
+            "album_name": album_name,
+            "cached": False
+        }
     except Exception as e:
         return {"error": str(e)}
 
 
+_download_flight = SingleFlight()
+
+
 # 通过ID直接下载歌曲
 async def download_music_by_id(song_id: str):
+    """通过ID下载歌曲，同一首歌的并发下载（例如预下载与播放队列）只会执行一次"""
+    song_id = str(song_id)
+    return await _download_flight.do(song_id, lambda: _download_music_by_id(song_id))
+
+
+async def _download_music_by_id(song_id: str):
     try:
         # 确保已登录
         await ensure_logged_in()
 
-        # 检查歌曲是否已存在
-        is_exists, file_path = is_song_exists(song_id)
-        if is_exists:
-            # 如果歌曲已存在，获取歌曲信息但不重新下载
-            # 加载 Cookie
-            cookies = await load_cookies()
-            if not cookies:
-                return {"error": "未登录，请通知开发者完成登录操作"}
-                
-            async with aiohttp.ClientSession(cookies=cookies) as session:
-                # 获取歌曲详情
-                async with session.get(f"http://localhost:3000/song/detail?ids={song_id}") as detail_resp:
-                    detail_data = await detail_resp.json()
-                    if detail_data['code'] != 200:
-                        return {"error": "获取歌曲详情失败"}
-                    
-                    # 提取歌曲信息
-                    song_info = detail_data.get('songs', [])
-                    if not song_info:
-                        return {"error": f"未找到ID为 {song_id} 的歌曲"}
-                    
-                    song_info = song_info[0]
-                    song_name = song_info['name']
-                    artist_name = ", ".join(artist['name'] for artist in song_info['ar'])
-                    album_name = song_info['al']['name']
-                    
-                    print(f"歌曲 {song_name} (ID: {song_id}) 已存在，跳过下载")
-                    return {
-                        "file_name": file_path,
-                        "download_url": "使用本地缓存",
-                        "song_name": song_name,
-                        "artist_name": artist_name,
-                        "album_name": album_name,
-                        "cached": True
-                    }
-
-        # 如果歌曲不存在，进行常规下载流程
         # 加载 Cookie
         cookies = await load_cookies()
         if not cookies:
             return {"error": "未登录，请通知开发者完成登录操作"}
 
+        # 获取歌曲详情（批量加载并按ID缓存）
+        song_info = await song_detail_loader.load(song_id)
+        if not song_info:
+            return {"error": f"未找到ID为 {song_id} 的歌曲", "permanent": True}
+
+        song_name = song_info['name']
+        artist_name = _join_artist_names(song_info)
+        album_name = song_info['al']['name']
+
+        # 检查歌曲是否已存在
+        is_exists, file_path = is_song_exists(song_id)
+        if is_exists:
+            # 如果歌曲已存在，只返回歌曲信息，不重新下载
+            print(f"歌曲 {song_name} (ID: {song_id}) 已存在，跳过下载")
+            return {
+                "file_name": file_path,
+                "download_url": "使用本地缓存",
+                "song_name": song_name,
+                "artist_name": artist_name,
+                "album_name": album_name,
+                "cached": True
+            }
+
+        # 如果歌曲不存在，进行常规下载流程
+        # 获取下载链接（带缓存）
+        download_url = await resolve_song_url(song_id, "download", cookies)
+        if not download_url:
+            return {"error": "无法获取下载链接，可能需要 VIP 权限", "permanent": True}
+
+        relative_path = "./AudioLib"
+        absolute_path = os.path.abspath(relative_path)
+        file_name = os.path.join(absolute_path, f"{song_id}.mp3")
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+        # 下载文件
+        file_name = os.path.normpath(file_name)
         async with aiohttp.ClientSession(cookies=cookies) as session:
-            # 获取歌曲详情
-            async with session.get(f"http://localhost:3000/song/detail?ids={song_id}") as detail_resp:
-                detail_data = await detail_resp.json()
-                if detail_data['code'] != 200:
-                    return {"error": "获取歌曲详情失败"}
-                
-                # 提取歌曲信息
-                song_info = detail_data.get('songs', [])
-                if not song_info:
-                    return {"error": f"未找到ID为 {song_id} 的歌曲"}
-                
-                song_info = song_info[0]
-                song_name = song_info['name']
-                artist_name = ", ".join(artist['name'] for artist in song_info['ar'])
-                album_name = song_info['al']['name']
-                
-                # 获取下载链接
-                async with session.get(
-                        f"http://localhost:3000/song/download/url/v1?id={song_id}&level=higher") as download_resp:
-                    download_data = await download_resp.json()
-                    if download_data['code'] != 200 or not download_data['data']['url']:
-                        return {"error": "无法获取下载链接，可能需要 VIP 权限"}
-
-                    download_url = download_data['data']['url']
-                    relative_path = "./AudioLib"
-                    absolute_path = os.path.abspath(relative_path)
-                    file_name = os.path.join(absolute_path, f"{song_id}.mp3")
-                    os.makedirs(os.path.dirname(file_name), exist_ok=True)
-
-                    # 下载文件
-                    file_name = os.path.normpath(file_name)
-                    async with session.get(download_url) as music_resp:
-                        with open(file_name, 'wb') as f:
-                            f.write(await music_resp.read())
+            status = await _download_audio(session, download_url, file_name, "song")
+            if status != 200:
+                invalidate_song_url(song_id)
+                return {"error": f"下载歌曲失败，状态码: {status}"}
 
-                    return {
-                        "file_name": file_name,
-                        "download_url": download_url,
-                        "song_name": song_name,
-                        "artist_name": artist_name,
-                        "album_name": album_name,
-                        "cached": False
-                    }
+        return {
+            "file_name": file_name,
+            "download_url": download_url,
+            "song_name": song_name,
+            "artist_name": artist_name,
+            "album_name": album_name,
+            "cached": False
+        }
     except Exception as e:
         return {"error": str(e)}
 
@@ -457,57 +866,89 @@ async def get_song_url(song_id: str):
         if not cookies:
             return {"error": "未登录，请通知开发者完成登录操作"}
             
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            # 获取歌曲详情
-            async with session.get(f"http://localhost:3000/song/detail?ids={song_id}") as detail_resp:
-                detail_data = await detail_resp.json()
-                if detail_data['code'] != 200:
-                    return {"error": "获取歌曲详情失败"}
-                
-                # 提取歌曲信息
-                song_info = detail_data.get('songs', [])
-                if not song_info:
-                    return {"error": f"未找到ID为 {song_id} 的歌曲"}
-                
-                song_info = song_info[0]
-                song_name = song_info['name']
-                artist_name = ", ".join(artist['name'] for artist in song_info['ar'])
-                album_name = song_info['al']['name']
-                album_pic = song_info.get('al', {}).get('picUrl', '')
-                
-                # 获取播放链接
-                async with session.get(
-                        f"http://localhost:3000/song/url?id={song_id}&br=320000") as url_resp:
-                    url_data = await url_resp.json()
-                    if url_data['code'] != 200 or not url_data.get('data') or not url_data['data'][0].get('url'):
-                        # 尝试获取下载链接作为备用
-                        async with session.get(
-                                f"http://localhost:3000/song/download/url/v1?id={song_id}&level=higher") as download_resp:
-                            download_data = await download_resp.json()
-                            if download_data['code'] != 200 or not download_data['data'].get('url'):
-                                return {"error": "无法获取歌曲链接，可能需要VIP权限"}
-                            song_url = download_data['data']['url']
-                    else:
-                        song_url = url_data['data'][0]['url']
-                
-                # 检查是否本地已缓存（仅用于信息返回，不影响URL获取）
-                is_cached, file_path = is_song_exists(song_id)
-                
-                return {
-                    "song_url": song_url,
-                    "song_name": song_name,
-                    "artist_name": artist_name,
-                    "album_name": album_name,
-                    "album_pic": album_pic,
-                    "cached": is_cached,
-                    "file_path": file_path if is_cached else ""
-                }
+        # 获取歌曲详情（批量加载并按ID缓存）
+        song_info = await song_detail_loader.load(song_id)
+        if not song_info:
+            return {"error": f"未找到ID为 {song_id} 的歌曲"}
+
+        song_name = song_info['name']
+        artist_name = _join_artist_names(song_info)
+        album_name = song_info['al']['name']
+        album_pic = song_info.get('al', {}).get('picUrl', '')
+
+        # 获取播放链接（带缓存），失败时尝试获取下载链接作为备用
+        song_url = await resolve_song_url(song_id, "play", cookies)
+        if not song_url:
+            song_url = await resolve_song_url(song_id, "download", cookies)
+            if not song_url:
+                return {"error": "无法获取歌曲链接，可能需要VIP权限"}
+
+        # 检查是否本地已缓存（仅用于信息返回，不影响URL获取）
+        is_cached, file_path = is_song_exists(song_id)
+
+        return {
+            "song_url": song_url,
+            "song_name": song_name,
+            "artist_name": artist_name,
+            "album_name": album_name,
+            "album_pic": album_pic,
+            "cached": is_cached,
+            "file_path": file_path if is_cached else ""
+        }
     except Exception as e:
         if is_api_connection_error(str(e)):
             return {"error": get_api_error_message()}
         return {"error": str(e)}
 
 
+# region 本地优先点歌
+async def resolve_keyword_locally(keyword: str):
+    """
+    在本地曲库中查找与关键词可信匹配的已缓存歌曲，命中时无需任何网络请求
+
+    :param keyword: 点歌关键词
+    :return: 与 download_music_by_id 相同格式的结果（额外包含 song_id），没有可信匹配时返回 None
+    """
+    # 首次使用时在线程池中建立索引，避免阻塞事件循环
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, library_index.ensure_built)
+
+    doc = library_index.find_confident_match(keyword)
+    if not doc or not os.path.exists(doc['path']):
+        return None
+    return {
+        "song_id": doc['song_id'],
+        "file_name": doc['path'],
+        "download_url": "使用本地缓存",
+        "song_name": doc['song_name'],
+        "artist_name": doc['artist_name'],
+        "album_name": doc['album_name'],
+        "cached": True
+    }
+
+
+async def find_remote_correction(keyword: str, song_id: str):
+    """
+    用网络搜索确认本地匹配的结果
+
+    :param keyword: 点歌关键词
+    :param song_id: 本地匹配到的歌曲ID
+    :return: 网络搜索首个结果与本地不一致时返回 {"song_id", "song_name", "artist_name"}，否则返回 None
+    """
+    songs = await search_songs(keyword)
+    if not songs or str(songs[0]['id']) == str(song_id):
+        return None
+    first_song = songs[0]
+    return {
+        "song_id": str(first_song['id']),
+        "song_name": first_song['name'],
+        "artist_name": ", ".join(artist['name'] for artist in first_song.get('artists', []))
+    }
+
+
+# endregion
+
+
 # 检查电台节目是否已经存在于本地
 def is_radio_program_exists(program_id: str) -> tuple[bool, str]:
     """
@@ -608,35 +1049,33 @@ async def download_radio_program(program_id: str):
                 
                 print(f"获取到电台节目: {program_name} (ID: {program_id}, 主曲目ID: {main_track_id})")
                 
-                # 使用主曲目ID获取下载链接
-                async with session.get(
-                        f"http://localhost:3000/song/download/url/v1?id={main_track_id}&level=higher") as download_resp:
-                    download_data = await download_resp.json()
-                    if download_data['code'] != 200 or not download_data['data']['url']:
-                        return {"error": "无法获取下载链接，可能需要 VIP 权限"}
-
-                    download_url = download_data['data']['url']
-                    relative_path = "./AudioLib/Radio"
-                    absolute_path = os.path.abspath(relative_path)
-                    os.makedirs(absolute_path, exist_ok=True)  # 确保Radio文件夹存在
-                    file_name = os.path.join(absolute_path, f"{program_id}.mp3")
-                    
-                    # 下载文件
-                    file_name = os.path.normpath(file_name)
-                    async with session.get(download_url) as music_resp:
-                        with open(file_name, 'wb') as f:
-                            f.write(await music_resp.read())
-                    
-                    return {
-                        "file_name": file_name,
-                        "download_url": download_url,
-                        "song_name": program_name,
-                        "artist_name": dj_name,
-                        "album_name": radio_name,
-                        "description": description,
-                        "cached": False,
-                        "is_radio": True
-                    }
+                # 使用主曲目ID获取下载链接（带缓存）
+                download_url = await resolve_song_url(str(main_track_id), "download", cookies)
+                if not download_url:
+                    return {"error": "无法获取下载链接，可能需要 VIP 权限"}
+
+                relative_path = "./AudioLib/Radio"
+                absolute_path = os.path.abspath(relative_path)
+                os.makedirs(absolute_path, exist_ok=True)  # 确保Radio文件夹存在
+                file_name = os.path.join(absolute_path, f"{program_id}.mp3")
+
+                # 下载文件
+                file_name = os.path.normpath(file_name)
+                status = await _download_audio(session, download_url, file_name, "radio")
+                if status != 200:
+                    invalidate_song_url(str(main_track_id))
+                    return {"error": f"下载电台节目失败，状态码: {status}"}
+
+                return {
+                    "file_name": file_name,
+                    "download_url": download_url,
+                    "song_name": program_name,
+                    "artist_name": dj_name,
+                    "album_name": radio_name,
+                    "description": description,
+                    "cached": False,
+                    "is_radio": True
+                }
     except Exception as e:
         return {"error": str(e)}
 
@@ -694,49 +1133,42 @@ async def get_song_detail(song_id: str):
         if not cookies:
             return {"error": "未登录，请通知开发者完成登录操作"}
         
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            async with session.get(f"http://localhost:3000/song/detail?ids={song_id}") as resp:
-                data = await resp.json()
-                if data['code'] != 200:
-                    raise Exception("获取歌曲详情失败")
-                
-                # 如果成功获取到歌曲信息
-                if data.get('songs') and len(data['songs']) > 0:
-                    song_info = data['songs'][0]
-                    
-                    # 提取重要信息
-                    result = {
-                        'name': song_info.get('name', ''),
-                        'id': song_info.get('id', ''),
-                        'duration': song_info.get('dt', 0) / 1000,  # 转换为秒
-                        'artists': [],
-                        'album': {
-                            'name': '',
-                            'id': '',
-                            'picUrl': ''
-                        }
-                    }
-                    
-                    # 提取艺术家信息
-                    if song_info.get('ar'):
-                        for artist in song_info['ar']:
-                            result['artists'].append({
-                                'name': artist.get('name', ''),
-                                'id': artist.get('id', '')
-                            })
-                    
-                    # 提取专辑信息
-                    if song_info.get('al'):
-                        album = song_info['al']
-                        result['album'] = {
-                            'name': album.get('name', ''),
-                            'id': album.get('id', ''),
-                            'picUrl': album.get('picUrl', '')
-                        }
-                    
-                    return result
-                else:
-                    return {"error": f"未找到ID为 {song_id} 的歌曲"}
+        # 获取歌曲详情（批量加载并按ID缓存）
+        song_info = await song_detail_loader.load(song_id)
+        if not song_info:
+            return {"error": f"未找到ID为 {song_id} 的歌曲"}
+
+        # 提取重要信息
+        result = {
+            'name': song_info.get('name', ''),
+            'id': song_info.get('id', ''),
+            'duration': song_info.get('dt', 0) / 1000,  # 转换为秒
+            'artists': [],
+            'album': {
+                'name': '',
+                'id': '',
+                'picUrl': ''
+            }
+        }
+
+        # 提取艺术家信息
+        if song_info.get('ar'):
+            for artist in song_info['ar']:
+                result['artists'].append({
+                    'name': artist.get('name', ''),
+                    'id': artist.get('id', '')
+                })
+
+        # 提取专辑信息
+        if song_info.get('al'):
+            album = song_info['al']
+            result['album'] = {
+                'name': album.get('name', ''),
+                'id': album.get('id', ''),
+                'picUrl': album.get('picUrl', '')
+            }
+
+        return result
     except Exception as e:
         if is_api_connection_error(str(e)):
             return {"error": get_api_error_message()}
@@ -783,6 +1215,10 @@ async def get_playlist_tracks(playlist_id: str, limit: int = 20, offset: int = 0
                 
                 # 打印调试信息
                 print(f"获取到 {len(data.get('songs', []))} 首歌曲")
+
+                # 歌单接口已返回完整的歌曲详情，写入缓存，后续卡片渲染无需再请求
+                for song in data.get('songs', []):
+                    song_detail_loader.prime(song)
                 
                 return data
     except Exception as e:
@@ -7,6 +7,7 @@ import os
 import platform
 import random
 import shlex
+import shutil
 import subprocess
 from collections import deque
 import time
@@ -19,6 +20,49 @@ BITRATE = "128k"
 PAYLOAD_TYPE = 111
 SSRC = 1111
 
+# 预下载设置
+PREFETCH_DEPTH = 5  # 按播放顺序向后预测的歌曲数量
+PREFETCH_INTERVAL = 3  # 预下载检查间隔（秒）
+PREFETCH_BYTES_PER_MINUTE = 64 * 1024 * 1024  # 每分钟最多预下载的字节数
+PREFETCH_MIN_FREE_BYTES = 1024 * 1024 * 1024  # 磁盘剩余空间低于该值时暂停预下载
+PREFETCH_RETRY_DELAY = 60  # 预下载临时失败后重试的间隔（秒）
+
+# 推流器生命周期事件
+STREAMER_PLAYING = "playing"  # 正在播放歌曲
+STREAMER_IDLE = "idle"  # 播放列表为空，等待下载或导入
+STREAMER_EMPTY = "empty"  # 确认没有任何歌曲，音频循环已停止，等待自动退出
+STREAMER_EXIT = "exit"  # 推流器已停止
+# 歌曲事件，data 中包含 track_id（每次开始播放递增）、path、song_info
+TRACK_STARTED = "track_started"  # 开始播放一首歌（单曲循环每次重播都会触发），announce 表示是否需要通知用户
+TRACK_ENDED = "track_ended"  # 一首歌结束，finished 表示自然播放完毕（否则为跳过或停止）
+TRACKS_UPCOMING = "tracks_upcoming"  # 预下载预测的即将播放歌曲，data 中 song_ids 按播放顺序排列，详情已加载
+
+# 发送给消息回调的通知类型
+NOTICE_NOW_PLAYING = "now_playing"  # 正在播放
+NOTICE_UP_NEXT = "up_next"  # 即将播放
+NOTICE_LIST_RESTART = "list_restart"  # 列表循环重新开始
+
+
+class StreamerNotice:
+    """推流器发送给消息回调的结构化通知，接收方按类型和频道ID处理，不需要解析文本"""
+
+    __slots__ = ('type', 'channel_id', 'text', 'track')
+
+    def __init__(self, notice_type, channel_id, text, track=None):
+        """
+        :param notice_type: 通知类型（NOTICE_*）
+        :param channel_id: 语音频道ID
+        :param text: 显示给用户的文本
+        :param track: 相关歌曲的信息字典（可能为None）
+        """
+        self.type = notice_type
+        self.channel_id = channel_id
+        self.text = text
+        self.track = track
+
+    def __str__(self):
+        return self.text
+
 
 # 设置 ffmpeg 路径
 def set_ffmpeg_path():
@@ -36,6 +80,27 @@ def set_ffprobe_path():
     return ffprobe_path
 
 
+# 歌曲元数据存储和 AudioLib 缓存管理器（独立使用本模块时可能不可用）
+try:
+    from metadata_store import song_metadata_store
+except ImportError:
+    song_metadata_store = None
+try:
+    from audio_cache import audio_lib_cache
+except ImportError:
+    audio_lib_cache = None
+try:
+    from metrics import metrics
+except ImportError:
+    metrics = None
+
+# FFmpeg 进程指标（独立使用本模块时不记录）
+if metrics is not None:
+    ffmpeg_processes_started = metrics.counter('ffmpeg_processes_started_total', "启动的 FFmpeg 进程数", ('kind',))
+    audio_loop_restarts = metrics.counter('audio_loop_restarts_total', "停止后重新启动音频循环的次数")
+else:
+    ffmpeg_processes_started = audio_loop_restarts = None
+
 # 仅在Windows上导入需要的模块
 if platform.system() == 'Windows':
     import win32pipe
@@ -99,6 +164,25 @@ class PlaylistManager:
             return True
         return False
 
+    def get_known_song_info(self, song_path):
+        """
+        获取已知的歌曲信息，优先使用 songs_info，其次根据文件名中的歌曲ID查询元数据存储
+
+        :param song_path: 歌曲文件路径
+        :return: 歌曲信息字典，没有记录时返回None
+        """
+        song_info = self.songs_info.get(song_path)
+        if song_info is not None:
+            return song_info
+        if song_metadata_store is None or not song_path:
+            return None
+
+        song_id = os.path.splitext(os.path.basename(song_path))[0]
+        song_info = song_metadata_store.get_song_info(song_id) if song_id.isdigit() else None
+        if song_info:
+            self.songs_info[song_path] = song_info
+        return song_info
+
     def get_current_audio(self):
         """获取当前正在播放的音频路径"""
         if self.current_song:
@@ -214,26 +298,30 @@ class PlaylistManager:
 
         # 更新当前歌曲和歌曲信息
         self.current_song = next_song
+        # 记录播放，供缓存淘汰策略使用
+        if audio_lib_cache is not None:
+            audio_lib_cache.record_access(next_song)
         # 记录歌曲开始播放的时间
         self.current_song_start_time = time.time()
 
         # 首先检查是否有预先存储的信息，否则使用ffprobe获取
-        if self.current_song in self.songs_info:
+        song_info = self.get_known_song_info(self.current_song)
+        if song_info:
             # 构建类似ffprobe返回的格式
-            song_info = self.songs_info[self.current_song]
             title = f"{song_info.get('song_name', '')} - {song_info.get('artist_name', '')}"
 
             self.current_song_info = {
                 'title': title,
-                'duration': 0,  # 没有精确时长，可能需要从ffprobe获取
+                'duration': float(song_info.get('duration') or 0),
                 'path': self.current_song,
                 'full_info': song_info
             }
 
-            # 使用ffprobe补充获取时长信息
-            probe_info = self.get_song_info(self.current_song)
-            if probe_info:
-                self.current_song_info['duration'] = probe_info.get('duration', 0)
+            # 元数据中没有时长时，使用ffprobe补充获取
+            if not self.current_song_info['duration']:
+                probe_info = self.get_song_info(self.current_song)
+                if probe_info:
+                    self.current_song_info['duration'] = probe_info.get('duration', 0)
         else:
             # 没有预存信息，使用ffprobe获取
             self.current_song_info = self.get_song_info(self.current_song)
@@ -366,8 +454,8 @@ class PlaylistManager:
             duration = float(info.get('format', {}).get('duration', 0))
 
             # 首先检查是否有预先存储的信息
-            if song_path in self.songs_info:
-                song_info = self.songs_info[song_path]
+            song_info = self.get_known_song_info(song_path)
+            if song_info:
                 title = f"{song_info.get('song_name', '')} - {song_info.get('artist_name', '')}"
             else:
                 # 尝试获取媒体标签中的标题
@@ -388,12 +476,12 @@ class PlaylistManager:
             print(f"获取歌曲信息出错: {e}")
 
             # 如果ffprobe失败但有预存信息
-            if song_path in self.songs_info:
-                song_info = self.songs_info[song_path]
+            song_info = self.get_known_song_info(song_path)
+            if song_info:
                 title = f"{song_info.get('song_name', '')} - {song_info.get('artist_name', '')}"
                 return {
                     'title': title,
-                    'duration': 0,
+                    'duration': float(song_info.get('duration') or 0),
                     'path': song_path
                 }
 
@@ -622,6 +710,58 @@ class PlaylistManager:
         self.download_queue.append(track_info)
         return True
 
+    @staticmethod
+    def _track_song_id(track):
+        """从临时列表/下载队列的条目中取出歌曲ID，本地文件返回None"""
+        if isinstance(track, dict):
+            song_id = str(track.get('id', '') or '')
+            return song_id or None
+        if isinstance(track, str) and not os.path.exists(track):
+            return track
+        return None
+
+    def get_upcoming_song_ids(self, count):
+        """
+        按实际播放顺序预测接下来需要的歌曲ID
+
+        顺序依次为：下载队列、临时播放列表（随机模式下创建时已打乱，即未来的随机顺序），
+        列表循环模式下临时列表播完后会回绕到完整歌单开头。
+
+        :param count: 最多返回的歌曲数量
+        :return: 歌曲ID列表
+        """
+        song_ids = []
+        seen = set()
+
+        def collect(tracks):
+            for track in tracks:
+                if len(song_ids) >= count:
+                    return
+                song_id = self._track_song_id(track)
+                if song_id and song_id not in seen:
+                    seen.add(song_id)
+                    song_ids.append(song_id)
+
+        collect(list(self.download_queue))
+        collect(list(self.temp_playlist))
+        if self.play_mode == "list_loop" and self.full_playlist:
+            collect(self.full_playlist)
+        return song_ids
+
+    def get_pinned_paths(self):
+        """
+        获取正在播放、排队中以及即将预下载的歌曲文件路径，这些文件不能被缓存淘汰
+
+        :return: 文件路径集合
+        """
+        audio_dir = os.path.abspath("./AudioLib")
+        pinned = set(self.playlist)
+        if self.current_song:
+            pinned.add(self.current_song)
+        for song_id in self.get_upcoming_song_ids(PREFETCH_DEPTH):
+            pinned.add(os.path.join(audio_dir, f"{song_id}.mp3"))
+        return pinned
+
     def add_playlist_batch(self, tracks_info):
         """
         批量添加歌单中的歌曲信息到系统
@@ -653,7 +793,9 @@ class PlaylistManager:
                 'id': song_id,
                 'song_name': track.get('name', '未知歌曲'),
                 'artist_name': artist_name,
-                'album_name': track.get('al', {}).get('name', '未知专辑')
+                'album_name': track.get('al', {}).get('name', '未知专辑'),
+                'duration': (track.get('dt') or 0) / 1000,  # 转换为秒
+                'pic_url': track.get('al', {}).get('picUrl', '')
             }
 
             # 添加到完整歌单
@@ -786,8 +928,8 @@ class PlaylistManager:
                 break
 
             # 获取歌曲标题
-            if song_path in self.songs_info:
-                song_info = self.songs_info[song_path]
+            song_info = self.get_known_song_info(song_path)
+            if song_info:
                 title = f"{song_info.get('song_name', '')} - {song_info.get('artist_name', '')}"
             else:
                 # 使用ffprobe获取信息
@@ -930,11 +1072,10 @@ class PlaylistManager:
         Returns:
             float: 歌曲时长（秒），如果无法获取则返回0
         """
-        # 首先检查是否有预存的歌曲信息
-        if file_path in self.songs_info:
-            info = self.songs_info[file_path]
-            if 'duration' in info:
-                return float(info['duration'])
+        # 首先检查是否有预存的歌曲信息（包括元数据存储中的记录）
+        info = self.get_known_song_info(file_path)
+        if info and info.get('duration'):
+            return float(info['duration'])
 
         # 使用ffprobe获取时长
         try:
@@ -1007,12 +1148,51 @@ class FFmpegPipeStreamer:
         # 任务
         self.audio_loop_task = None
         self.download_task = None
+        self._prefetch_task = None
+        self._prefetch_history = deque()  # 最近一分钟预下载记录 (时间, 字节数)
+        self._prefetch_failed = set()  # 无法下载的歌曲ID（例如需要VIP），不再重试
+        self._prefetch_retry_at = {}  # 临时失败的歌曲ID -> 可以重试的时间
+        self._last_upcoming = []  # 上一次通知的即将播放歌曲
 
         # 第一首歌标志
         self.is_first_song = True
 
+        # 生命周期状态和事件监听器
+        self.lifecycle_state = None
+        self._event_listeners = []
+        self.current_track_id = 0  # 当前（或最近一次）播放的歌曲序号
+        self.track_samples = 0  # 当前歌曲已写入管道的采样数，作为播放进度的时钟
+
         print(f"初始化FFmpegPipeStreamer，推流地址: {rtp_url}，比特率: {self.bitrate}，音量: {self.volume}")
 
+    def add_event_listener(self, callback):
+        """
+        注册推流器事件监听器
+
+        :param callback: callback(event, data)，event 为生命周期事件（STREAMER_*），data 为附加信息字典；
+                         在事件循环线程中同步调用，不能阻塞
+        """
+        if callback not in self._event_listeners:
+            self._event_listeners.append(callback)
+
+    def remove_event_listener(self, callback):
+        if callback in self._event_listeners:
+            self._event_listeners.remove(callback)
+
+    def _emit(self, event, **data):
+        for callback in list(self._event_listeners):
+            try:
+                callback(event, data)
+            except Exception as e:
+                print(f"推流器事件 {event} 的监听器出错: {e}")
+
+    def _set_lifecycle(self, state):
+        """切换生命周期状态，只在状态变化时发出事件"""
+        if self.lifecycle_state == state:
+            return
+        self.lifecycle_state = state
+        self._emit(state, channel_id=self.channel_id)
+
     def _get_pipe_path(self):
         """获取管道路径，使用channel_id确保唯一性"""
         if platform.system() == 'Windows':
@@ -1079,6 +1259,9 @@ class FFmpegPipeStreamer:
                 stderr=subprocess.PIPE
             )
 
+        if ffmpeg_processes_started is not None:
+            ffmpeg_processes_started.inc(kind="streamer")
+
         # Windows上连接管道
         if platform.system() == 'Windows':
             win32pipe.ConnectNamedPipe(self._pipe, None)
@@ -1103,6 +1286,10 @@ class FFmpegPipeStreamer:
             # 启动下载管理任务
             self._download_task = asyncio.create_task(self._manage_downloads())
 
+            # 启动预下载任务
+            if self._prefetch_task is None or self._prefetch_task.done():
+                self._prefetch_task = asyncio.create_task(self._prefetch_loop())
+
             while self._running:
                 # 检查播放列表是否为空
                 current_audio_path = self.playlist_manager.get_current_audio()
@@ -1128,6 +1315,7 @@ class FFmpegPipeStreamer:
                         continue
                     else:
                         # 没有待处理的歌曲，计时器增加
+                        self._set_lifecycle(STREAMER_IDLE)
                         empty_playlist_timer += 1
                         print(f"播放列表为空 ({empty_playlist_timer}/5)，无待处理歌曲")
 
@@ -1164,6 +1352,7 @@ class FFmpegPipeStreamer:
                                 self.playlist_manager.playlist.clear()
                                 self.playlist_manager.download_queue.clear()
                                 self.playlist_manager.temp_playlist.clear()
+                                self._set_lifecycle(STREAMER_EMPTY)
 
                                 # 终止循环，避免重置标志
                                 break
@@ -1200,6 +1389,7 @@ class FFmpegPipeStreamer:
                                 self.playlist_manager.playlist.clear()
                                 self.playlist_manager.download_queue.clear()
                                 self.playlist_manager.temp_playlist.clear()
+                                self._set_lifecycle(STREAMER_EMPTY)
 
                                 print(f"已设置exit_due_to_empty_playlist为True（频道将自动退出），音频循环已标记为停止")
                                 # 终止循环，避免重置标志
@@ -1210,12 +1400,17 @@ class FFmpegPipeStreamer:
                     # 重置计时器
                     empty_playlist_timer = 0
                     self.exit_due_to_empty_playlist = False
+                    self._set_lifecycle(STREAMER_PLAYING)
 
                 try:
                     # 获取当前播放的歌曲信息
-                    song_info = None
-                    if current_audio_path in self.playlist_manager.songs_info:
-                        song_info = self.playlist_manager.songs_info[current_audio_path]
+                    song_info = self.playlist_manager.get_known_song_info(current_audio_path)
+
+                    # 发出开始播放事件，由监听器处理播放卡片
+                    self.current_track_id += 1
+                    track_id = self.current_track_id
+                    self._emit(TRACK_STARTED, channel_id=self.channel_id, track_id=track_id, path=current_audio_path,
+                               song_info=song_info, announce=not self.playlist_manager.current_song_notified)
 
                     # 通知用户正在播放的歌曲
                     if self.message_callback and self.message_obj and not self.playlist_manager.current_song_notified:
@@ -1236,7 +1431,8 @@ class FFmpegPipeStreamer:
                             self.is_first_song = False
 
                             # 发送播放通知
-                            await self.message_callback(self.message_obj, f"正在播放: {song_name} - {artist_name}")
+                            await self.message_callback(self.message_obj, StreamerNotice(
+                                NOTICE_NOW_PLAYING, self.channel_id, f"正在播放: {song_name} - {artist_name}", song_info))
                         except Exception as e:
                             print(f"处理播放通知时出错: {e}")
 
@@ -1261,9 +1457,12 @@ class FFmpegPipeStreamer:
                         stdout=subprocess.PIPE,
                         stderr=subprocess.PIPE
                     )
+                    if ffmpeg_processes_started is not None:
+                        ffmpeg_processes_started.inc(kind="player")
 
                     # 从播放器读取数据并写入管道
                     buffer_size = 8192  # 恢复原来的缓冲区大小
+                    self.track_samples = 0
                     while self._running and self.playlist_manager.current_song == current_audio_path:
                         try:
                             # 非阻塞读取
@@ -1278,6 +1477,8 @@ class FFmpegPipeStreamer:
                             else:
                                 with open(self.pipe_path, 'wb') as pipe:
                                     pipe.write(data)
+                            # s16le 每个采样点每个声道 2 字节
+                            self.track_samples += len(data) // (2 * CHANNELS)
 
                             # 让出控制权给其他任务，但不要过长时间暂停
                             await asyncio.sleep(0.005)  # 使用更短的暂停时间
@@ -1291,6 +1492,10 @@ class FFmpegPipeStreamer:
                         self.ffmpeg_process_player.terminate()
                         self.ffmpeg_process_player = None
 
+                    self._emit(TRACK_ENDED, channel_id=self.channel_id, track_id=track_id, path=current_audio_path,
+                               song_info=song_info,
+                               finished=self._running and self.playlist_manager.current_song == current_audio_path)
+
                     # 如果是自然播放完毕（没有被跳过），根据播放模式处理
                     if self.playlist_manager.current_song == current_audio_path:
                         if self.playlist_manager.play_mode == "single_loop":
@@ -1308,7 +1513,8 @@ class FFmpegPipeStreamer:
                                         self.playlist_manager._recreate_temp_playlist()
                                         self.playlist_manager._refill_playlist_from_temp()
 
-                                    await self.message_callback(self.message_obj, "列表播放完毕，将重新开始播放")
+                                    await self.message_callback(self.message_obj, StreamerNotice(
+                                        NOTICE_LIST_RESTART, self.channel_id, "列表播放完毕，将重新开始播放"))
                                 except Exception as e:
                                     print(f"发送列表循环通知时出错: {e}")
 
@@ -1334,8 +1540,8 @@ class FFmpegPipeStreamer:
                                     # 尽管是随机模式，但即将播放的歌曲已经在队列前端
                                     next_song_path = self.playlist_manager.playlist[0]
 
-                                    if next_song_path in self.playlist_manager.songs_info:
-                                        next_song_info = self.playlist_manager.songs_info[next_song_path]
+                                    next_song_info = self.playlist_manager.get_known_song_info(next_song_path)
+                                    if next_song_info:
                                         song_name = next_song_info.get('song_name', os.path.basename(next_song_path))
                                         artist_name = next_song_info.get('artist_name', "未知艺术家")
                                         next_song_title = f"{song_name} - {artist_name}"
@@ -1347,8 +1553,9 @@ class FFmpegPipeStreamer:
                                     try:
                                         # 通知用户下一首歌曲
                                         if self._running:  # 只有在仍然运行时才发送消息
-                                            await self.message_callback(self.message_obj,
-                                                                        f"即将播放: {next_song_title}")
+                                            await self.message_callback(self.message_obj, StreamerNotice(
+                                                NOTICE_UP_NEXT, self.channel_id, f"即将播放: {next_song_title}",
+                                                next_song_info))
                                     except Exception as e:
                                         print(f"发送下一首歌曲通知时出错: {e}")
                             else:
@@ -1356,8 +1563,8 @@ class FFmpegPipeStreamer:
                                 if self.playlist_manager.playlist:
                                     next_song_path = self.playlist_manager.playlist[0]
 
-                                    if next_song_path in self.playlist_manager.songs_info:
-                                        next_song_info = self.playlist_manager.songs_info[next_song_path]
+                                    next_song_info = self.playlist_manager.get_known_song_info(next_song_path)
+                                    if next_song_info:
                                         song_name = next_song_info.get('song_name', os.path.basename(next_song_path))
                                         artist_name = next_song_info.get('artist_name', "未知艺术家")
                                         next_song_title = f"{song_name} - {artist_name}"
@@ -1369,8 +1576,9 @@ class FFmpegPipeStreamer:
                                     try:
                                         # 通知用户下一首歌曲
                                         if self._running:  # 只有在仍然运行时才发送消息
-                                            await self.message_callback(self.message_obj,
-                                                                        f"即将播放: {next_song_title}")
+                                            await self.message_callback(self.message_obj, StreamerNotice(
+                                                NOTICE_UP_NEXT, self.channel_id, f"即将播放: {next_song_title}",
+                                                next_song_info))
                                     except Exception as e:
                                         print(f"发送下一首歌曲通知时出错: {e}")
 
@@ -1547,6 +1755,79 @@ class FFmpegPipeStreamer:
                 self.playlist_manager.is_downloading = False
             print("下载管理任务结束")
 
+    def _prefetch_budget_available(self):
+        """检查预下载的带宽和磁盘预算"""
+        now = time.monotonic()
+        while self._prefetch_history and now - self._prefetch_history[0][0] > 60:
+            self._prefetch_history.popleft()
+        if sum(size for _, size in self._prefetch_history) >= PREFETCH_BYTES_PER_MINUTE:
+            return False
+
+        try:
+            audio_dir = os.path.abspath("./AudioLib")
+            free = shutil.disk_usage(audio_dir if os.path.isdir(audio_dir) else ".").free
+        except OSError as e:
+            print(f"获取磁盘剩余空间失败: {e}")
+            return False
+        return free >= PREFETCH_MIN_FREE_BYTES
+
+    async def _prefetch_loop(self):
+        """按预测的播放顺序在后台预下载即将播放的歌曲，并预热歌曲详情缓存"""
+        while self._running:
+            try:
+                await asyncio.sleep(PREFETCH_INTERVAL)
+                await self._prefetch_once()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                # 单次失败（例如超时或本地 API 重启）不影响之后的预下载
+                print(f"预下载任务异常: {e}")
+
+    async def _prefetch_once(self):
+        """预下载一轮即将播放的歌曲"""
+        # 动态导入NeteaseAPI，避免循环导入
+        import importlib
+        NeteaseAPI = importlib.import_module("NeteaseAPI")
+
+        now = time.monotonic()
+        upcoming = [song_id for song_id in self.playlist_manager.get_upcoming_song_ids(PREFETCH_DEPTH)
+                    if song_id not in self._prefetch_failed and self._prefetch_retry_at.get(song_id, 0) <= now]
+        if not upcoming:
+            self._last_upcoming = []
+            return
+
+        # 歌曲详情按批次合并请求，已缓存的不会再次请求
+        await NeteaseAPI.prefetch_song_details(upcoming)
+        if upcoming != self._last_upcoming:
+            # 只在预测结果变化时通知，避免监听方每轮都重新处理
+            self._last_upcoming = upcoming
+            self._emit(TRACKS_UPCOMING, channel_id=self.channel_id, song_ids=upcoming)
+
+        for song_id in upcoming:
+            if not self._running:
+                break
+            if os.path.exists(os.path.join(os.path.abspath("./AudioLib"), f"{song_id}.mp3")):
+                continue
+            if not self._prefetch_budget_available():
+                break
+
+            # 与下载管理任务下载同一首歌时会共享同一次下载
+            result = await NeteaseAPI.download_music_by_id(song_id)
+            if "error" in result:
+                print(f"预下载歌曲 {song_id} 失败: {result['error']}")
+                if result.get('permanent'):
+                    self._prefetch_failed.add(song_id)
+                else:
+                    # 网络错误等临时失败，稍后重试
+                    self._prefetch_retry_at[song_id] = time.monotonic() + PREFETCH_RETRY_DELAY
+                continue
+            self._prefetch_retry_at.pop(song_id, None)
+            if not result.get('cached'):
+                file_path = result.get('file_name', '')
+                size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+                self._prefetch_history.append((time.monotonic(), size))
+                print(f"已预下载歌曲: {result.get('song_name', song_id)}")
+
     async def stop(self):
         """停止所有FFmpeg进程"""
         self._running = False
@@ -1566,6 +1847,14 @@ class FFmpegPipeStreamer:
             except asyncio.CancelledError:
                 pass
 
+        # 取消预下载任务
+        if self._prefetch_task and not self._prefetch_task.done():
+            self._prefetch_task.cancel()
+            try:
+                await self._prefetch_task
+            except asyncio.CancelledError:
+                pass
+
         # 停止播放器进程
         if self.ffmpeg_process_player:
             try:
@@ -1612,6 +1901,8 @@ class FFmpegPipeStreamer:
             # 重置通知标志，避免在退出时发送"即将播放"消息
             self.playlist_manager.current_song_notified = True
 
+        self._set_lifecycle(STREAMER_EXIT)
+
     async def add_song(self, file_path, song_info=None):
         """
         添加歌曲到播放列表
@@ -1638,9 +1929,35 @@ class FFmpegPipeStreamer:
             if self.playlist_manager.has_songs():
                 asyncio.create_task(self._audio_loop())
                 print("播放列表更新，已重新启动音频循环")
+                if audio_loop_restarts is not None:
+                    audio_loop_restarts.inc()
 
         return playlist_empty  # 返回是否是播放列表中的第一首歌
 
+    def get_track_position(self) -> float:
+        """
+        根据已写入管道的采样数获取当前歌曲的播放位置
+
+        :return: 播放位置（秒）
+        """
+        return self.track_samples / SAMPLE_RATE
+
+    def resume(self):
+        """
+        自动退出等待期间又有了歌曲时，重新启动已停止的音频循环
+
+        :return: 是否重新启动了音频循环
+        """
+        self.exit_due_to_empty_playlist = False
+        if self._running or not self.playlist_manager.has_songs():
+            return False
+        self._running = True
+        self.audio_loop_task = asyncio.create_task(self._audio_loop())
+        print("播放列表更新，已重新启动音频循环")
+        if audio_loop_restarts is not None:
+            audio_loop_restarts.inc()
+        return True
+
     async def update_volume(self, new_volume):
         """更新音量设置
         
@@ -18,9 +18,42 @@ class VoiceClientError(Exception):
         return base
 
 
+# 共享的HTTP连接池：同一令牌的所有客户端共用一个 ClientSession
+_shared_sessions = {}
+# 连接池中最多同时保持的连接数
+POOL_LIMIT = 32
+
+
+def get_shared_session(token):
+    """
+    获取指定令牌的共享 ClientSession，不存在或已关闭时创建
+
+    :param token: Kook API令牌
+    :return: aiohttp.ClientSession
+    """
+    session = _shared_sessions.get(token)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT, ttl_dns_cache=300)
+        session = aiohttp.ClientSession(headers={"Authorization": f"Bot {token}"}, connector=connector)
+        _shared_sessions[token] = session
+    return session
+
+
+async def close_shared_sessions():
+    """关闭所有共享的 ClientSession，在程序退出时调用"""
+    sessions = list(_shared_sessions.values())
+    _shared_sessions.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()
+
+
 class KookVoiceClient:
     """
     Kook App Voice API
+
+    客户端本身只保存令牌和频道ID，所有请求都通过同一令牌共享的连接池发送，
+    因此为每个频道或每次调用创建客户端几乎没有开销。
     """
 
     def __init__(self, token, channel_id=None):
@@ -30,7 +63,11 @@ class KookVoiceClient:
         self.headers = {
             "Authorization": f"Bot {self.token}"
         }
-        self.session = aiohttp.ClientSession(headers=self.headers)
+
+    @property
+    def session(self):
+        """共享的 ClientSession（首次使用时在事件循环中创建）"""
+        return get_shared_session(self.token)
 
     async def join_channel(self, audio_ssrc="1111", audio_pt="111", rtcp_mux=True, password=None):
         """
@@ -244,6 +281,6 @@ class KookVoiceClient:
 
     async def close(self):
         """
-        关闭HTTP会话
+        释放客户端。连接池由所有客户端共享，这里不会关闭它，关闭请使用 close_shared_sessions
         """
-        await self.session.close()
+        pass
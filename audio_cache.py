@@ -0,0 +1,375 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 音频缓存目录
+AUDIO_LIB_PATH = "./AudioLib"
+# 缓存索引文件（文件大小、最近播放时间、播放次数）
+CACHE_INDEX_FILE = os.path.join(AUDIO_LIB_PATH, ".cache_index.json")
+# 纳入缓存管理的音频后缀
+AUDIO_EXTENSIONS = (".flac", ".mp3", ".wav")
+# 默认缓存容量上限（字节）
+DEFAULT_BUDGET_BYTES = 1024 * 1024 * 1024
+# 索引写盘的延迟（秒），合并短时间内的多次更新
+SAVE_DELAY = 5.0
+# 后台校对索引与实际文件的间隔（秒）
+RECONCILE_INTERVAL = 6 * 3600
+
+
+def _normalize_path(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+class AudioLibCache:
+    """
+    AudioLib 缓存管理器
+
+    在内存中维护每个音频文件的大小、最近访问时间和播放次数，总大小超过容量上限时
+    按 LRU（最近最少使用）或 LFU（最不经常使用）淘汰文件。正在播放、排队中或即将预下载的
+    文件由 pin_provider 提供，永远不会被淘汰。只有机器人下载的文件（根目录下的 <歌曲ID>.mp3）
+    会被淘汰，用户手动放入的本地音频计入总大小，但不会被删除。
+
+    索引延迟写入 CACHE_INDEX_FILE，在下载、播放和淘汰时增量更新。启动时直接加载索引，
+    不再遍历目录；索引与实际文件的差异（例如手动删除或复制文件）由后台线程定期校对。
+    """
+
+    def __init__(self, root: str = AUDIO_LIB_PATH, budget_bytes: int = DEFAULT_BUDGET_BYTES,
+                 policy: str = "lfu", index_path: str = CACHE_INDEX_FILE):
+        """
+        :param root: 音频缓存目录
+        :param budget_bytes: 缓存容量上限（字节）
+        :param policy: 淘汰策略，"lru" 或 "lfu"
+        :param index_path: 索引文件路径
+        """
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.policy = policy
+        self.index_path = index_path
+        self.total_size = 0
+        self._entries = {}  # 绝对路径 -> {'size': 字节数, 'last_access': 时间戳, 'play_count': 播放次数}
+        self._lock = threading.Lock()
+        self._pin_provider = None
+        self._save_timer = None
+        self._reconcile_thread = None
+        self._listeners = []
+        self._loop = None
+
+    def configure(self, budget_bytes: int = None, policy: str = None):
+        """
+        更新容量上限和淘汰策略
+
+        :param budget_bytes: 缓存容量上限（字节）
+        :param policy: 淘汰策略，"lru" 或 "lfu"
+        """
+        if budget_bytes is not None:
+            self.budget_bytes = budget_bytes
+        if policy is not None:
+            if policy not in ("lru", "lfu"):
+                logger.warning(f"未知的淘汰策略 {policy}，使用 lfu")
+                policy = "lfu"
+            self.policy = policy
+
+    def set_pin_provider(self, provider):
+        """
+        设置不可淘汰文件的提供函数
+
+        :param provider: 无参数函数，返回正在播放/排队中的文件路径集合
+        """
+        self._pin_provider = provider
+
+    def bind_loop(self, loop):
+        """
+        设置事件循环，后台线程需要淘汰文件时交给该事件循环执行
+
+        :param loop: 机器人运行的事件循环
+        """
+        self._loop = loop
+
+    def add_listener(self, callback):
+        """
+        注册文件变化的回调，例如本地曲库索引
+
+        :param callback: callback(added, removed)，参数为新增和移除的文件路径列表，可能在后台线程中调用
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, added=(), removed=()):
+        if not added and not removed:
+            return
+        for callback in self._listeners:
+            try:
+                callback(list(added), list(removed))
+            except Exception as e:
+                logger.error(f"AudioLib 文件变化回调出错: {e}")
+
+    def paths(self):
+        """获取索引中的全部文件路径"""
+        with self._lock:
+            return list(self._entries.keys())
+
+    @staticmethod
+    def is_audio_file(path: str) -> bool:
+        return path.lower().endswith(AUDIO_EXTENSIONS)
+
+    def is_downloaded(self, key: str) -> bool:
+        """是否是机器人下载的文件（根目录下的 <歌曲ID>.mp3），只有这些文件可以被淘汰"""
+        directory, filename = os.path.split(key)
+        stem, ext = os.path.splitext(filename)
+        return stem.isdigit() and ext.lower() == ".mp3" and directory == _normalize_path(self.root)
+
+    def load(self):
+        """
+        从索引文件加载缓存索引
+
+        :return: 是否成功加载（索引文件不存在或损坏时返回False）
+        """
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"读取 AudioLib 缓存索引失败: {e}")
+            return False
+        if not isinstance(data, dict):
+            return False
+
+        entries = {}
+        for key, record in data.items():
+            if isinstance(record, dict) and 'size' in record:
+                entries[key] = {
+                    'size': record['size'],
+                    'last_access': record.get('last_access', 0),
+                    'play_count': record.get('play_count', 0),
+                }
+        with self._lock:
+            self._entries = entries
+            self.total_size = sum(entry['size'] for entry in entries.values())
+        return True
+
+    def scan(self):
+        """遍历缓存目录校对索引：补充新文件、移除已不存在的文件、更新大小，保留访问记录"""
+        sizes = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not self.is_audio_file(filename):
+                    continue
+                file_path = os.path.join(dirpath, filename)
+                # 跳过符号链接防止重复计算或无限循环
+                if os.path.islink(file_path):
+                    continue
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                sizes[_normalize_path(file_path)] = (stat.st_size, stat.st_mtime)
+
+        added, removed = [], []
+        with self._lock:
+            entries = {}
+            changed = False
+            for key, (size, mtime) in sizes.items():
+                entry = self._entries.get(key)
+                if entry is None:
+                    # 遍历时没有持锁，文件可能已在此期间被淘汰，确认仍然存在后再加入索引
+                    if not os.path.exists(key):
+                        continue
+                    entry = {'size': size, 'last_access': mtime, 'play_count': 0}
+                    added.append(key)
+                    changed = True
+                elif entry['size'] != size:
+                    entry['size'] = size
+                    changed = True
+                entries[key] = entry
+            for key, entry in self._entries.items():
+                if key in entries:
+                    continue
+                if os.path.exists(key):
+                    # 扫描期间新下载的文件以内存中的记录为准
+                    entries[key] = entry
+                else:
+                    removed.append(key)
+                    changed = True
+            self._entries = entries
+            self.total_size = sum(entry['size'] for entry in entries.values())
+        if changed:
+            self._schedule_save()
+        self._notify(added, removed)
+
+    def start_reconcile(self, interval: float = RECONCILE_INTERVAL, immediate: bool = False):
+        """
+        启动后台校对线程
+
+        :param interval: 校对间隔（秒）
+        :param immediate: 是否立即执行第一次校对（索引不存在时使用）
+        """
+        if self._reconcile_thread is not None:
+            return
+
+        def run():
+            if not immediate:
+                time.sleep(interval)
+            while True:
+                try:
+                    self.scan()
+                    logger.info(f"AudioLib 缓存索引校对完成，共 {len(self._entries)} 个文件，"
+                                f"{self.total_size / (1024 * 1024):.2f} MB")
+                    # 校对可能发现新文件（首次建立索引时是全部文件），需要重新检查容量上限
+                    self._enforce_budget_on_loop()
+                except Exception as e:
+                    logger.error(f"校对 AudioLib 缓存索引失败: {e}")
+                time.sleep(interval)
+
+        self._reconcile_thread = threading.Thread(target=run, name="audiolib-reconcile", daemon=True)
+        self._reconcile_thread.start()
+
+    def _enforce_budget_on_loop(self):
+        """从后台线程请求淘汰：pin_provider 读取的播放列表状态只能在事件循环线程中访问"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            # 无法安全获取正在使用的文件，留到下次下载时再检查
+            logger.warning("AudioLib 缓存未绑定事件循环，跳过后台淘汰")
+            return
+        loop.call_soon_threadsafe(self.enforce_budget)
+
+    def record_added(self, path: str):
+        """记录新下载的文件，并在超出容量时淘汰旧文件"""
+        if not self.is_audio_file(path):
+            return
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        key = _normalize_path(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            is_new = entry is None
+            if is_new:
+                entry = {'size': 0, 'last_access': time.time(), 'play_count': 0}
+                self._entries[key] = entry
+            self.total_size += size - entry['size']
+            entry['size'] = size
+            entry['last_access'] = time.time()
+        self._schedule_save()
+        if is_new:
+            self._notify(added=[key])
+        # 刚下载的文件还没有播放过，LFU 下会排在最前面，本轮淘汰不能删除它
+        self.enforce_budget(protect={key})
+
+    def record_access(self, path: str):
+        """记录一次播放"""
+        if not path or not self.is_audio_file(path):
+            return
+        key = _normalize_path(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    return
+                entry = {'size': size, 'last_access': 0, 'play_count': 0}
+                self._entries[key] = entry
+                self.total_size += size
+            entry['last_access'] = time.time()
+            entry['play_count'] += 1
+        self._schedule_save()
+
+    def remove(self, path: str):
+        """从索引中移除文件（不删除文件本身）"""
+        key = _normalize_path(path)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self.total_size -= entry['size']
+        if entry:
+            self._notify(removed=[key])
+
+    def enforce_budget(self, protect=()):
+        """
+        总大小超过容量上限时淘汰文件，直到回到上限以内
+
+        必须在事件循环线程中调用，pin_provider 会读取事件循环中的播放列表状态。
+
+        :param protect: 本轮不淘汰的文件路径（已规范化），例如刚下载的文件
+        :return: 被删除的文件路径列表
+        """
+        if self.total_size <= self.budget_bytes:
+            return []
+
+        pinned = set(protect)
+        if self._pin_provider:
+            try:
+                pinned.update(_normalize_path(path) for path in self._pin_provider() if path)
+            except Exception as e:
+                # 无法确定哪些文件正在使用时不淘汰任何文件
+                logger.error(f"获取正在使用的音频文件失败，跳过淘汰: {e}")
+                return []
+
+        with self._lock:
+            if self.policy == "lru":
+                candidates = sorted(self._entries.items(), key=lambda item: item[1]['last_access'])
+            else:
+                candidates = sorted(self._entries.items(),
+                                    key=lambda item: (item[1]['play_count'], item[1]['last_access']))
+
+        removed = []
+        for key, entry in candidates:
+            if self.total_size <= self.budget_bytes:
+                break
+            if key in pinned or not self.is_downloaded(key):
+                continue
+            try:
+                os.remove(key)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"淘汰缓存文件 {key} 失败: {e}")
+                continue
+            self.remove(key)
+            removed.append(key)
+
+        if removed:
+            logger.info(f"AudioLib 超出容量上限，已淘汰 {len(removed)} 个文件，当前大小 {self.total_size / (1024 * 1024):.2f} MB")
+            self._schedule_save()
+        return removed
+
+    def _schedule_save(self):
+        """延迟写入索引，合并短时间内的多次更新"""
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(SAVE_DELAY, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def save(self):
+        """原子写入索引"""
+        with self._lock:
+            self._save_timer = None
+            snapshot = {key: dict(entry) for key, entry in self._entries.items()}
+        try:
+            directory = os.path.dirname(os.path.abspath(self.index_path))
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".cache_index.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self.index_path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        except Exception as e:
+            logger.error(f"保存 AudioLib 缓存索引失败: {e}")
+
+
+# 全局 AudioLib 缓存管理器
+audio_lib_cache = AudioLibCache()
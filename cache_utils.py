@@ -0,0 +1,206 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+# 缓存未命中时 get 返回的默认值
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    带过期时间的 LRU 缓存
+
+    每个条目可以单独指定有效期，超过 maxsize 时淘汰最久未使用的条目。
+    只在事件循环线程中使用，不加锁。
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 60.0):
+        """
+        :param maxsize: 最多保存的条目数量
+        :param ttl: 默认有效期（秒）
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, 过期时间)
+
+    def get(self, key, default=None):
+        """获取未过期的值，过期或不存在时返回 default"""
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        写入缓存
+
+        :param key: 键
+        :param value: 值
+        :param ttl: 有效期（秒），为 None 时使用默认有效期
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            self._data.pop(key, None)
+            return
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """删除并返回缓存中的值"""
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ExpiringDict(MutableMapping):
+    """
+    自动过期的字典，用于长期运行时会不断增加键的状态表（冷却时间、按钮锁、卡片消息等）
+
+    条目可以按写入时间（或最近访问时间）过期，也可以由 is_stale 判断失效（例如任务已结束）；
+    超过 maxsize 时淘汰最久未使用的条目。访问单个键时惰性检查过期，遍历和获取长度时先清理全部过期条目，
+    写入时按 sweep_interval 定期清理，内存占用不会随运行时间增长。用法与普通字典相同。
+    """
+
+    def __init__(self, ttl: float = None, maxsize: int = None, sliding: bool = False,
+                 is_stale=None, sweep_interval: float = 60.0):
+        """
+        :param ttl: 有效期（秒），为 None 时不按时间过期
+        :param maxsize: 最多保存的条目数量，为 None 时不限制
+        :param sliding: 为 True 时每次读取都会重新计算有效期
+        :param is_stale: 函数 is_stale(value)，返回 True 时条目视为过期
+        :param sweep_interval: 定期清理的最小间隔（秒）
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.sliding = sliding
+        self.is_stale = is_stale
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> [value, 过期时间或None]
+        self._lock = threading.RLock()
+        self._last_sweep = time.monotonic()
+
+    def _expired(self, item, now) -> bool:
+        if item[1] is not None and item[1] <= now:
+            return True
+        if self.is_stale is not None:
+            try:
+                return bool(self.is_stale(item[0]))
+            except Exception:
+                return False
+        return False
+
+    def _expires_at(self, now):
+        return None if self.ttl is None else now + self.ttl
+
+    def __getitem__(self, key):
+        with self._lock:
+            item = self._data[key]
+            now = time.monotonic()
+            if self._expired(item, now):
+                del self._data[key]
+                raise KeyError(key)
+            if self.sliding:
+                item[1] = self._expires_at(now)
+            self._data.move_to_end(key)
+            return item[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = [value, self._expires_at(now)]
+            self._data.move_to_end(key)
+            self._maybe_sweep(now)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __iter__(self):
+        return iter([key for key, _ in self._live_items()])
+
+    def __len__(self):
+        with self._lock:
+            self.sweep()
+            return len(self._data)
+
+    def items(self):
+        """未过期的 (键, 值) 列表，遍历不会延长 sliding 条目的有效期"""
+        return self._live_items()
+
+    def values(self):
+        """未过期的值列表"""
+        return [value for _, value in self._live_items()]
+
+    def _live_items(self):
+        # 清理和取快照在同一次加锁中完成，返回的键不会在读取值时已经过期
+        with self._lock:
+            self.sweep()
+            return [(key, item[0]) for key, item in self._data.items()]
+
+    def _maybe_sweep(self, now):
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+    def sweep(self) -> int:
+        """
+        立即清理全部过期条目
+
+        :return: 清理的条目数量
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._last_sweep = now
+            expired = [key for key, item in self._data.items() if self._expired(item, now)]
+            for key in expired:
+                del self._data[key]
+            return len(expired)
+
+    def __repr__(self):
+        return f"ExpiringDict({dict(self._live_items())!r})"
+
+
+class SingleFlight:
+    """
+    合并同一个键的并发请求
+
+    同一时刻对同一个键只执行一次协程，其余调用方等待并共享同一个结果（或异常）。
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> Future
+
+    async def do(self, key, factory):
+        """
+        执行或加入对 key 的请求
+
+        :param key: 请求的键
+        :param factory: 无参数的协程函数，只有第一个调用方会执行
+        :return: factory 的返回值
+        """
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: 某个调用方被取消时不影响其他等待同一结果的调用方
+        return await asyncio.shield(future)
@@ -1,26 +1,275 @@
 import asyncio
 import logging
+import time
+from collections.abc import MutableMapping
 
 from VoiceAPI import KookVoiceClient
+from cache_utils import ExpiringDict
 from StreamTools.ffmpeg_stream_tool import FFmpegPipeStreamer, PlaylistManager
 
 # 设置日志
 logger = logging.getLogger(__name__)
 
+# 客户端闲置多久后自动释放（秒），客户端只是共享连接池上的视图，需要时会重新创建
+CLIENT_IDLE_TTL = 3600
+
+# 频道会话的生命周期：加入 -> 推流 -> 空闲 -> 离开
+SESSION_JOINED = "joined"
+SESSION_STREAMING = "streaming"
+SESSION_IDLE = "idle"
+SESSION_LEAVING = "leaving"
+
+
+# region 频道会话
+class ChannelSession:
+    """
+    单个语音频道的全部状态
+
+    原先分散在 keep_alive_tasks、playlist_tasks 等多个字典中的状态都保存在这里，
+    退出频道时由 ChannelSessionRegistry.close 统一停止推流、取消任务并移除会话。
+    """
+
+    # 保存在会话中的字段，旧的全局字典通过 SessionFieldView 映射到这些字段
+    FIELDS = ('keep_alive', 'streamer', 'stream', 'stream_monitor', 'auto_exit', 'now_playing',
+              'playlist_manager', 'card_message_id')
+    # 退出时需要取消的任务字段
+    TASK_FIELDS = ('keep_alive', 'stream_monitor', 'auto_exit', 'now_playing')
+
+    def __init__(self, channel_id, origin_id=None, notify_channel=None):
+        """
+        :param channel_id: 语音频道ID
+        :param origin_id: 发起加入的文字频道ID
+        :param notify_channel: 用于发送通知的文字频道对象
+        """
+        self.channel_id = channel_id
+        self.origin_id = origin_id
+        self.notify_channel = notify_channel
+        self.state = SESSION_JOINED
+        self.created_at = time.monotonic()
+        self.tasks = {}  # 其他附属任务，名称 -> Task
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def get_field(self, field):
+        value = getattr(self, field)
+        if field in self.TASK_FIELDS and value is not None and value.done():
+            # 已结束的任务视为不存在
+            setattr(self, field, None)
+            return None
+        return value
+
+    def set_field(self, field, value):
+        setattr(self, field, value)
+        if field == 'streamer' and value is not None and self.state == SESSION_JOINED:
+            self.state = SESSION_STREAMING
+
+    def add_task(self, name, task):
+        """
+        登记附属任务，同名的旧任务会被取消，任务结束后自动移除
+
+        :param name: 任务名称
+        :param task: asyncio.Task
+        """
+        old = self.tasks.get(name)
+        if old is not None and old is not task:
+            old.cancel()
+        self.tasks[name] = task
+        task.add_done_callback(lambda t: self.tasks.pop(name, None) if self.tasks.get(name) is t else None)
+
+    def is_empty(self) -> bool:
+        return all(self.get_field(field) is None for field in self.FIELDS) and not self.tasks
+
+    def cancel_tasks(self):
+        """取消会话的全部任务（不包括调用方自身所在的任务）"""
+        current = asyncio.current_task()
+        for field in self.TASK_FIELDS:
+            task = getattr(self, field)
+            setattr(self, field, None)
+            if task is not None and task is not current:
+                task.cancel()
+        for task in list(self.tasks.values()):
+            if task is not current:
+                task.cancel()
+        self.tasks.clear()
+
+
+class ChannelSessionRegistry:
+    """
+    频道会话注册表
+
+    按语音频道ID和发起消息所在的文字频道ID都可以 O(1) 查找会话。
+    """
+
+    def __init__(self):
+        self._sessions = {}  # 语音频道ID -> ChannelSession
+        self._by_origin = {}  # 文字频道ID -> {语音频道ID}
+
+    def open(self, channel_id, origin_id=None, notify_channel=None) -> ChannelSession:
+        """
+        获取或创建频道会话
+
+        :param channel_id: 语音频道ID
+        :param origin_id: 发起加入的文字频道ID
+        :param notify_channel: 用于发送通知的文字频道对象
+        :return: 频道会话
+        """
+        session = self._sessions.get(channel_id)
+        if session is None:
+            session = ChannelSession(channel_id)
+            self._sessions[channel_id] = session
+        if origin_id is not None and origin_id != session.origin_id:
+            self._unlink_origin(session)
+            session.origin_id = origin_id
+            self._by_origin.setdefault(origin_id, set()).add(channel_id)
+        if notify_channel is not None:
+            session.notify_channel = notify_channel
+        return session
+
+    def get(self, channel_id):
+        return self._sessions.get(channel_id)
+
+    def by_origin(self, origin_id) -> list:
+        """获取由指定文字频道发起的全部会话"""
+        return [self._sessions[cid] for cid in self._by_origin.get(origin_id, ()) if cid in self._sessions]
+
+    def __contains__(self, channel_id):
+        return channel_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _unlink_origin(self, session):
+        channels = self._by_origin.get(session.origin_id)
+        if channels is not None:
+            channels.discard(session.channel_id)
+            if not channels:
+                del self._by_origin[session.origin_id]
+
+    def _remove(self, channel_id):
+        session = self._sessions.pop(channel_id, None)
+        if session is not None:
+            self._unlink_origin(session)
+        return session
+
+    def discard_if_empty(self, channel_id):
+        """会话中已经没有任何状态时移除会话"""
+        session = self._sessions.get(channel_id)
+        if session is not None and session.state != SESSION_LEAVING and session.is_empty():
+            self._remove(channel_id)
+
+    async def close(self, channel_id, leave=None):
+        """
+        统一的退出流程：停止推流、离开频道、取消全部任务并移除会话
+
+        :param channel_id: 语音频道ID
+        :param leave: 协程函数 leave(channel_id)，用于离开语音频道，为 None 时不调用
+        :return: leave 的返回值，会话不存在或正在退出时返回 None
+        """
+        session = self._sessions.get(channel_id)
+        if session is not None and session.state == SESSION_LEAVING:
+            return None
+        if session is not None:
+            session.state = SESSION_LEAVING
+
+        result = None
+        try:
+            streamer = session.streamer if session is not None else None
+            if streamer is not None:
+                session.streamer = None
+                try:
+                    await streamer.stop()
+                except Exception as e:
+                    logger.error(f"停止频道 {channel_id} 的推流器时出错: {e}")
+            if leave is not None:
+                try:
+                    result = await leave(channel_id)
+                except Exception as e:
+                    logger.error(f"离开频道 {channel_id} 时出错: {e}")
+                    result = {"error": str(e)}
+        finally:
+            if session is not None:
+                session.cancel_tasks()
+                if self._sessions.get(channel_id) is session:
+                    self._remove(channel_id)
+        return result
+
+    def stats(self) -> dict:
+        """
+        获取会话统计，便于观察每个频道的开销
+
+        :return: 语音频道ID -> {'state', 'age', 'tasks'}
+        """
+        now = time.monotonic()
+        return {
+            channel_id: {
+                'state': session.state,
+                'age': now - session.created_at,
+                'tasks': sum(1 for field in session.TASK_FIELDS if session.get_field(field) is not None)
+                         + len(session.tasks),
+            }
+            for channel_id, session in list(self._sessions.items())
+        }
+
+
+class SessionFieldView(MutableMapping):
+    """
+    以字典方式访问所有会话的同一个字段，兼容原先按频道ID保存状态的全局字典
+
+    写入时自动创建会话，删除后会话为空则自动移除。
+    """
+
+    def __init__(self, registry: ChannelSessionRegistry, field: str):
+        self._registry = registry
+        self._field = field
+
+    def __getitem__(self, channel_id):
+        session = self._registry.get(channel_id)
+        value = session.get_field(self._field) if session is not None else None
+        if value is None:
+            raise KeyError(channel_id)
+        return value
+
+    def __setitem__(self, channel_id, value):
+        self._registry.open(channel_id).set_field(self._field, value)
+
+    def __delitem__(self, channel_id):
+        session = self._registry.get(channel_id)
+        if session is None or session.get_field(self._field) is None:
+            raise KeyError(channel_id)
+        session.set_field(self._field, None)
+        self._registry.discard_if_empty(channel_id)
+
+    def __iter__(self):
+        return iter([channel_id for channel_id, session in list(self._registry._sessions.items())
+                     if session.get_field(self._field) is not None])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+# 全局频道会话注册表
+channel_sessions = ChannelSessionRegistry()
+
+
+# endregion
+
+
 # 全局字典来管理客户端实例
-clients = {}
+# 客户端只是共享连接池上的轻量视图，作为缓存按闲置时间过期，不属于会话状态
+clients = ExpiringDict(ttl=CLIENT_IDLE_TTL, sliding=True)
 clients_lock = asyncio.Lock()
 
+# 以下字典均为频道会话字段的视图，保留原有的字典用法
 # 全局字典来管理保持活跃的任务
-keep_alive_tasks = {}
+keep_alive_tasks = SessionFieldView(channel_sessions, 'keep_alive')
 
 # 全局字典来管理推流任务
-stream_tasks = {}
-stream_monitor_tasks = {}
+stream_tasks = SessionFieldView(channel_sessions, 'stream')
+stream_monitor_tasks = SessionFieldView(channel_sessions, 'stream_monitor')
 
 # 新增：全局字典来管理播放列表任务
-playlist_tasks = {}
-playlist_managers = {}
+playlist_tasks = SessionFieldView(channel_sessions, 'streamer')
+playlist_managers = SessionFieldView(channel_sessions, 'playlist_manager')
 
 
 async def get_client(channel_id, token):
@@ -34,24 +283,8 @@ async def get_client(channel_id, token):
     async with clients_lock:
         try:
             if channel_id in clients:
-                # 检查客户端是否仍然有效
-                client = clients[channel_id]
-                # 简单测试客户端是否仍可用
-                try:
-                    # 尝试获取频道列表，如果成功说明客户端仍然有效
-                    list_data = await client.list_channels()
-                    if 'error' in list_data:
-                        logger.warning(f"客户端测试失败，创建新客户端: {list_data.get('error')}")
-                        raise Exception("客户端测试失败")
-                    return client
-                except Exception as e:
-                    logger.warning(f"客户端似乎无效，创建新客户端: {e}")
-                    # 客户端无效，创建新的
-                    await client.close()
-                    client = KookVoiceClient(token, channel_id)
-                    clients[channel_id] = client
-                    logger.info(f"为频道 {channel_id} 重新创建了客户端")
-                    return client
+                # 客户端只是共享连接池上的轻量视图，不需要每次请求频道列表检查是否可用
+                return clients[channel_id]
             else:
                 # 创建新客户端
                 client = KookVoiceClient(token, channel_id)
@@ -66,6 +299,21 @@ async def get_client(channel_id, token):
             return client
 
 
+def get_pinned_audio_paths():
+    """
+    获取所有频道正在播放或排队中的音频文件路径，供 AudioLib 缓存淘汰时跳过
+
+    :return: 文件路径集合
+    """
+    pinned = set()
+    for enhanced_streamer in list(playlist_tasks.values()):
+        streamer = getattr(enhanced_streamer, 'streamer', None)
+        playlist_manager = getattr(streamer, 'playlist_manager', None)
+        if playlist_manager is not None:
+            pinned.update(playlist_manager.get_pinned_paths())
+    return pinned
+
+
 async def remove_client(channel_id):
     """
     移除并关闭指定频道的客户端
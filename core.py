@@ -7,7 +7,12 @@ import os
 import time
 
 from VoiceAPI import KookVoiceClient, VoiceClientError
+from audio_cache import AUDIO_LIB_PATH
+from cache_utils import ExpiringDict
 from client_manager import get_client, remove_client, clients
+from heartbeat import HeartbeatScheduler, HEARTBEAT_INTERVAL
+from library_index import library_index
+from metrics import metrics
 
 
 # region 环境配置部分
@@ -56,20 +61,89 @@ def set_ffmpeg_path():
 # region VoiceAPI调用配置（加入频道退出频道等）
 
 
-async def get_alive_channel_list():
-    client = KookVoiceClient(token)
-    try:
-        # 获取频道列表示例
-        list_data = await client.list_channels()
-        return list_data  # Return the actual data for processing
-    except VoiceClientError as e:
-        return {"error": str(e)}
-    finally:
-        await client.close()
+# 不绑定频道的客户端，用于获取频道列表和离开频道（与其他客户端共享连接池）
+voice_client = KookVoiceClient(token)
+
+
+# 频道列表缓存有效期（秒）
+ALIVE_CHANNEL_TTL = 15
+
+
+class VoiceStateCache:
+    """
+    机器人所在语音频道的缓存
+
+    保存最近一次 /voice/list 的结果和频道ID集合，在有效期内直接返回缓存；
+    加入、离开频道以及心跳成功时直接更新缓存，不需要重新请求。
+    """
+
+    def __init__(self, ttl: float = ALIVE_CHANNEL_TTL):
+        """
+        :param ttl: 缓存有效期（秒）
+        """
+        self.ttl = ttl
+        self.data = None  # 最近一次 /voice/list 的结果
+        self.channel_ids = set()  # 机器人所在的频道ID（字符串）
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self):
+        return self.data is not None and time.monotonic() - self._fetched_at < self.ttl
+
+    async def get(self, force_refresh=False):
+        """
+        获取频道列表
+
+        :param force_refresh: 是否忽略缓存重新请求
+        :return: 频道列表数据，失败时返回 {"error": ...}
+        """
+        if not force_refresh and self._is_fresh():
+            return self.data
+        async with self._lock:
+            # 等待锁期间可能已被其他请求刷新
+            if not force_refresh and self._is_fresh():
+                return self.data
+            try:
+                data = await voice_client.list_channels()
+            except VoiceClientError as e:
+                return {"error": str(e)}
+            self.data = data
+            self.channel_ids = {str(item['id']) for item in data.get('items', [])}
+            self._fetched_at = time.monotonic()
+            return data
+
+    def mark_joined(self, channel_id):
+        """记录机器人已在频道中"""
+        channel_id = str(channel_id)
+        if channel_id in self.channel_ids or self.data is None:
+            return
+        self.channel_ids.add(channel_id)
+        self.data.setdefault('items', []).append({'id': channel_id})
+
+    def mark_left(self, channel_id):
+        """记录机器人已离开频道"""
+        channel_id = str(channel_id)
+        if channel_id not in self.channel_ids or self.data is None:
+            return
+        self.channel_ids.discard(channel_id)
+        self.data['items'] = [item for item in self.data.get('items', []) if str(item['id']) != channel_id]
+
+
+voice_state = VoiceStateCache()
+
+
+async def get_alive_channel_list(force_refresh=False):
+    """
+    获取机器人所在的语音频道列表（带缓存）
+
+    :param force_refresh: 是否忽略缓存重新请求
+    """
+    return await voice_state.get(force_refresh)
 
 
-cooldown_tracker = {}
 cooldown_seconds = 0  # 冷却时间（秒）
+# 冷却结束后的记录没有意义，随冷却时间自动过期
+cooldown_tracker = ExpiringDict(ttl=max(cooldown_seconds, 1), maxsize=4096)
 
 
 # 全局CD检查
@@ -79,8 +153,9 @@ def check_cooldown(channel_id):
     如果在冷却中，返回剩余时间；否则记录当前时间并返回 None。
     """
     current_time = time.time()
-    if channel_id in cooldown_tracker:
-        elapsed_time = current_time - cooldown_tracker[channel_id]
+    last_time = cooldown_tracker.get(channel_id)
+    if last_time is not None:
+        elapsed_time = current_time - last_time
         if elapsed_time < cooldown_seconds:
             wait_cd = cooldown_seconds - elapsed_time
             return wait_cd  # 返回剩余冷却时间
@@ -99,6 +174,10 @@ def is_bot_in_channel(alive_data, channel_id):
     # 转换channel_id为字符串，确保类型一致性
     channel_id_str = str(channel_id)
 
+    # 缓存的频道列表直接查集合
+    if alive_data is voice_state.data:
+        return channel_id_str in voice_state.channel_ids, None
+
     for item in alive_data.get('items', []):
         if str(item['id']) == channel_id_str:
             return True, None
@@ -116,6 +195,7 @@ async def join_channel(channel_id):
     client = await get_client(channel_id, token)
     try:
         join_data = await client.join_channel(rtcp_mux=False)  # 将rtcp_mux设置为False 防止推流失败
+        voice_state.mark_joined(channel_id)
         return join_data
     except VoiceClientError as e:
         return {"error": str(e)}
@@ -138,10 +218,10 @@ async def leave_channel(channel_id):
     if not is_in_channel:
         return {"error": "机器人未在该频道"}
 
-    # 使用临时客户端来离开频道，不依赖于 client_manager 的客户端实例
-    temp_client = KookVoiceClient(token)
+    # 使用不绑定频道的客户端来离开频道，不依赖于 client_manager 的客户端实例
     try:
-        leave_data = await temp_client.leave_channel(channel_id)
+        leave_data = await voice_client.leave_channel(channel_id)
+        voice_state.mark_left(channel_id)
 
         # 关闭持久客户端连接（如果存在）
         if channel_id in clients:
@@ -156,66 +236,64 @@ async def leave_channel(channel_id):
         return {"success": leave_data}
     except VoiceClientError as e:
         return {"error": str(e)}
-    finally:
-        await temp_client.close()
 
 
-async def keep_channel_alive(channel_id):
-    """
-    保持指定频道的活跃状态。
-    """
-    client = await get_client(channel_id, token)
-    try:
-        # 初始化连续失败计数器
-        consecutive_failures = 0
-        max_failures = 3  # 允许连续失败的最大次数
+# 心跳指标
+heartbeat_rtt = metrics.histogram('voice_heartbeat_rtt_seconds', "语音频道心跳请求的往返耗时（秒）")
+heartbeat_failures = metrics.counter('voice_heartbeat_failures_total', "语音频道心跳失败次数")
 
-        while True:
-            try:
-                # 记录发送心跳前的时间
-                before_time = time.time()
 
-                # 发送心跳
-                result = await client.keep_alive(channel_id)
+async def _send_heartbeat(channel_id):
+    """发送一次心跳，失败时抛出 VoiceClientError"""
+    # 心跳发出前频道可能已经停止心跳并释放了客户端，此时不能再通过 get_client 重新创建
+    if not heartbeat_scheduler.is_registered(channel_id):
+        return
+    client = await get_client(channel_id, token)
+    started = time.monotonic()
+    try:
+        await client.keep_alive(channel_id)
+    except VoiceClientError as e:
+        heartbeat_failures.inc()
+        # 频道不存在或已离开时同步更新频道缓存
+        if e.code == 404:
+            voice_state.mark_left(channel_id)
+        raise
+    except Exception:
+        heartbeat_failures.inc()
+        raise
+    heartbeat_rtt.observe(time.monotonic() - started)
+    voice_state.mark_joined(channel_id)
 
-                # 计算心跳响应时间
-                response_time = time.time() - before_time
 
-                # 重置失败计数
-                consecutive_failures = 0
+async def _recreate_client(channel_id):
+    """连续心跳失败后重新创建客户端"""
+    await remove_client(channel_id)
+    if heartbeat_scheduler.is_registered(channel_id):
+        await get_client(channel_id, token)
 
-                # 记录心跳成功的详细信息
-                print(f"保持频道 {channel_id} 活跃成功，响应时间: {response_time:.2f}秒，响应数据: {result}")
 
-            except VoiceClientError as e:
-                # 增加失败计数
-                consecutive_failures += 1
+async def _release_client(channel_id):
+    await remove_client(channel_id)
+    print(f"已关闭频道 {channel_id} 的客户端会话")
 
-                print(f"保持频道 {channel_id} 活跃时出错 (尝试 {consecutive_failures}/{max_failures}): {e}")
 
-                # 如果连续失败次数超过阈值，重新创建客户端
-                if consecutive_failures >= max_failures:
-                    print(f"频道 {channel_id} 连续 {consecutive_failures} 次心跳失败，尝试重新创建客户端")
-                    await remove_client(channel_id)
-                    client = await get_client(channel_id, token)
-                    consecutive_failures = 0
+# 全部频道共享一个心跳调度器
+heartbeat_scheduler = HeartbeatScheduler(
+    _send_heartbeat,
+    interval=HEARTBEAT_INTERVAL,
+    on_failures=_recreate_client,
+    on_cancel=_release_client
+)
 
-            except Exception as e:
-                # 记录非预期的异常
-                print(f"保持频道 {channel_id} 活跃时发生意外错误: {e}")
-                consecutive_failures += 1
 
-            # 等待时间可以根据KOOK的要求调整
-            # KOOK的文档建议30-50秒发送一次心跳
-            await asyncio.sleep(30)  # 减少到30秒，确保不会因为网络延迟等问题导致超时
+def keep_channel_alive(channel_id):
+    """
+    保持指定频道的活跃状态。
 
-    except asyncio.CancelledError:
-        print(f"保持频道 {channel_id} 活动任务被取消")
-    except Exception as e:
-        print(f"保持频道 {channel_id} 活动任务发生异常: {e}")
-    finally:
-        await remove_client(channel_id)
-        print(f"已关闭频道 {channel_id} 的客户端会话")
+    :param channel_id: 频道ID
+    :return: 心跳句柄，调用 cancel() 停止心跳
+    """
+    return heartbeat_scheduler.register(channel_id)
 
 
 # endregion
@@ -225,10 +303,19 @@ async def search_files(folder_path="AudioLib", search_keyword=""):
     """
     搜索指定文件夹中符合关键字和文件后缀的文件。
 
+    AudioLib 使用本地曲库索引，按歌名/艺术家/专辑/文件名进行前缀、子串和模糊匹配；
+    其他文件夹仍遍历文件名进行部分匹配。
+
     :param folder_path: 要搜索的文件夹路径
-    :param search_keyword: 文件名中包含的关键字（部分匹配）
+    :param search_keyword: 关键字（部分匹配）
     :return: 符合条件的文件路径列表
     """
+    if os.path.abspath(folder_path) == os.path.abspath(AUDIO_LIB_PATH):
+        # 首次搜索时在线程池中建立索引，避免阻塞事件循环
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, library_index.ensure_built)
+        return [doc['path'] for doc in library_index.search(search_keyword, limit=None)]
+
     result_files = []  # 用于存储符合条件的文件路径
     file_extensions = [".flac", ".mp3", ".wav"]
     # 遍历文件夹及其子文件夹中的所有文件
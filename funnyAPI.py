@@ -2,6 +2,8 @@ import csv
 import json
 import os
 import random
+import tempfile
+import time
 import traceback
 from datetime import datetime, timedelta
 
@@ -10,6 +12,8 @@ import aiohttp
 from khl import Bot, Message
 from khl.card import Card, CardMessage, Element, Module, Types
 
+from cache_utils import SingleFlight
+
 
 def open_file(path: str):
     # 检查文件是否存在
@@ -42,36 +46,133 @@ if config is None:
 bot = Bot(token=config['token'])
 
 
+# region 天气查询缓存
+# 城市 -> adcode 的持久化缓存，行政区划编码基本不会变化
+GEOCODE_CACHE_PATH = './config/geocode_cache.json'
+# 高德天气预报的发布间隔（秒），缓存到下一次发布为止
+FORECAST_REPORT_INTERVAL = 3 * 3600
+# 预报已超过发布间隔仍未更新时，最短的缓存时间（秒）
+FORECAST_MIN_TTL = 10 * 60
+# 共享连接池的最大连接数
+WEATHER_POOL_LIMIT = 8
+
+_weather_session = None
+_geocode_cache = None  # 城市 -> adcode，首次使用时从文件加载
+_forecast_cache = {}  # adcode -> (过期时间, 天气数据)
+_weather_flight = SingleFlight()
+
+
+def get_weather_session():
+    """获取天气查询共享的 ClientSession，不存在或已关闭时创建"""
+    global _weather_session
+    if _weather_session is None or _weather_session.closed:
+        connector = aiohttp.TCPConnector(limit=WEATHER_POOL_LIMIT, ttl_dns_cache=300)
+        _weather_session = aiohttp.ClientSession(connector=connector)
+    return _weather_session
+
+
+async def close_weather_session():
+    """关闭天气查询的共享 ClientSession，在程序退出时调用"""
+    global _weather_session
+    session, _weather_session = _weather_session, None
+    if session is not None and not session.closed:
+        await session.close()
+
+
+def _load_geocode_cache() -> dict:
+    global _geocode_cache
+    if _geocode_cache is None:
+        _geocode_cache = {}
+        if os.path.exists(GEOCODE_CACHE_PATH):
+            try:
+                with open(GEOCODE_CACHE_PATH, 'r', encoding='utf-8') as f:
+                    _geocode_cache = json.load(f)
+            except Exception as e:
+                print(f"读取adcode缓存失败: {e}")
+    return _geocode_cache
+
+
+def _save_geocode_cache():
+    """原子写入adcode缓存"""
+    try:
+        directory = os.path.dirname(os.path.abspath(GEOCODE_CACHE_PATH))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".geocode_cache.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(_geocode_cache, f, ensure_ascii=False)
+            os.replace(tmp_path, GEOCODE_CACHE_PATH)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+    except Exception as e:
+        print(f"保存adcode缓存失败: {e}")
+
+
+def _forecast_expires_at(weather_data) -> float:
+    """根据预报的发布时间计算缓存的过期时间（time.time()）"""
+    now = time.time()
+    try:
+        report_time = datetime.strptime(weather_data['forecasts'][0]['reporttime'], '%Y-%m-%d %H:%M:%S')
+        expires_at = report_time.timestamp() + FORECAST_REPORT_INTERVAL
+    except (KeyError, IndexError, TypeError, ValueError):
+        expires_at = now + FORECAST_MIN_TTL
+    # 预报迟迟没有更新时，缩短缓存时间以便尽快拿到新的预报
+    return min(max(expires_at, now + FORECAST_MIN_TTL), now + FORECAST_REPORT_INTERVAL)
+
+
+# endregion
+
+
 # 获取城市的adcode
 async def get_adcode(api_key, address):
+    cache = _load_geocode_cache()
+    if address in cache:
+        return cache[address]
+    return await _weather_flight.do(('geocode', address), lambda: _fetch_adcode(api_key, address))
+
+
+async def _fetch_adcode(api_key, address):
     api_url = f"https://restapi.amap.com/v3/geocode/geo?key={api_key}&address={address}"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(api_url) as response:
-            if response.status == 200:
-                geocode_data = await response.json()
-                if geocode_data["status"] == "1" and geocode_data["count"] == "1":
-                    return geocode_data["geocodes"][0]["adcode"]
-                else:
-                    print("获取adcode失败")
-                    return None
+    async with get_weather_session().get(api_url) as response:
+        if response.status == 200:
+            geocode_data = await response.json()
+            if geocode_data["status"] == "1" and geocode_data["count"] == "1":
+                adcode = geocode_data["geocodes"][0]["adcode"]
+                # 只缓存成功的结果，城市名称写错时下次仍会重新查询
+                _geocode_cache[address] = adcode
+                _save_geocode_cache()
+                return adcode
             else:
-                print("API请求失败")
+                print("获取adcode失败")
                 return None
+        else:
+            print("API请求失败")
+            return None
 
 
 # 获取天气信息
 async def fetch_weather_data(api_key, city_code):
+    cached = _forecast_cache.get(city_code)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    return await _weather_flight.do(('forecast', city_code), lambda: _fetch_forecast(api_key, city_code))
+
+
+async def _fetch_forecast(api_key, city_code):
     api_url = f"https://restapi.amap.com/v3/weather/weatherInfo?key={api_key}&extensions=all&city={city_code}"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(api_url) as response:
-            if response.status == 200:
-                weather_data = await response.json()
-                return weather_data
-            else:
-                print("API请求失败")
-                return None
+    async with get_weather_session().get(api_url) as response:
+        if response.status == 200:
+            weather_data = await response.json()
+            if weather_data.get("status") == "1" and weather_data.get("forecasts"):
+                _forecast_cache[city_code] = (_forecast_expires_at(weather_data), weather_data)
+            return weather_data
+        else:
+            print("API请求失败")
+            return None
 
 
 # 发送天气信息
@@ -163,26 +264,50 @@ async def get_hitokoto():
 
 
 # LocalHitokoto
-async def local_hitokoto():
-    # 获取当前脚本的目录
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    csv_path = os.path.join(script_dir, 'Tools', 'hitokoto.csv')
+# 一言语料只在文件修改后重新解析，检查文件修改时间的间隔（秒）
+HITOKOTO_CHECK_INTERVAL = 60
+HITOKOTO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Tools', 'hitokoto.csv')
+
+_hitokoto_corpus = ()
+_hitokoto_mtime = None
+_hitokoto_checked = 0.0
+
+
+async def load_hitokoto_corpus(csv_path: str = HITOKOTO_PATH):
+    """
+    加载一言语料，文件修改时间没有变化时直接返回已解析的内容
+
+    :param csv_path: CSV 文件路径
+    :return: 一言文本元组
+    """
+    global _hitokoto_corpus, _hitokoto_mtime, _hitokoto_checked
+
+    now = time.monotonic()
+    if _hitokoto_mtime is not None and now - _hitokoto_checked < HITOKOTO_CHECK_INTERVAL:
+        return _hitokoto_corpus
+    _hitokoto_checked = now
+
+    try:
+        mtime = os.stat(csv_path).st_mtime
+    except OSError as e:
+        print(f"读取一言文件失败: {e}")
+        return _hitokoto_corpus
+    if mtime == _hitokoto_mtime:
+        return _hitokoto_corpus
 
     # 读取CSV文件内容
     async with aiofiles.open(csv_path, mode='r', encoding='utf-8') as f:
         content = await f.read()
 
-    # 按行分割内容
-    lines = content.splitlines()
+    # 使用csv.DictReader解析CSV内容，只保留一言文本
+    reader = csv.DictReader(content.splitlines())
+    _hitokoto_corpus = tuple(row['hitokoto'] for row in reader if isinstance(row, dict) and row.get('hitokoto'))
+    _hitokoto_mtime = mtime
+    return _hitokoto_corpus
 
-    # 使用csv.DictReader解析CSV内容
-    reader = csv.DictReader(lines)
 
-    # 收集所有的hitokoto
-    hitokotos = []
-    for row in reader:
-        if isinstance(row, dict) and 'hitokoto' in row:
-            hitokotos.append(row['hitokoto'])
+async def local_hitokoto():
+    hitokotos = await load_hitokoto_corpus()
 
     # 随机选择一个hitokoto并返回
     if hitokotos:
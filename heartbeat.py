@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 心跳间隔（秒），KOOK 建议 30-50 秒发送一次心跳
+HEARTBEAT_INTERVAL = 30
+# 时间轮每格的时长（秒）
+HEARTBEAT_TICK = 1.0
+# 失败后重试的初始等待时间（秒），之后每次翻倍，最长不超过半个心跳间隔
+HEARTBEAT_RETRY_BASE = 2.0
+# 连续失败多少次后调用 on_failures（例如重新创建客户端）
+HEARTBEAT_MAX_FAILURES = 3
+# 输出心跳延迟统计的间隔（秒）
+HEARTBEAT_REPORT_INTERVAL = 600
+# 延迟直方图的桶上界（秒），最后一个桶收集超过上界的样本
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+
+
+class LatencyHistogram:
+    """心跳延迟直方图"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.failures = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        labels = [f"<={bound}s" for bound in self.buckets] + [f">{self.buckets[-1]}s"]
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'avg': self.total / self.count if self.count else 0.0,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class HeartbeatHandle:
+    """
+    单个频道的心跳句柄
+
+    保持与 asyncio.Task 相同的 cancel() 用法，可以直接放进 keep_alive_tasks。
+    """
+
+    def __init__(self, scheduler, channel_id):
+        self._scheduler = scheduler
+        self.channel_id = channel_id
+        self._cancelled = False
+
+    def cancel(self):
+        if self._cancelled:
+            return False
+        self._cancelled = True
+        self._scheduler.unregister(self.channel_id)
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._cancelled
+
+
+class HeartbeatScheduler:
+    """
+    集中式心跳调度器
+
+    用时间轮保存各频道的心跳时间：每个频道注册时放入负载最小的格子，使心跳均匀分布在整个间隔内，
+    全部频道只需要一个调度任务。失败的心跳按指数退避放入之后的格子重试，连续失败达到阈值时调用
+    on_failures。每个频道记录心跳延迟直方图，并定期输出统计。
+    """
+
+    def __init__(self, beat, interval: float = HEARTBEAT_INTERVAL, tick: float = HEARTBEAT_TICK,
+                 max_failures: int = HEARTBEAT_MAX_FAILURES, on_failures=None, on_cancel=None):
+        """
+        :param beat: 协程函数 beat(channel_id)，发送一次心跳，失败时抛出异常
+        :param interval: 心跳间隔（秒）
+        :param tick: 时间轮每格的时长（秒）
+        :param max_failures: 连续失败多少次后调用 on_failures
+        :param on_failures: 协程函数 on_failures(channel_id)，连续失败达到阈值时调用
+        :param on_cancel: 协程函数 on_cancel(channel_id)，频道取消心跳后调用（例如释放客户端）
+        """
+        self.beat = beat
+        self.interval = interval
+        self.tick = tick
+        self.max_failures = max_failures
+        self.on_failures = on_failures
+        self.on_cancel = on_cancel
+
+        self._size = max(1, int(round(interval / tick)))
+        self._wheel = [set() for _ in range(self._size)]  # 常规心跳所在的格子
+        self._retries = [set() for _ in range(self._size)]  # 等待重试的频道
+        self._slots = {}  # channel_id -> 常规心跳所在格子
+        self._failures = {}  # channel_id -> 连续失败次数
+        self._retrying = set()
+        self._inflight = set()
+        self._histograms = {}
+        self._cursor = 0
+        self._task = None
+        self._last_report = time.monotonic()
+
+    def register(self, channel_id) -> HeartbeatHandle:
+        """
+        开始为频道发送心跳
+
+        :param channel_id: 频道ID
+        :return: 心跳句柄，调用 cancel() 停止心跳
+        """
+        if channel_id not in self._slots:
+            slot = self._least_loaded_slot()
+            self._wheel[slot].add(channel_id)
+            self._slots[channel_id] = slot
+            self._failures[channel_id] = 0
+            self._histograms.setdefault(channel_id, LatencyHistogram())
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return HeartbeatHandle(self, channel_id)
+
+    def unregister(self, channel_id):
+        """停止为频道发送心跳"""
+        slot = self._slots.pop(channel_id, None)
+        if slot is None:
+            return
+        self._wheel[slot].discard(channel_id)
+        for retries in self._retries:
+            retries.discard(channel_id)
+        self._retrying.discard(channel_id)
+        self._failures.pop(channel_id, None)
+        self._histograms.pop(channel_id, None)
+        logger.info(f"保持频道 {channel_id} 活动任务被取消")
+        if self.on_cancel:
+            asyncio.ensure_future(self._cancelled(channel_id))
+
+    def is_registered(self, channel_id) -> bool:
+        """频道是否仍在发送心跳"""
+        return channel_id in self._slots
+
+    def _least_loaded_slot(self) -> int:
+        """从当前位置的下一格开始，选择频道最少的格子"""
+        start = (self._cursor + 1) % self._size
+        return min(((start + i) % self._size for i in range(self._size)), key=lambda s: len(self._wheel[s]))
+
+    def stats(self, channel_id=None) -> dict:
+        """
+        获取心跳延迟统计
+
+        :param channel_id: 频道ID，为 None 时返回全部频道
+        :return: 频道ID -> 直方图快照
+        """
+        if channel_id is not None:
+            histogram = self._histograms.get(channel_id)
+            return {channel_id: histogram.snapshot()} if histogram else {}
+        return {cid: histogram.snapshot() for cid, histogram in self._histograms.items()}
+
+    async def _run(self):
+        """调度任务：每格检查一次到期的频道"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        try:
+            while self._slots:
+                self._cursor = (self._cursor + 1) % self._size
+                due = [cid for cid in self._wheel[self._cursor] if cid not in self._retrying]
+                retries = list(self._retries[self._cursor])
+                self._retries[self._cursor].clear()
+                for channel_id in due + retries:
+                    if channel_id in self._slots and channel_id not in self._inflight:
+                        self._inflight.add(channel_id)
+                        asyncio.ensure_future(self._beat(channel_id))
+
+                if time.monotonic() - self._last_report >= HEARTBEAT_REPORT_INTERVAL:
+                    self._report()
+
+                # 以绝对时间推进，避免心跳处理耗时造成漂移
+                next_tick += self.tick
+                await asyncio.sleep(max(0.0, next_tick - loop.time()))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"心跳调度任务发生异常: {e}")
+
+    async def _beat(self, channel_id):
+        started = time.monotonic()
+        try:
+            await self.beat(channel_id)
+        except Exception as e:
+            await self._on_failure(channel_id, e)
+        else:
+            if channel_id in self._slots:
+                self._histograms[channel_id].observe(time.monotonic() - started)
+                self._failures[channel_id] = 0
+                self._retrying.discard(channel_id)
+        finally:
+            self._inflight.discard(channel_id)
+
+    async def _on_failure(self, channel_id, error):
+        if channel_id not in self._slots:
+            return
+        self._histograms[channel_id].failures += 1
+        failures = self._failures[channel_id] + 1
+        self._failures[channel_id] = failures
+        logger.warning(f"保持频道 {channel_id} 活跃时出错 (尝试 {failures}/{self.max_failures}): {error}")
+
+        if failures >= self.max_failures:
+            logger.warning(f"频道 {channel_id} 连续 {failures} 次心跳失败，尝试重新创建客户端")
+            self._failures[channel_id] = 0
+            if self.on_failures:
+                await self._call(self.on_failures, channel_id)
+
+        # 指数退避后重试，期间跳过该频道的常规心跳
+        delay = min(HEARTBEAT_RETRY_BASE * (2 ** (failures - 1)), self.interval / 2)
+        slot = (self._cursor + max(1, int(round(delay / self.tick)))) % self._size
+        self._retries[slot].add(channel_id)
+        self._retrying.add(channel_id)
+
+    async def _cancelled(self, channel_id):
+        # unregister 是同步方法，on_cancel 稍后才执行；频道在此之前重新注册（离开后立即重新加入）时
+        # 不能再释放资源，否则会移除新注册使用的客户端
+        if channel_id in self._slots:
+            return
+        await self._call(self.on_cancel, channel_id)
+
+    @staticmethod
+    async def _call(callback, channel_id):
+        try:
+            await callback(channel_id)
+        except Exception as e:
+            logger.error(f"心跳回调处理频道 {channel_id} 时出错: {e}")
+
+    def _report(self):
+        self._last_report = time.monotonic()
+        for channel_id, snapshot in self.stats().items():
+            logger.info(f"频道 {channel_id} 心跳统计: 成功 {snapshot['count']} 次，失败 {snapshot['failures']} 次，"
+                        f"平均延迟 {snapshot['avg']:.3f}秒，分布 {snapshot['buckets']}")
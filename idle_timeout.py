@@ -0,0 +1,88 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+
+class IdleTimeoutScheduler:
+    """
+    全部频道共享的空闲超时调度器
+
+    以最小堆保存各频道的到期时间，只有一个任务等待最早的到期时间，没有到期项时不做任何周期性工作。
+    同一个频道重复调度时以最后一次为准，取消只做标记，弹出时丢弃。
+    """
+
+    def __init__(self):
+        self._heap = []  # (到期时间, 序号, 频道ID)
+        self._entries = {}  # 频道ID -> (序号, 回调)
+        self._counter = itertools.count()
+        self._task = None
+        self._wakeup = None
+
+    def schedule(self, channel_id, delay: float, callback):
+        """
+        在 delay 秒后调用 callback(channel_id)
+
+        :param channel_id: 频道ID
+        :param delay: 延迟（秒）
+        :param callback: 普通函数或协程函数，协程会作为新任务运行
+        """
+        loop = asyncio.get_running_loop()
+        seq = next(self._counter)
+        self._entries[channel_id] = (seq, callback)
+        heapq.heappush(self._heap, (loop.time() + delay, seq, channel_id))
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        else:
+            # 新的到期时间可能比当前等待的更早
+            self._wakeup.set()
+
+    def cancel(self, channel_id) -> bool:
+        """
+        取消频道的超时
+
+        :return: 是否存在待执行的超时
+        """
+        return self._entries.pop(channel_id, None) is not None
+
+    def pending(self, channel_id) -> bool:
+        return channel_id in self._entries
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._entries:
+                # 丢弃已取消或被重新调度的旧项
+                while self._heap and self._entries.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    break
+                deadline, seq, channel_id = self._heap[0]
+                delay = deadline - loop.time()
+                if delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                heapq.heappop(self._heap)
+                _, callback = self._entries.pop(channel_id)
+                try:
+                    result = callback(channel_id)
+                    if asyncio.iscoroutine(result):
+                        asyncio.create_task(result)
+                except Exception as e:
+                    logger.error(f"处理频道 {channel_id} 的空闲超时出错: {e}")
+            self._heap.clear()
+        except asyncio.CancelledError:
+            pass
+
+
+# 全局空闲超时调度器
+idle_timeout_scheduler = IdleTimeoutScheduler()
@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import json
 import logging
 import os
@@ -6,28 +7,40 @@ import random
 import time
 from datetime import datetime, timedelta
 
-# 监测文件夹大小的阈值（字节）
-AUDIO_LIB_SIZE_ALERT_THRESHOLD = 200 * 1024 * 1024  # 第一个数字为MB
+# AudioLib 缓存容量上限（字节），超出后自动淘汰，可在 config.json 中通过 audio_lib_budget_mb 覆盖
+AUDIO_LIB_SIZE_BUDGET = 1024 * 1024 * 1024  # 第一个数字为MB
 
 from khl import Bot, Message, EventTypes, Event, api
 from khl.card import Card, CardMessage, Element, Module, Types
 
 import NeteaseAPI
 import core
-from client_manager import keep_alive_tasks, stream_tasks, stream_monitor_tasks, playlist_tasks
-from core import search_files
-from funnyAPI import weather, local_hitokoto  # , get_hitokoto
+from audio_cache import audio_lib_cache
+from cache_utils import ExpiringDict
+from client_manager import keep_alive_tasks, stream_tasks, playlist_tasks, get_pinned_audio_paths, \
+    channel_sessions, SessionFieldView, SESSION_IDLE, SESSION_STREAMING
+from idle_timeout import idle_timeout_scheduler
+from library_index import library_index
+from metadata_store import song_metadata_store
+from song_card import song_card_cache, render_song_card, current_position
+from outbound import OutboundQueue
+from progress_card import ProgressCardRefresher
+from metrics import metrics, timed_command, start_metrics_server, METRICS_HOST, METRICS_PORT
+from funnyAPI import weather, local_hitokoto, close_weather_session  # , get_hitokoto
+from VoiceAPI import close_shared_sessions
+from StreamTools.ffmpeg_stream_tool import STREAMER_EMPTY, STREAMER_EXIT, STREAMER_IDLE, STREAMER_PLAYING, \
+    TRACK_STARTED, TRACKS_UPCOMING, NOTICE_NOW_PLAYING, NOTICE_UP_NEXT, StreamerNotice
 
 # 创建logger
 logger = logging.getLogger(__name__)
 
 # 按钮点击的锁，防止连续点击
-BUTTON_LOCKS = {}  # 格式: {'频道ID_操作类型': 时间戳}
 BUTTON_COOLDOWN = 5  # 按钮冷却时间（秒）
+BUTTON_LOCKS = ExpiringDict(ttl=BUTTON_COOLDOWN, maxsize=4096)  # 格式: {'频道ID_操作类型': 时间戳}，冷却结束后自动过期
 
 # 在文件顶部合适位置添加一个新的字典来跟踪每个频道的卡片消息ID
 # 在playlist_tasks变量附近添加
-card_messages = {}  # 用于跟踪每个频道的卡片消息ID {channel_id: msg_id}
+card_messages = SessionFieldView(channel_sessions, 'card_message_id')  # 用于跟踪每个频道的卡片消息ID {channel_id: msg_id}
 
 
 # 按钮点击事件处理
@@ -37,334 +50,303 @@ card_messages = {}  # 用于跟踪每个频道的卡片消息ID {channel_id: msg
 async def message_callback(msg, message):
     """
     消息回调函数，用于推流器发送状态消息
-    
+
     :param msg: 消息对象
-    :param message: 消息内容
+    :param message: StreamerNotice 结构化通知（也兼容纯文本）
     """
     try:
-        # 检查是否是过程性消息，如果是则只记录到日志中
-        process_messages = [
-            "正在获取歌单",
-            "将导入全部歌曲",
-            "正在从歌单",
-            "共有",
-            "首歌曲，将导入",
-            "正在尝试加入",
-            "机器人尚未加入频道",
-            "这可能需要较长时间",
-            "即将播放"
-        ]
-
-        # 检查消息是否包含任何过程性提示
-        is_process_message = any(phrase in message for phrase in process_messages)
-
-        if is_process_message:
-            # 只记录到日志，不发送给用户
-            logger.info(f"过程消息(未发送): {message}")
-            return
-
-        # 检查是否是播放消息
-        if "正在播放:" in message or "正在播放：" in message:
-            logger.info(f"收到播放消息: {message}")
-
-            # 从消息对象中获取频道ID
-            # 检查该消息是否与特定频道相关
-            channel_id = None
-
-            # 遍历所有播放器任务，找到与当前消息对象关联的频道
-            for ch_id, enhanced_streamer in playlist_tasks.items():
-                if hasattr(enhanced_streamer, 'message_obj') and enhanced_streamer.message_obj == msg:
-                    channel_id = ch_id
-                    logger.info(f"找到消息对象关联的频道: {channel_id}")
-                    break
-
-            if channel_id:
-                # 调用播放卡片函数而不是发送简单文本
-                logger.info(f"将为频道 {channel_id} 生成播放卡片")
-                await playing_songcard(msg, channel_id, auto_mode=True)
-
-                # 启动任务来监控这首歌的播放状态
-                asyncio.create_task(monitor_song_completion(msg, channel_id))
-
-                logger.info(f"已替换为播放卡片显示: {message}")
+        if isinstance(message, StreamerNotice):
+            # 即将播放属于过程性消息，只记录到日志中
+            if message.type == NOTICE_UP_NEXT:
+                logger.info(f"过程消息(未发送): {message.text}")
                 return
-            else:
-                logger.warning(f"无法确定播放消息关联的频道，将使用普通文本消息")
+
+            # 播放卡片由推流器的开始播放事件生成（见 NowPlayingCards），按频道ID直接找到会话
+            if message.type == NOTICE_NOW_PLAYING:
+                logger.info(f"收到播放消息: {message.text}")
+                session = channel_sessions.get(message.channel_id)
+                if session is not None and session.get_field('now_playing') is not None:
+                    logger.info(f"频道 {message.channel_id} 的播放卡片由播放事件生成: {message.text}")
+                    return
+                logger.warning(f"频道 {message.channel_id} 没有播放卡片监听，将使用普通文本消息")
+                # 连续切歌时只发送最新的正在播放消息
+                await outbound.send(msg.ctx.channel, message.text, key=f"notice_{message.channel_id}_{message.type}")
+                return
+
+            message = message.text
 
         # 直接回复原始消息
-        await msg.ctx.channel.send(message)
+        await outbound.send(msg.ctx.channel, message)
     except Exception as e:
         logger.error(f"处理消息回调时出错: {e}")
 
 
 # 自动检查播放器状态的任务字典
-auto_exit_tasks = {}
+auto_exit_tasks = SessionFieldView(channel_sessions, 'auto_exit')
 
 
-# 监控推流器状态，检查是否因为播放列表为空而退出
-async def monitor_streamer_status(msg, channel_id):
+# 统一的退出频道流程
+async def teardown_channel(channel_id, leave=True):
     """
-    监控推流器状态，如果因为播放列表为空而退出，则自动退出频道
-    
-    :param msg: 消息对象，用于回复用户
-    :param channel_id: 频道ID
+    删除播放卡片、停止推流、取消频道的全部任务并离开频道
+
+    :param channel_id: 语音频道ID
+    :param leave: 是否调用离开频道接口
+    :return: 离开频道的结果，频道已在退出中时返回None
     """
-    try:
-        # 等待5秒钟，确保推流器状态已更新
-        await asyncio.sleep(5)
-        logger.info(f"开始监控频道 {channel_id} 的推流器状态")
+    session = channel_sessions.get(channel_id)
+    card_id = card_messages.pop(channel_id, None)
+    if card_id:
+        outbound.delete(card_id, session.origin_id if session is not None else None)
+        logger.info(f"退出频道时删除了频道 {channel_id} 的播放卡片")
+
+    leave_result = await channel_sessions.close(channel_id, leave=core.leave_channel if leave else None)
+    if leave_result is not None:
+        if 'error' in leave_result:
+            logger.error(f"退出频道失败: {leave_result['error']}")
+        else:
+            logger.info(f"已成功退出频道: {channel_id}")
 
-        # 初始化空播放列表标志
-        empty_playlist = False
+    progress_cards.stop(channel_id)
 
-        # 持续检查推流器状态
-        while channel_id in playlist_tasks:
-            enhanced_streamer = playlist_tasks[channel_id]
+    # 清理该频道的按钮锁
+    for k in list(BUTTON_LOCKS.keys()):
+        if k.startswith(channel_id):
+            BUTTON_LOCKS.pop(k, None)
+    return leave_result
 
-            # 检查推流器是否还存在
-            if not hasattr(enhanced_streamer, 'streamer') or enhanced_streamer.streamer is None:
-                logger.info(f"检测到频道 {channel_id} 的推流器已停止，准备退出频道")
-                # 不能直接调用exit_command，需要手动执行退出逻辑
-                try:
-                    # 停止播放列表和推流任务
-                    if channel_id in playlist_tasks:
-                        enhanced_streamer = playlist_tasks.pop(channel_id, None)
-                        if enhanced_streamer:
-                            await enhanced_streamer.stop()
 
-                    # 使用退出函数
-                    leave_result = await core.leave_channel(channel_id)
-                    if 'error' in leave_result:
-                        # await msg.reply(f"退出频道失败: {leave_result['error']}")
-                        logger.error(f"退出频道失败: {leave_result['error']}")
-                    else:
-                        # await msg.reply(f"已成功退出频道: {channel_id}")
-                        logger.info(f"已成功退出频道: {channel_id}")
-                except Exception as e:
-                    logger.error(f"退出频道时发生错误: {e}")
-                    # await msg.reply(f"退出频道时发生错误: {e}")
-                finally:
-                    # 取消保持活跃任务
-                    task = keep_alive_tasks.pop(channel_id, None)
-                    if task:
-                        task.cancel()
-
-                    # 清理所有相关任务和引用
-                    stream_tasks.pop(channel_id, None)
-                    stream_monitor_tasks.pop(channel_id, None)
-
-                    # 取消自动监控任务
-                    task = auto_exit_tasks.pop(channel_id, None)
-                    if task:
-                        task.cancel()
-                break
-
-            # 检查推流器是否因为播放列表为空而退出
-            if hasattr(enhanced_streamer.streamer,
-                       'exit_due_to_empty_playlist') and enhanced_streamer.streamer.exit_due_to_empty_playlist:
-                # 推流器已设置自动退出标志
-                logger.info(f"检测到频道 {channel_id} 的推流器设置了空列表退出标志，准备退出频道")
-
-                # 确保用户收到通知
-                try:
-                    await msg.ctx.channel.send(f"播放列表为空，10秒后将自动退出频道。如需继续播放，请添加歌曲。")
-                except Exception as e:
-                    logger.error(f"通知用户退出频道失败: {e}")
-
-                # 等待10秒给用户添加歌曲的机会，但分成多次短等待，每次检查播放列表
-                empty_playlist = True
-                for i in range(5):  # 分5次等待，每次2秒
-                    logger.info(f"等待用户添加歌曲：第{i + 1}次检查，剩余{10 - i * 2}秒")
-                    await asyncio.sleep(2)
-
-                    # 重新检查播放列表状态
-                    # 确保playlist_tasks中仍然有这个频道
-                    if channel_id not in playlist_tasks:
-                        # 频道可能已经被其他地方清理了
-                        logger.info(f"频道 {channel_id} 已不在播放列表任务中，终止监控")
-                        empty_playlist = False  # 避免后续操作
-                        break
-
-                    enhanced_streamer = playlist_tasks[channel_id]
-                    # 确认退出标志仍然为True
-                    if hasattr(enhanced_streamer.streamer,
-                               'exit_due_to_empty_playlist') and not enhanced_streamer.streamer.exit_due_to_empty_playlist:
-                        logger.info(f"频道 {channel_id} 的退出标志已被取消，终止监控")
-                        empty_playlist = False
-                        break
-
-                    # 检查是否有真实的新歌曲加入
-                    has_real_songs = False
-
-                    # 检查播放列表和下载队列是否确实有内容
-                    if hasattr(enhanced_streamer.streamer, 'playlist_manager'):
-                        has_current_song = enhanced_streamer.streamer.playlist_manager.current_song is not None
-                        has_playlist_songs = len(enhanced_streamer.streamer.playlist_manager.playlist) > 0
-                        has_download_queue = len(enhanced_streamer.streamer.playlist_manager.download_queue) > 0
-                        has_temp_playlist = len(enhanced_streamer.streamer.playlist_manager.temp_playlist) > 0
-
-                        has_real_songs = has_current_song or has_playlist_songs or has_download_queue or has_temp_playlist
-
-                    # 仅当确实有歌曲时才取消退出
-                    if has_real_songs:
-                        # 重置退出标志
-                        if hasattr(enhanced_streamer.streamer, 'exit_due_to_empty_playlist'):
-                            enhanced_streamer.streamer.exit_due_to_empty_playlist = False
-                            logger.info(f"用户已添加新歌，已取消退出频道 {channel_id}")
-                            empty_playlist = False
-                            break
-                    else:
-                        logger.info(f"播放列表表面上有歌曲，但实际检查发现没有真正的歌曲，继续退出流程")
-
-                # 如果始终没有找到真实歌曲，强制执行退出，无需进一步检查
-                if empty_playlist:
-                    logger.info(f"等待结束，频道 {channel_id} 确认没有真实歌曲，强制执行退出操作")
-                    try:
-                        # 停止播放列表和推流任务
-                        if channel_id in playlist_tasks:
-                            enhanced_streamer = playlist_tasks.pop(channel_id, None)
-                            if enhanced_streamer:
-                                # 防止再次检查播放列表状态
-                                if hasattr(enhanced_streamer.streamer, '_running'):
-                                    enhanced_streamer.streamer._running = False
-                                await enhanced_streamer.stop()
-
-                        # 使用退出函数，强制执行离开
-                        leave_result = await core.leave_channel(channel_id)
-                        if 'error' in leave_result:
-                            logger.error(f"退出频道失败: {leave_result['error']}")
-                        else:
-                            logger.info(f"已成功退出频道: {channel_id}")
-                    except Exception as e:
-                        logger.error(f"退出频道时发生错误: {e}")
-                    finally:
-                        # 清理所有相关任务和引用
-                        task = keep_alive_tasks.pop(channel_id, None)
-                        if task:
-                            task.cancel()
-                        stream_tasks.pop(channel_id, None)
-                        stream_monitor_tasks.pop(channel_id, None)
-                        task = auto_exit_tasks.pop(channel_id, None)
-                        if task:
-                            task.cancel()
-                    # 直接退出循环，避免继续处理
-                    break
+# 播放列表为空后等待用户添加歌曲的时间（秒）
+EMPTY_PLAYLIST_GRACE = 10
 
-            # 如果播放列表仍然为空，执行退出操作
-            if empty_playlist and channel_id in playlist_tasks:
-                enhanced_streamer = playlist_tasks[channel_id]
-                songs_list = await enhanced_streamer.list_songs()
 
-                # 再次进行全面检查，确保播放列表确实为空
-                has_real_songs = False
-                if hasattr(enhanced_streamer.streamer, 'playlist_manager'):
-                    has_current_song = enhanced_streamer.streamer.playlist_manager.current_song is not None
-                    has_playlist_songs = len(enhanced_streamer.streamer.playlist_manager.playlist) > 0
-                    has_download_queue = len(enhanced_streamer.streamer.playlist_manager.download_queue) > 0
-                    has_temp_playlist = len(enhanced_streamer.streamer.playlist_manager.temp_playlist) > 0
-
-                    has_real_songs = has_current_song or has_playlist_songs or has_download_queue or has_temp_playlist
-
-                # 有真实歌曲时，取消退出
-                if has_real_songs:
-                    logger.info(f"最终检查发现有歌曲，取消退出频道 {channel_id}")
-                    if hasattr(enhanced_streamer.streamer, 'exit_due_to_empty_playlist'):
-                        enhanced_streamer.streamer.exit_due_to_empty_playlist = False
-                    # 重置empty_playlist标志
-                    empty_playlist = False
-                    continue
-
-                # 以下为原有逻辑，只有确认没有任何歌曲后才会执行
-                # 再次确认播放列表确实为空，避免误判断
-                if not songs_list or len(songs_list) == 0:
-                    # 最后确认下载队列也是空的
-                    has_pending_downloads = False
-                    if hasattr(enhanced_streamer.streamer, 'playlist_manager'):
-                        has_pending_downloads = (
-                                len(enhanced_streamer.streamer.playlist_manager.download_queue) > 0 or
-                                len(enhanced_streamer.streamer.playlist_manager.temp_playlist) > 0
-                        )
-
-                    if not has_pending_downloads:
-                        logger.info(f"最终确认：频道 {channel_id} 没有任何歌曲，执行退出操作")
-                        # 执行退出操作 - 不能直接调用exit_command，需要手动执行退出逻辑
-                        try:
-                            # 停止播放列表和推流任务
-                            if channel_id in playlist_tasks:
-                                enhanced_streamer = playlist_tasks.pop(channel_id, None)
-                                if enhanced_streamer:
-                                    await enhanced_streamer.stop()
-
-                            # 使用退出函数
-                            leave_result = await core.leave_channel(channel_id)
-                            if 'error' in leave_result:
-                                # await msg.reply(f"退出频道失败: {leave_result['error']}")
-                                logger.error(f"退出频道失败: {leave_result['error']}")
-                            else:
-                                # await msg.reply(f"已成功退出频道: {channel_id}")
-                                logger.info(f"已成功退出频道: {channel_id}")
-                        except Exception as e:
-                            logger.error(f"退出频道时发生错误: {e}")
-                            # await msg.reply(f"退出频道时发生错误: {e}")
-                        finally:
-                            # 取消保持活跃任务
-                            task = keep_alive_tasks.pop(channel_id, None)
-                            if task:
-                                task.cancel()
+class StreamerStatusWatch:
+    """
+    监听推流器的生命周期事件，播放列表为空时自动退出频道
 
-                            # 清理所有相关任务和引用
-                            stream_tasks.pop(channel_id, None)
-                            stream_monitor_tasks.pop(channel_id, None)
+    推流器确认没有任何歌曲（STREAMER_EMPTY）后通知用户，并在共享的空闲超时调度器中登记退出时间，
+    等待期间重新开始播放则取消退出。到期时再确认一次播放列表，仍然没有歌曲才退出频道。
+    空闲的频道不需要任何轮询。
+    """
 
-                            # 取消自动监控任务
-                            task = auto_exit_tasks.pop(channel_id, None)
-                            if task:
-                                task.cancel()
-                break
+    def __init__(self, msg, channel_id, streamer):
+        """
+        :param msg: 消息对象，用于通知用户
+        :param channel_id: 频道ID
+        :param streamer: FFmpegPipeStreamer 实例
+        """
+        self.msg = msg
+        self.channel_id = channel_id
+        self.streamer = streamer
+        self._done = False
+        streamer.add_event_listener(self._on_event)
+
+    def _on_event(self, event, data):
+        session = channel_sessions.get(self.channel_id)
+        if event == STREAMER_EMPTY:
+            logger.info(f"检测到频道 {self.channel_id} 的推流器设置了空列表退出标志，{EMPTY_PLAYLIST_GRACE}秒后退出频道")
+            if session is not None:
+                session.state = SESSION_IDLE
+                session.add_task('empty_notice', asyncio.create_task(self._notify_empty()))
+            idle_timeout_scheduler.schedule(self.channel_id, EMPTY_PLAYLIST_GRACE, self._on_timeout)
+        elif event == STREAMER_PLAYING:
+            if session is not None and session.state == SESSION_IDLE:
+                session.state = SESSION_STREAMING
+            if idle_timeout_scheduler.cancel(self.channel_id):
+                logger.info(f"用户已添加新歌，已取消退出频道 {self.channel_id}")
+        elif event == STREAMER_EXIT:
+            self.cancel()
+
+    async def _notify_empty(self):
+        # 确保用户收到通知
+        try:
+            await outbound.send(self.msg.ctx.channel,
+                                f"播放列表为空，{EMPTY_PLAYLIST_GRACE}秒后将自动退出频道。如需继续播放，请添加歌曲。",
+                                key=f"empty_{self.channel_id}")
+        except Exception as e:
+            logger.error(f"通知用户退出频道失败: {e}")
 
-            # 等待2秒后再次检查
-            await asyncio.sleep(2)
+    async def _on_timeout(self, channel_id):
+        if self._done:
+            return
+        # 等待期间添加的歌曲可能没有重新启动音频循环
+        if self.streamer.playlist_manager.has_songs():
+            logger.info(f"最终检查发现有歌曲，取消退出频道 {channel_id}")
+            self.streamer.resume()
+            return
+        if self.streamer.is_importing:
+            logger.info(f"频道 {channel_id} 正在导入歌单，推迟退出")
+            idle_timeout_scheduler.schedule(channel_id, EMPTY_PLAYLIST_GRACE, self._on_timeout)
+            return
+
+        logger.info(f"等待结束，频道 {channel_id} 确认没有真实歌曲，执行退出操作")
+        await teardown_channel(channel_id)
+
+    def cancel(self):
+        """停止监听并取消待执行的自动退出"""
+        if self._done:
+            return False
+        self._done = True
+        self.streamer.remove_event_listener(self._on_event)
+        idle_timeout_scheduler.cancel(self.channel_id)
+        return True
+
+    def cancelled(self):
+        return self._done
+
+    def done(self):
+        return self._done
+
+
+# 预先生成卡片内容的即将播放歌曲数量
+CARD_WARMUP_DEPTH = 2
+# 播放卡片之后频道中又出现多少条消息时，认为卡片已被刷上去，改为重新发送
+CARD_SCROLL_MESSAGES = 8
 
-    except asyncio.CancelledError:
-        logger.info(f"频道 {channel_id} 的监控任务被取消")
-    except Exception as e:
-        logger.error(f"监控频道 {channel_id} 时发生错误: {e}")
 
+class NowPlayingCards:
+    """
+    根据推流器的歌曲事件维护正在播放卡片
+
+    开始播放（TRACK_STARTED）时原地更新卡片（卡片已被刷上去时重新发送），
+    播放列表变空（STREAMER_IDLE/STREAMER_EMPTY）时删除最后一张卡片，每次切换只处理一次。卡片操作按事件顺序串行执行，不再为每首歌启动轮询任务。
+    """
+
+    def __init__(self, msg, channel_id, streamer):
+        """
+        :param msg: 消息对象，卡片发送到该消息所在的频道
+        :param channel_id: 语音频道ID
+        :param streamer: FFmpegPipeStreamer 实例
+        """
+        self.msg = msg
+        self.channel_id = channel_id
+        self.streamer = streamer
+        self.card_track_id = None  # 当前卡片对应的歌曲序号
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+        self._done = False
+        streamer.add_event_listener(self._on_event)
+
+    def _on_event(self, event, data):
+        if event == TRACK_STARTED and data.get('announce'):
+            self._run(self._show(data['track_id']))
+        elif event == TRACKS_UPCOMING:
+            # 预先生成即将播放歌曲的卡片内容，并缓存下一首的音频直链
+            session = channel_sessions.get(self.channel_id)
+            if session is not None:
+                session.add_task('card_warmup', asyncio.create_task(self._warm(data['song_ids'])))
+        elif event in (STREAMER_IDLE, STREAMER_EMPTY):
+            self._run(self._clear())
+        elif event == STREAMER_EXIT:
+            self.cancel()
+
+    def _run(self, coro):
+        task = asyncio.create_task(self._locked(coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _locked(self, coro):
+        # asyncio.Lock 按等待顺序唤醒，保证卡片操作与事件顺序一致
+        async with self._lock:
+            await coro
+
+    async def _show(self, track_id):
+        if track_id != self.streamer.current_track_id:
+            # 卡片还没发出去歌曲就已经切换，直接处理下一首
+            return
+        logger.info(f"将为频道 {self.channel_id} 生成播放卡片")
+        await playing_songcard(self.msg, self.channel_id, auto_mode=True)
+        self.card_track_id = track_id
+
+    @staticmethod
+    async def _warm(song_ids):
+        await song_card_cache.warm(song_ids[:CARD_WARMUP_DEPTH])
+        if song_ids:
+            await song_card_cache.get_audio_url(song_ids[0])
+
+    async def _clear(self):
+        card_id = card_messages.pop(self.channel_id, None)
+        self.card_track_id = None
+        if not card_id:
+            return
+        logger.info(f"频道 {self.channel_id} 的歌曲已播放完毕，删除卡片")
+        outbound.delete(card_id, self.msg.ctx.channel.id)
 
-# 计算文件夹大小的函数
-def get_folder_size(folder_path):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
-            # 只计算文件的大小，跳过符号链接防止重复计算或无限循环
-            if not os.path.islink(file_path):
-                total_size += os.path.getsize(file_path)
-    return total_size
+    def cancel(self):
+        """停止监听，取消未完成的卡片操作"""
+        if self._done:
+            return False
+        self._done = True
+        self.streamer.remove_event_listener(self._on_event)
+        current = asyncio.current_task()
+        for task in list(self._tasks):
+            if task is not current:
+                task.cancel()
+        return True
 
+    def cancelled(self):
+        return self._done
 
-# 检查 AudioLib 文件夹大小
+    def done(self):
+        return self._done
+
+
+def watch_streamer_status(msg, channel_id):
+    """
+    为频道的推流器登记自动退出和播放卡片监听，已经登记时不重复登记
+
+    :param msg: 消息对象，用于通知用户
+    :param channel_id: 频道ID
+    """
+    if channel_id in auto_exit_tasks:
+        return
+    enhanced_streamer = playlist_tasks.get(channel_id)
+    streamer = getattr(enhanced_streamer, 'streamer', None)
+    if streamer is None:
+        logger.warning(f"频道 {channel_id} 的推流器尚未启动，无法监听自动退出")
+        return
+    logger.info(f"为频道 {channel_id} 创建自动退出和播放卡片监听")
+    auto_exit_tasks[channel_id] = StreamerStatusWatch(msg, channel_id, streamer)
+    channel_sessions.open(channel_id).set_field('now_playing', NowPlayingCards(msg, channel_id, streamer))
+
+
+# 检查 AudioLib 文件夹大小，并按容量上限淘汰缓存
 def check_audio_lib_size():
     audio_lib_path = "./AudioLib"
     # 如果文件夹不存在，创建它
     if not os.path.exists(audio_lib_path):
         os.makedirs(audio_lib_path)
         print(f"已创建 {audio_lib_path} 文件夹")
+
+    # 读取缓存配置
+    budget = AUDIO_LIB_SIZE_BUDGET
+    try:
+        if config.get('audio_lib_budget_mb'):
+            budget = int(float(config['audio_lib_budget_mb']) * 1024 * 1024)
+    except (TypeError, ValueError):
+        print(f"警告：audio_lib_budget_mb 参数 {config.get('audio_lib_budget_mb')} 不是有效的数值，使用默认值")
+    audio_lib_cache.configure(budget_bytes=budget, policy=config.get('audio_lib_eviction') or "lfu")
+    audio_lib_cache.set_pin_provider(get_pinned_audio_paths)
+    # 后台校对线程需要淘汰文件时交给事件循环执行
+    audio_lib_cache.bind_loop(asyncio.get_running_loop())
+
+    # 加载持久化的缓存索引，不再遍历整个文件夹；索引与实际文件的差异由后台线程校对
+    if not audio_lib_cache.load():
+        print("未找到 AudioLib 缓存索引，将在后台建立索引")
+        audio_lib_cache.start_reconcile(immediate=True)
         return
+    audio_lib_cache.start_reconcile()
 
-    # 计算文件夹大小
-    folder_size = get_folder_size(audio_lib_path)
-    # 转换为MB便于显示
-    folder_size_mb = folder_size / (1024 * 1024)
+    folder_size_mb = audio_lib_cache.total_size / (1024 * 1024)
+    budget_mb = audio_lib_cache.budget_bytes / (1024 * 1024)
 
     # 输出当前文件夹大小
-    print(f"当前 AudioLib 文件夹大小: {folder_size_mb:.2f} MB")
+    print(f"当前 AudioLib 文件夹大小: {folder_size_mb:.2f} MB，容量上限: {budget_mb:.2f} MB（{audio_lib_cache.policy}）")
 
-    # 检查是否超过阈值
-    if folder_size > AUDIO_LIB_SIZE_ALERT_THRESHOLD:
-        print(
-            f"⚠️ 警告：AudioLib 文件夹大小 ({folder_size_mb:.2f} MB) 已超过设定阈值 ({AUDIO_LIB_SIZE_ALERT_THRESHOLD / (1024 * 1024):.2f} MB)")
-        print("请及时清理 AudioLib 文件夹，以免占用过多存储空间！")
+    # 超过上限时淘汰缓存
+    removed = audio_lib_cache.enforce_budget()
+    if removed:
+        print(f"已淘汰 {len(removed)} 个缓存文件，当前大小: {audio_lib_cache.total_size / (1024 * 1024):.2f} MB")
 
 
 # region 初始化进程
@@ -428,6 +410,20 @@ bot = Bot(token=config['token'])  # 默认采用 websocket
 token = config['token']
 
 
+async def delete_message(msg_id):
+    await bot.client.gate.exec_req(api.Message.delete(msg_id))
+
+
+async def update_message(msg_id, content):
+    if isinstance(content, CardMessage):
+        content = json.dumps(content)
+    await bot.client.gate.exec_req(api.Message.update(msg_id=msg_id, content=content))
+
+
+# 播放卡片、状态通知和按钮回复统一经过发送队列，合并被取代的消息并限速
+outbound = OutboundQueue(delete_message, update_message)
+
+
 def get_time():
     return time.strftime("%y-%m-%d %H:%M:%S", time.localtime())
 
@@ -470,6 +466,75 @@ def get_progress_bar(current, total, bar_length=20):
     return f"{progress_bar} {percent}%"
 
 
+async def render_progress_card(channel_id):
+    """
+    生成自动刷新的进度卡片，播放位置来自推流器写入的采样数
+
+    :param channel_id: 语音频道ID
+    :return: (CardMessage, 播放位置, 歌曲时长)，没有正在播放的歌曲时返回None
+    """
+    enhanced_streamer = playlist_tasks.get(channel_id)
+    if enhanced_streamer is None or enhanced_streamer.streamer is None:
+        return None
+    playlist_manager = enhanced_streamer.playlist_manager
+    current_song = playlist_manager.current_song
+    if not current_song:
+        return None
+
+    template = await song_card_cache.get_template(current_song, playlist_manager)
+    duration = template['duration']
+    position = min(enhanced_streamer.streamer.get_track_position(), duration)
+    cm = CardMessage(Card(
+        Module.Header("播放进度： " + template['song_name']),
+        Module.Context(Element.Text(f"歌手： {template['artist_name']}", Types.Text.KMD)),
+        Module.Section(Element.Text(
+            f"⏱️ {format_time(position)} / {format_time(duration)}\n📊 {get_progress_bar(position, duration)}",
+            Types.Text.KMD)),
+        color="#6AC629"))
+    return cm, position, duration
+
+
+# 自动刷新的进度卡片，所有频道共享刷新预算
+progress_cards = ProgressCardRefresher(outbound, render_progress_card)
+
+# region 运行指标
+channel_sessions_gauge = metrics.gauge('channel_sessions', "各状态的语音频道会话数", ('state',))
+playlist_length_gauge = metrics.gauge('playlist_queue_length', "各频道播放列表中的歌曲数", ('channel', 'queue'))
+ffmpeg_processes_gauge = metrics.gauge('ffmpeg_processes', "正在运行的 FFmpeg 进程数", ('kind',))
+outbound_gauge = metrics.gauge('outbound_messages', "发送队列的累计处理数和当前排队数", ('kind',))
+metrics_runner = None
+
+
+def collect_runtime_metrics():
+    """采集时统计频道会话、播放列表、FFmpeg 进程和发送队列"""
+    channel_sessions_gauge.clear()
+    for session_stats in channel_sessions.stats().values():
+        channel_sessions_gauge.inc(state=session_stats['state'])
+
+    playlist_length_gauge.clear()
+    running = {'streamer': 0, 'player': 0}
+    for channel_id, enhanced_streamer in list(playlist_tasks.items()):
+        playlist_manager = enhanced_streamer.playlist_manager
+        if playlist_manager is not None:
+            playlist_length_gauge.set(len(playlist_manager.playlist), channel=channel_id, queue="playlist")
+            playlist_length_gauge.set(len(playlist_manager.temp_playlist), channel=channel_id, queue="temp")
+        streamer = enhanced_streamer.streamer
+        if streamer is None:
+            continue
+        for kind, process in (('streamer', streamer.ffmpeg_process_streamer), ('player', streamer.ffmpeg_process_player)):
+            if process is not None and process.poll() is None:
+                running[kind] += 1
+    for kind, count in running.items():
+        ffmpeg_processes_gauge.set(count, kind=kind)
+
+    for kind, value in outbound.stats().items():
+        outbound_gauge.set(value, kind=kind)
+
+
+metrics.add_collector(collect_runtime_metrics)
+# endregion
+
+
 start_time = get_time()
 
 
@@ -486,7 +551,58 @@ async def set_bot_game_status(_):
         print(f"设置机器人游戏状态时发生错误: {e}")
 
 
+# 启动本地指标接口，config.json 中 metrics_port 设置为 0 时不启动
+@bot.on_startup
+async def start_metrics(_):
+    global metrics_runner
+    try:
+        port = int(config.get('metrics_port', METRICS_PORT))
+        if port:
+            metrics_runner = await start_metrics_server(METRICS_HOST, port)
+    except Exception as e:
+        print(f"启动指标接口时发生错误: {e}")
+
+
+# 退出时关闭语音API和天气查询的共享连接池，并写完歌曲元数据
+@bot.on_shutdown
+async def close_voice_sessions(_):
+    await close_shared_sessions()
+    await close_weather_session()
+    # 等待歌曲元数据写入数据库，避免退出时丢失最近的更新
+    await asyncio.get_running_loop().run_in_executor(None, song_metadata_store.close)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+
 # endregion
+@bot.on_message()
+async def on_channel_message(msg: Message):
+    # 记录其他人发送的消息，用于判断播放卡片是否已被刷上去
+    if not getattr(msg.author, 'bot', False):
+        outbound.note_activity(msg.ctx.channel.id)
+        progress_cards.touch_text_channel(msg.ctx.channel.id)
+
+
+def counts_reply(func):
+    """
+    命令处理结束后记录频道中出现了一条机器人回复，放在 @timed_command 下方
+
+    命令的回复通过 msg.reply 直接发送，不经过发送队列，而机器人收不到自己发送的消息，
+    需要在这里计入，否则播放卡片被回复刷上去之后仍会被原地修改。
+
+    :param func: 命令处理协程函数
+    """
+
+    @functools.wraps(func)
+    async def wrapper(msg: Message, *args, **kwargs):
+        try:
+            return await func(msg, *args, **kwargs)
+        finally:
+            outbound.note_activity(msg.ctx.channel.id)
+
+    return wrapper
+
+
 @bot.on_event(EventTypes.MESSAGE_BTN_CLICK)
 async def on_btn_clicked(_: Bot, e: Event):
     try:
@@ -521,26 +637,28 @@ async def on_btn_clicked(_: Bot, e: Event):
         voice_channel_id = parts[1] if len(parts) > 1 else ""
 
         if not voice_channel_id:
-            await channel.send("操作失败：未提供有效的语音频道ID")
+            await outbound.send(channel, "操作失败：未提供有效的语音频道ID")
             return
 
         # 检查该频道是否有活跃的播放列表
         if voice_channel_id not in playlist_tasks or playlist_tasks[voice_channel_id] is None:
-            await channel.send("操作失败：找不到该频道的播放列表")
+            await outbound.send(channel, "操作失败：找不到该频道的播放列表")
             return
 
+        progress_cards.touch(voice_channel_id)
+
         # 检查按钮锁
         lock_key = f"{voice_channel_id}_{action}"
         current_time = time.time()
 
-        if lock_key in BUTTON_LOCKS:
-            last_click_time = BUTTON_LOCKS[lock_key]
+        last_click_time = BUTTON_LOCKS.get(lock_key)
+        if last_click_time is not None:
             time_diff = current_time - last_click_time
 
             if time_diff < BUTTON_COOLDOWN:
                 # 在冷却期内，拒绝请求并提示用户
                 remaining = round(BUTTON_COOLDOWN - time_diff, 1)
-                await channel.send(f"操作过于频繁，请等待 {remaining} 秒后再试")
+                await outbound.send(channel, f"操作过于频繁，请等待 {remaining} 秒后再试")
                 return
 
         # 更新锁状态
@@ -565,17 +683,17 @@ async def on_btn_clicked(_: Bot, e: Event):
                             new_title = f"{new_info.get('song_name', '')} - {new_info.get('artist_name', '')}"
 
                         # 只发送简单的确认消息，不创建卡片
-                        await channel.send(f"来自 {user_nickname} 的操作：已切换到下一首歌曲")
+                        await outbound.send(channel, f"来自 {user_nickname} 的操作：已切换到下一首歌曲")
 
                         # 删除之前手动创建播放卡片的部分，让系统自动创建一个
                         # 因为当歌曲实际开始播放时，系统会自动发送播放通知
                     else:
-                        await channel.send(f"来自 {user_nickname} 的操作：已跳过当前歌曲，播放列表已播放完毕")
+                        await outbound.send(channel, f"来自 {user_nickname} 的操作：已跳过当前歌曲，播放列表已播放完毕")
                 else:
-                    await channel.send("操作失败：找不到该频道的播放器")
+                    await outbound.send(channel, "操作失败：找不到该频道的播放器")
             except Exception as ex:
                 logger.error(f"执行跳过操作时出错: {ex}")
-                await channel.send(f"执行跳过操作时出错: {ex}")
+                await outbound.send(channel, f"执行跳过操作时出错: {ex}")
 
                 # 出错时释放锁
                 BUTTON_LOCKS.pop(lock_key, None)
@@ -588,14 +706,14 @@ async def on_btn_clicked(_: Bot, e: Event):
                     # 直接调用clear_playlist方法
                     count = await enhanced_streamer.clear_playlist()
                     if count > 0:
-                        await channel.send(f"来自 {user_nickname} 的操作：已清空播放列表，移除了 {count} 首歌曲")
+                        await outbound.send(channel, f"来自 {user_nickname} 的操作：已清空播放列表，移除了 {count} 首歌曲")
                     else:
-                        await channel.send(f"来自 {user_nickname} 的操作：播放列表已经是空的")
+                        await outbound.send(channel, f"来自 {user_nickname} 的操作：播放列表已经是空的")
                 else:
-                    await channel.send("操作失败：找不到该频道的播放器")
+                    await outbound.send(channel, "操作失败：找不到该频道的播放器")
             except Exception as ex:
                 logger.error(f"执行清空播放列表操作时出错: {ex}")
-                await channel.send(f"执行清空播放列表操作时出错: {ex}")
+                await outbound.send(channel, f"执行清空播放列表操作时出错: {ex}")
 
                 # 出错时释放锁
                 BUTTON_LOCKS.pop(lock_key, None)
@@ -623,14 +741,14 @@ async def on_btn_clicked(_: Bot, e: Event):
                     success = await enhanced_streamer.set_play_mode(next_mode)
                     if success:
                         new_mode_info = await enhanced_streamer.get_play_mode()
-                        await channel.send(f"来自 {user_nickname} 的操作：已将播放模式切换为 {new_mode_info[1]}")
+                        await outbound.send(channel, f"来自 {user_nickname} 的操作：已将播放模式切换为 {new_mode_info[1]}")
                     else:
-                        await channel.send(f"来自 {user_nickname} 的操作：切换播放模式失败")
+                        await outbound.send(channel, f"来自 {user_nickname} 的操作：切换播放模式失败")
                 else:
-                    await channel.send("操作失败：找不到该频道的播放器")
+                    await outbound.send(channel, "操作失败：找不到该频道的播放器")
             except Exception as ex:
                 logger.error(f"执行切换播放模式操作时出错: {ex}")
-                await channel.send(f"执行切换播放模式操作时出错: {ex}")
+                await outbound.send(channel, f"执行切换播放模式操作时出错: {ex}")
 
                 # 出错时释放锁
                 BUTTON_LOCKS.pop(lock_key, None)
@@ -638,65 +756,19 @@ async def on_btn_clicked(_: Bot, e: Event):
         elif action == "EXIT":
             # 处理"退出频道"操作
             try:
-                # 删除当前频道的卡片（如果存在）
-                if voice_channel_id in card_messages:
-                    try:
-                        card_id = card_messages[voice_channel_id]
-                        await bot.client.gate.exec_req(api.Message.delete(card_id))
-                        # 从字典中移除该卡片
-                        del card_messages[voice_channel_id]
-                        logger.info(f"退出操作时删除了频道 {voice_channel_id} 的播放卡片")
-                    except Exception as e:
-                        logger.error(f"删除卡片时出错: {e}")
-
-                # 停止并退出语音频道
-                if voice_channel_id in playlist_tasks:
-                    try:
-                        # 停止推流
-                        enhanced_streamer = playlist_tasks[voice_channel_id]
-                        stop_success, _ = await enhanced_streamer.stop()
-
-                        if not stop_success:
-                            logger.warning(f"停止推流失败，频道ID: {voice_channel_id}")
-
-                        # 清理任务
-                        playlist_tasks.pop(voice_channel_id, None)
-
-                        if voice_channel_id in stream_tasks:
-                            task = stream_tasks.pop(voice_channel_id, None)
-                            if task:
-                                task.cancel()
-
-                        if voice_channel_id in stream_monitor_tasks:
-                            task = stream_monitor_tasks.pop(voice_channel_id, None)
-                            if task:
-                                task.cancel()
-
-                        if voice_channel_id in keep_alive_tasks:
-                            task = keep_alive_tasks.pop(voice_channel_id, None)
-                            if task:
-                                task.cancel()
-                    except Exception as e:
-                        logger.error(f"停止推流任务时出错: {e}")
+                # 删除播放卡片、停止推流和相关任务，并退出语音频道
+                leave_result = await teardown_channel(voice_channel_id)
 
-                # 调用离开频道API
-                leave_result = await core.leave_channel(voice_channel_id)
-
-                if 'error' in leave_result:
-                    await channel.send(f"来自 {user_nickname} 的操作：退出频道失败: {leave_result['error']}")
-                    logger.error(f"退出频道失败: {leave_result['error']}")
+                if leave_result is None:
+                    await outbound.send(channel, f"来自 {user_nickname} 的操作：频道正在退出中")
+                elif 'error' in leave_result:
+                    await outbound.send(channel, f"来自 {user_nickname} 的操作：退出频道失败: {leave_result['error']}")
                 else:
-                    await channel.send(f"来自 {user_nickname} 的操作：已成功退出频道")
-                    logger.info(f"已成功退出频道: {voice_channel_id}")
-
-                # 退出成功后，移除该频道的所有锁
-                for k in list(BUTTON_LOCKS.keys()):
-                    if k.startswith(voice_channel_id):
-                        BUTTON_LOCKS.pop(k, None)
+                    await outbound.send(channel, f"来自 {user_nickname} 的操作：已成功退出频道")
             except Exception as ex:
                 logger.error(f"执行退出频道操作时出错: {ex}")
                 try:
-                    await channel.send(f"执行退出频道操作时出错: {ex}")
+                    await outbound.send(channel, f"执行退出频道操作时出错: {ex}")
                 except:
                     logger.error("无法发送退出频道错误消息")
 
@@ -713,7 +785,7 @@ async def on_btn_clicked(_: Bot, e: Event):
                 try:
                     channel = await bot.client.fetch_public_channel(target_id)
                     if channel:
-                        await channel.send(f"处理按钮点击事件时出错: {ex}")
+                        await outbound.send(channel, f"处理按钮点击事件时出错: {ex}")
                 except Exception as channel_ex:
                     logger.error(f"获取频道对象或发送错误消息失败: {channel_ex}")
         except Exception as send_ex:
@@ -733,6 +805,8 @@ async def on_btn_clicked(_: Bot, e: Event):
 
 # region 基础功能
 @bot.command(name='menu', aliases=['帮助', '菜单', "help"])
+@timed_command
+@counts_reply
 async def menu(msg: Message):
     cm = CardMessage()
     c3 = Card(
@@ -794,6 +868,8 @@ async def menu(msg: Message):
 # 娱乐项目
 # 摇骰子
 @bot.command(name='r', aliases=['roll'])
+@timed_command
+@counts_reply
 async def r(msg: Message, t_min: int = 1, t_max: int = 100, n: int = 1, *args):
     if args != ():
         await msg.reply(f"参数错误")
@@ -812,6 +888,8 @@ async def r(msg: Message, t_min: int = 1, t_max: int = 100, n: int = 1, *args):
 # 秒表
 # 倒计时函数，单位为秒，默认60秒
 @bot.command(name='cd', aliases=['倒计时', 'countdown'])
+@timed_command
+@counts_reply
 async def cd(msg: Message, countdown_second: int = 60, *args):
     if args != ():
         await msg.reply(f"参数错误，countdown命令只支持1个参数\n正确用法: `countdown 120` 生成一个120s的倒计时")
@@ -830,6 +908,8 @@ async def cd(msg: Message, countdown_second: int = 60, *args):
 
 # 天气
 @bot.command(name='we', aliases=["天气", "weather"])
+@timed_command
+@counts_reply
 async def we_command(msg: Message, city: str = "err"):
     await weather(msg, city)  # 调用we函数
 
@@ -840,6 +920,8 @@ async def we_command(msg: Message, city: str = "err"):
 
 # 加入频道 (Test)
 @bot.command(name="join")
+@timed_command
+@counts_reply
 async def play(msg: Message, *args):
     # 检查列表中的频道，以确保机器人不会重复加入同一频道
     alive_data = await core.get_alive_channel_list()
@@ -896,14 +978,16 @@ async def play(msg: Message, *args):
         rtp_address = f"rtp://{ip}:{port}?rtcpport={rtcp_port}"
 
         await msg.reply(f"成功加入频道: {target_channel_id}\n{join_result}\n\nRTP地址: {rtp_address}")
+        channel_sessions.open(target_channel_id, origin_id=msg.ctx.channel.id, notify_channel=msg.ctx.channel)
         if target_channel_id not in keep_alive_tasks:
-            task = asyncio.create_task(core.keep_channel_alive(target_channel_id))
-            keep_alive_tasks[target_channel_id] = task
+            keep_alive_tasks[target_channel_id] = core.keep_channel_alive(target_channel_id)
 
 
 # noinspection PyUnresolvedReferences
 
 @bot.command(name="exit", aliases=["leave", "退出"])
+@timed_command
+@counts_reply
 async def exit_command(msg: Message, *args):
     # 确定离开的频道
     target_channel_id = None
@@ -935,55 +1019,22 @@ async def exit_command(msg: Message, *args):
         await msg.reply(f"机器人不在语音频道 {target_channel_id} 中")
         return
 
-    # 删除该频道的播放卡片（如果有）
-    if target_channel_id in card_messages:
-        try:
-            card_id = card_messages[target_channel_id]
-            await bot.client.gate.exec_req(api.Message.delete(card_id))
-            # 从字典中移除该卡片
-            del card_messages[target_channel_id]
-            logger.info(f"退出频道时删除了频道 {target_channel_id} 的播放卡片")
-        except Exception as e:
-            logger.error(f"删除卡片时出错: {e}")
-
-    # 停止相关任务
-    keep_alive_task = keep_alive_tasks.pop(target_channel_id, None)
-    if keep_alive_task:
-        keep_alive_task.cancel()
-
-    stream_monitor_task = stream_monitor_tasks.pop(target_channel_id, None)
-    if stream_monitor_task:
-        stream_monitor_task.cancel()
-
-    auto_exit_task = auto_exit_tasks.pop(target_channel_id, None)
-    if auto_exit_task:
-        auto_exit_task.cancel()
-
-    # 停止播放列表和推流
-    enhanced_streamer = playlist_tasks.pop(target_channel_id, None)
-    if enhanced_streamer:
-        await enhanced_streamer.stop()
-
-    # 清理其他任务
-    stream_tasks.pop(target_channel_id, None)
-
-    # 使用退出函数退出语音频道
-    leave_result = await core.leave_channel(target_channel_id)
-    if 'error' in leave_result:
+    # 删除播放卡片、停止推流和相关任务，并退出语音频道
+    leave_result = await teardown_channel(target_channel_id)
+    if leave_result is None:
+        await msg.reply(f"频道 {target_channel_id} 正在退出中")
+    elif 'error' in leave_result:
         await msg.reply(f"退出频道失败: {leave_result['error']}")
     else:
         await msg.reply(f"已成功退出语音频道")
 
-    # 确保清理所有按钮锁
-    for k in list(BUTTON_LOCKS.keys()):
-        if k.startswith(target_channel_id):
-            BUTTON_LOCKS.pop(k, None)
-
 
 @bot.command(name="alive", aliases=['ping'])
+@timed_command
+@counts_reply
 async def alive_command(msg: Message):
     try:
-        alive_data = await core.get_alive_channel_list()
+        alive_data = await core.get_alive_channel_list(force_refresh=True)
         if 'error' in alive_data:
             await msg.reply(f"获取频道列表时发生错误: {alive_data['error']}")
         else:
@@ -994,17 +1045,48 @@ async def alive_command(msg: Message):
 
 # 本地搜索(test)
 @bot.command(name="ls")
+@timed_command
+@counts_reply
 async def ls_command(msg: Message, *args):
     try:
         search_keyword = " ".join(args)
-        search_file = await search_files(search_keyword=search_keyword)
-        print(search_file)
+        # 首次搜索时在线程池中建立索引，避免阻塞事件循环；只搜索一次，总数和前10条都取自同一结果
+        await asyncio.get_running_loop().run_in_executor(None, library_index.ensure_built)
+        results = library_index.search(search_keyword, limit=None)
+
+        if not results:
+            await msg.reply("本地曲库中未找到相关歌曲")
+            return
+        lines = [f"{i}. {doc['song_name']} - {doc['artist_name'] or '未知艺术家'}"
+                 for i, doc in enumerate(results[:10], 1)]
+        await msg.reply(f"本地曲库找到 {len(results)} 首歌曲：\n" + "\n".join(lines))
 
     except Exception as e:
         await msg.reply(f"发生错误:{e}")
 
 
+async def confirm_local_match(msg, keyword, song_id):
+    """
+    后台用网络搜索确认本地优先匹配的结果，不一致时提示用户
+
+    :param msg: 点歌消息对象
+    :param keyword: 点歌关键词
+    :param song_id: 本地匹配到的歌曲ID
+    """
+    try:
+        remote_song = await NeteaseAPI.find_remote_correction(keyword, song_id)
+        if remote_song:
+            logger.info(f"本地匹配与网络搜索结果不一致: 本地 {song_id}，网络 {remote_song['song_id']}")
+            await msg.ctx.channel.send(
+                f"提示：网络搜索“{keyword}”的首个结果为 {remote_song['song_name']} - {remote_song['artist_name']}，"
+                f"如需播放请发送：点歌 https://music.163.com/song?id={remote_song['song_id']}")
+    except Exception as e:
+        logger.warning(f"后台确认本地匹配时出错: {e}")
+
+
 @bot.command(name="play", aliases=["点歌", "p"])
+@timed_command
+@counts_reply
 async def neteasemusic_stream(msg: Message, *args):
     if not args:
         await msg.reply(
@@ -1043,9 +1125,9 @@ async def neteasemusic_stream(msg: Message, *args):
             else:
                 # await msg.reply(f"加入频道成功！ID: {target_channel_id}")
                 logger.info(f"加入频道成功！ID: {target_channel_id}")
+                channel_sessions.open(target_channel_id, origin_id=msg.ctx.channel.id, notify_channel=msg.ctx.channel)
                 if target_channel_id not in keep_alive_tasks:
-                    task = asyncio.create_task(core.keep_channel_alive(target_channel_id))
-                    keep_alive_tasks[target_channel_id] = task
+                    keep_alive_tasks[target_channel_id] = core.keep_channel_alive(target_channel_id)
 
                 # 创建并启动新的推流器，传入消息对象和消息回调函数
                 enhanced_streamer = core.EnhancedAudioStreamer(
@@ -1070,12 +1152,8 @@ async def neteasemusic_stream(msg: Message, *args):
                 stream_tasks[target_channel_id] = enhanced_streamer
                 playlist_tasks[target_channel_id] = enhanced_streamer
 
-                # 创建监控任务
-                if target_channel_id not in auto_exit_tasks:
-                    # 确保监控任务能持续追踪推流器状态直到自动退出
-                    logger.info(f"为频道 {target_channel_id} 创建监控任务")
-                    task = asyncio.create_task(monitor_streamer_status(msg, target_channel_id))
-                    auto_exit_tasks[target_channel_id] = task
+                # 监听推流器状态，播放列表为空时自动退出
+                watch_streamer_status(msg, target_channel_id)
 
         # 参数处理与搜索
         keyword = " ".join(args)
@@ -1089,6 +1167,11 @@ async def neteasemusic_stream(msg: Message, *args):
         # 检查是否是网易云电台节目链接
         dj_id_match = re.search(r'music\.163\.com/dj\?id=(\d+)', keyword)
 
+        # 关键词点歌时优先在本地曲库中查找可信匹配，命中时直接播放，网络搜索在后台确认
+        local_song = None
+        if not dj_id_match and not song_id_match:
+            local_song = await NeteaseAPI.resolve_keyword_locally(keyword)
+
         if dj_id_match:
             # 处理电台节目
             dj_id = dj_id_match.group(1)
@@ -1101,6 +1184,10 @@ async def neteasemusic_stream(msg: Message, *args):
             # await msg.reply(f"检测到网易云音乐链接，正在获取歌曲ID: {music_id}")
             logger.info(f"检测到网易云音乐链接，正在获取歌曲ID: {music_id}")
             songs = await NeteaseAPI.download_music_by_id(music_id)
+        elif local_song:
+            logger.info(f"本地曲库匹配到歌曲：{local_song['song_name']} - {local_song['artist_name']}，在后台进行网络搜索确认")
+            songs = local_song
+            asyncio.create_task(confirm_local_match(msg, keyword, local_song['song_id']))
         else:
             # 使用关键词搜索
             # await msg.reply(f"正在搜索关键字: {keyword}")
@@ -1232,11 +1319,8 @@ async def neteasemusic_stream(msg: Message, *args):
         # 只向用户发送简化的消息
         await msg.ctx.channel.send(user_message)
 
-        # 确保监控任务存在且正常运行
-        if target_channel_id not in auto_exit_tasks or auto_exit_tasks[target_channel_id].done():
-            logger.info(f"重新创建频道 {target_channel_id} 的监控任务")
-            task = asyncio.create_task(monitor_streamer_status(msg, target_channel_id))
-            auto_exit_tasks[target_channel_id] = task
+        # 确保自动退出监听存在
+        watch_streamer_status(msg, target_channel_id)
 
     except asyncio.CancelledError:
         # 处理被取消的任务
@@ -1252,6 +1336,8 @@ async def neteasemusic_stream(msg: Message, *args):
 
 # 添加一个查看当前播放列表的命令
 @bot.command(name="list", aliases=["列表", "歌单"])
+@timed_command
+@counts_reply
 async def list_playlist(msg: Message, channel_id: str = ""):
     try:
         target_channel_id = None
@@ -1309,6 +1395,8 @@ async def list_playlist(msg: Message, channel_id: str = ""):
 
 # 添加一个跳过当前歌曲的命令
 @bot.command(name="skip", aliases=["跳过", "下一首"])
+@timed_command
+@counts_reply
 async def skip_song(msg: Message, channel_id: str = ""):
     """
     跳过当前播放的歌曲
@@ -1355,16 +1443,7 @@ async def skip_song(msg: Message, channel_id: str = ""):
         # 直接获取EnhancedAudioStreamer实例
         enhanced_streamer = playlist_tasks[target_channel_id]
 
-        # 如果有正在播放的卡片，删除它
-        if target_channel_id in card_messages:
-            try:
-                card_id = card_messages[target_channel_id]
-                await bot.client.gate.exec_req(api.Message.delete(card_id))
-                # 从字典中移除该卡片
-                del card_messages[target_channel_id]
-                logger.info(f"跳过歌曲时删除了频道 {target_channel_id} 的播放卡片")
-            except Exception as e:
-                logger.error(f"删除卡片时出错: {e}")
+        # 播放卡片会在下一首开始播放时原地更新，播放列表结束时自动删除
 
         # 跳过当前歌曲
         old, new = await enhanced_streamer.skip_current()
@@ -1388,6 +1467,8 @@ async def skip_song(msg: Message, channel_id: str = ""):
 
 
 @bot.command(name="pc")
+@timed_command
+@counts_reply
 async def play_channel(msg: Message, song_name: str = "", channel_id: str = ""):
     if not song_name or not channel_id:
         await msg.reply("参数缺失，请提供歌名/URL和频道ID，格式：pc \"歌名或网易云链接\" \"频道ID\"")
@@ -1420,9 +1501,9 @@ async def play_channel(msg: Message, song_name: str = "", channel_id: str = ""):
                 return
             else:
                 await msg.reply(f"加入频道成功！ID: {target_channel_id}")
+                channel_sessions.open(target_channel_id, origin_id=msg.ctx.channel.id, notify_channel=msg.ctx.channel)
                 if target_channel_id not in keep_alive_tasks:
-                    task = asyncio.create_task(core.keep_channel_alive(target_channel_id))
-                    keep_alive_tasks[target_channel_id] = task
+                    keep_alive_tasks[target_channel_id] = core.keep_channel_alive(target_channel_id)
 
                 # 创建并启动新的推流器，传入消息对象和消息回调函数
                 enhanced_streamer = core.EnhancedAudioStreamer(
@@ -1447,12 +1528,8 @@ async def play_channel(msg: Message, song_name: str = "", channel_id: str = ""):
                 stream_tasks[target_channel_id] = enhanced_streamer
                 playlist_tasks[target_channel_id] = enhanced_streamer
 
-                # 创建监控任务
-                if target_channel_id not in auto_exit_tasks:
-                    # 确保监控任务能持续追踪推流器状态直到自动退出
-                    logger.info(f"为频道 {target_channel_id} 创建监控任务")
-                    task = asyncio.create_task(monitor_streamer_status(msg, target_channel_id))
-                    auto_exit_tasks[target_channel_id] = task
+                # 监听推流器状态，播放列表为空时自动退出
+                watch_streamer_status(msg, target_channel_id)
 
         # 使用统一的URL解析函数检查是否是网易云音乐链接
         parsed_url = NeteaseAPI.parse_music_url(song_name)
@@ -1596,11 +1673,8 @@ async def play_channel(msg: Message, song_name: str = "", channel_id: str = ""):
 
         await msg.reply(message_text)
 
-        # 确保监控任务存在且正常运行
-        if target_channel_id not in auto_exit_tasks or auto_exit_tasks[target_channel_id].done():
-            logger.info(f"重新创建频道 {target_channel_id} 的监控任务")
-            task = asyncio.create_task(monitor_streamer_status(msg, target_channel_id))
-            auto_exit_tasks[target_channel_id] = task
+        # 确保自动退出监听存在
+        watch_streamer_status(msg, target_channel_id)
 
     except asyncio.CancelledError:
         # 处理被取消的任务
@@ -1618,6 +1692,8 @@ async def play_channel(msg: Message, song_name: str = "", channel_id: str = ""):
 
 # region 网易API测试部分
 @bot.command(name="search", aliases=["搜索", "s"])
+@timed_command
+@counts_reply
 async def s1_command(msg: Message, *args):
     """搜索歌曲"""
     keyword = " ".join(args).strip()
@@ -1671,6 +1747,8 @@ async def s1_command(msg: Message, *args):
 
 
 @bot.command(name='download', aliases=["d", "下载"])
+@timed_command
+@counts_reply
 async def download(msg: Message, *args):
     if not args:
         await msg.reply("请提供关键词或ID")
@@ -1748,6 +1826,8 @@ async def download(msg: Message, *args):
 
 # qrcode login
 @bot.command(name='login')
+@timed_command
+@counts_reply
 async def login(msg: Message):
     try:
         await msg.reply("正在登录，请开发者查看机器人后台")
@@ -1762,6 +1842,8 @@ async def login(msg: Message):
 
 # check CookieAlive
 @bot.command(name='check')
+@timed_command
+@counts_reply
 async def check(msg: Message):
     try:
         a = await NeteaseAPI.ensure_logged_in()
@@ -1787,6 +1869,8 @@ async def check(msg: Message):
 # endregion
 # 添加一个调整音量的命令
 @bot.command(name="volume", aliases=["音量", "vol"])
+@timed_command
+@counts_reply
 async def set_volume(msg: Message, volume_str: str = None):
     if volume_str is None:
         # 显示当前音量
@@ -1835,6 +1919,8 @@ async def set_volume(msg: Message, volume_str: str = None):
 
 # region 播放模式切换
 @bot.command(name="mode", aliases=["播放模式", "模式"])
+@timed_command
+@counts_reply
 async def set_play_mode(msg: Message, mode: str = None, channel_id: str = ""):
     """
     设置播放模式
@@ -1930,6 +2016,8 @@ async def set_play_mode(msg: Message, mode: str = None, channel_id: str = ""):
 
 
 @bot.command(name="currentmode", aliases=["当前模式", "查看模式"])
+@timed_command
+@counts_reply
 async def get_current_mode(msg: Message, channel_id: str = ""):
     """
     获取当前播放模式
@@ -1989,6 +2077,8 @@ async def get_current_mode(msg: Message, channel_id: str = ""):
 
 
 @bot.command(name="progress", aliases=["进度", "播放进度"])
+@timed_command
+@counts_reply
 async def show_progress(msg: Message, channel_id: str = ""):
     """
     显示当前播放歌曲的进度
@@ -2064,7 +2154,48 @@ async def show_progress(msg: Message, channel_id: str = ""):
         await msg.reply(f"获取播放进度时发生错误: {e}")
 
 
+@bot.command(name="liveprogress", aliases=["实时进度", "lp"])
+@timed_command
+@counts_reply
+async def live_progress(msg: Message, channel_id: str = ""):
+    """
+    开启或关闭自动刷新的播放进度卡片
+
+    :param msg: 消息对象
+    :param channel_id: 频道ID，可选
+    """
+    try:
+        # 如果没有提供channel_id参数，则获取用户所在的语音频道
+        if not channel_id:
+            user_channels = await msg.ctx.guild.fetch_joined_channel(msg.author)
+            if not user_channels:
+                await msg.reply('请先加入一个语音频道，或提供频道ID作为参数，例如：`liveprogress 频道ID`')
+                return
+            target_channel_id = user_channels[0].id
+        else:
+            # 使用提供的频道ID
+            target_channel_id = channel_id.strip()
+
+        # 再次执行命令时关闭
+        if progress_cards.stop(target_channel_id):
+            await msg.reply("已关闭实时进度卡片")
+            return
+
+        if target_channel_id not in playlist_tasks:
+            await msg.reply("当前没有正在播放的音乐。")
+            return
+
+        result = await progress_cards.start(msg.ctx.channel, target_channel_id)
+        if isinstance(result, dict) and 'error' in result:
+            await msg.reply(result['error'])
+
+    except Exception as e:
+        await msg.reply(f"开启实时进度卡片时发生错误: {e}")
+
+
 @bot.command(name="import", aliases=["导入歌单", "歌单导入"])
+@timed_command
+@counts_reply
 async def import_playlist(msg: Message, playlist_url: str = "", play_mode: str = "", channel_id: str = ""):
     """
     导入网易云音乐歌单
@@ -2199,8 +2330,8 @@ async def import_playlist(msg: Message, playlist_url: str = "", play_mode: str =
             playlist_tasks[target_channel_id] = enhanced_streamer
 
             # 启动保持频道活跃的任务
-            keep_alive_task = asyncio.create_task(core.keep_channel_alive(target_channel_id))
-            keep_alive_tasks[target_channel_id] = keep_alive_task
+            channel_sessions.open(target_channel_id, origin_id=msg.ctx.channel.id, notify_channel=msg.ctx.channel)
+            keep_alive_tasks[target_channel_id] = core.keep_channel_alive(target_channel_id)
 
             logger.info(f"已加入频道 {target_channel_id} 并启动推流服务")
             await msg.reply(f"已加入频道 {target_channel_id}，准备导入歌单「{playlist_name}」")
@@ -2257,11 +2388,8 @@ async def import_playlist(msg: Message, playlist_url: str = "", play_mode: str =
 
         await msg.reply(message_text)
 
-        # 创建或更新监控任务
-        if target_channel_id not in auto_exit_tasks or auto_exit_tasks[target_channel_id].done():
-            logger.info(f"重新创建频道 {target_channel_id} 的监控任务")
-            task = asyncio.create_task(monitor_streamer_status(msg, target_channel_id))
-            auto_exit_tasks[target_channel_id] = task
+        # 确保自动退出监听存在
+        watch_streamer_status(msg, target_channel_id)
 
     except Exception as e:
         error_msg = str(e)
@@ -2272,6 +2400,8 @@ async def import_playlist(msg: Message, playlist_url: str = "", play_mode: str =
 
 
 @bot.command(name="remove", aliases=["删除", "rm"])
+@timed_command
+@counts_reply
 async def remove_song(msg: Message, index: int = 0, channel_id: str = ""):
     """
     从播放列表中删除指定索引的歌曲
@@ -2349,6 +2479,8 @@ async def remove_song(msg: Message, index: int = 0, channel_id: str = ""):
 
 
 @bot.command(name="clear", aliases=["清空", "清除"])
+@timed_command
+@counts_reply
 async def clear_playlist(msg: Message, channel_id: str = ""):
     """
     清空播放列表（不包括当前正在播放的歌曲）
@@ -2445,199 +2577,46 @@ async def playing_songcard(msg: Message, channel_id: str = "", auto_mode: bool =
             logger.info(f"尝试为频道 {target_channel_id} 生成播放卡片，但当前没有正在播放的歌曲")
             return
 
-        # 删除该频道之前的卡片消息（如果有）
-        if target_channel_id in card_messages:
-            try:
-                old_msg_id = card_messages[target_channel_id]
-                await bot.client.gate.exec_req(api.Message.delete(old_msg_id))
-                logger.info(f"已删除频道 {target_channel_id} 的旧播放卡片")
-            except Exception as e:
-                logger.error(f"删除旧播放卡片时出错: {e}")
-
-        # 获取歌曲详细信息
-        song_info = None
-        pic_url = "https://p2.music.126.net/6y-UleORITEDbvrOLV0Q8A==/5639395138885805.jpg"  # 默认封面
-        song_url = "https://music.163.com/"  # 默认网址
-        singer_url = "https://music.163.com/artist"  # 默认艺术家链接
-        album_url = "https://music.163.com/album"  # 默认专辑链接
-        song_name = os.path.basename(current_song)
-        artist_name = "未知艺术家"
-        album_name = "未知专辑"
-        duration = 0
-        audio_url = ""  # 音频直链
-
-        # 尝试从文件名获取歌曲ID
-        song_id = os.path.basename(current_song).split('.')[0]
-
-        # 如果是网易云音乐ID，尝试通过API获取详细信息和音频URL
-        if song_id.isdigit():
-            try:
-                # 导入NeteaseAPI
-                import NeteaseAPI
-
-                # 尝试获取歌曲URL和详情
-                song_url_info = await NeteaseAPI.get_song_url(song_id)
-
-                if "error" not in song_url_info:
-                    # 获取直链URL
-                    audio_url = song_url_info.get("song_url", "")
-
-                    # 获取歌曲详情
-                    song_detail = await NeteaseAPI.get_song_detail(song_id)
-
-                    if "error" not in song_detail:
-                        # 获取歌曲名称
-                        song_name = song_detail.get('name', song_name)
-
-                        # 获取艺术家信息
-                        if song_detail.get('artists'):
-                            artists = song_detail['artists']
-                            artist_name = ", ".join(
-                                [artist.get('name', '') for artist in artists if artist.get('name')])
-                            # 获取第一个艺术家的ID用于链接
-                            if artists and artists[0].get('id'):
-                                artist_id = artists[0]['id']
-                                singer_url = f"https://music.163.com/#/artist?id={artist_id}"
-
-                        # 获取专辑信息
-                        if song_detail.get('album'):
-                            album = song_detail['album']
-                            album_name = album.get('name', '未知专辑')
-                            # 获取专辑ID用于链接
-                            if album.get('id'):
-                                album_id = album['id']
-                                album_url = f"https://music.163.com/#/album?id={album_id}"
-                            # 获取专辑封面
-                            if album.get('picUrl'):
-                                pic_url = album['picUrl']
-
-                        # 获取歌曲时长
-                        duration = song_detail.get('duration', 0)  # 已转换为秒
-
-                        # 构建歌曲URL
-                        song_url = f"https://music.163.com/#/song?id={song_id}"
-
-                        print(f"从API获取到歌曲信息: {song_name} - {artist_name}")
-                    else:
-                        # 如果get_song_detail失败，但get_song_url成功，使用get_song_url的信息
-                        song_name = song_url_info.get('song_name', song_name)
-                        artist_name = song_url_info.get('artist_name', artist_name)
-                        album_name = song_url_info.get('album_name', album_name)
-                        pic_url = song_url_info.get('album_pic', pic_url)
-                        song_url = f"https://music.163.com/#/song?id={song_id}"
-                else:
-                    print(f"获取歌曲URL失败: {song_url_info['error']}")
-            except Exception as e:
-                print(f"通过API获取歌曲详情时出错: {e}")
-                # 如果API获取失败，回退到本地信息
-
-        # 如果API获取失败或不是网易云ID，尝试从本地信息获取
-        if not duration or duration == 0 or not artist_name or artist_name == "未知艺术家":
-            # 尝试从playlist_manager中获取信息
-            if current_song in playlist_manager.songs_info:
-                local_info = playlist_manager.songs_info[current_song]
-
-                # 只有在API没有获取到有效信息时才使用本地信息
-                if not song_name or song_name == os.path.basename(current_song):
-                    song_name = local_info.get('song_name', song_name)
-
-                if artist_name == "未知艺术家":
-                    artist_name = local_info.get('artist_name', artist_name)
+        # 卡片的静态内容按歌曲缓存（预下载时已提前生成），这里只填入倒计时等动态内容
+        template = await song_card_cache.get_template(current_song, playlist_manager)
+        audio_url = await song_card_cache.get_audio_url(template['song_id'])
+        position = current_position(playlist_manager, template['duration'])
+        cm = render_song_card(template, target_channel_id, position, audio_url, msg.author.avatar,
+                              f"{await local_hitokoto()}")  # 插入本地一言功能
 
-                if album_name == "未知专辑":
-                    album_name = local_info.get('album_name', album_name)
-
-                # 设置封面图片URL，如果有的话
-                if ('pic_url' in local_info and local_info['pic_url'] and
-                        pic_url == "https://p2.music.126.net/6y-UleORITEDbvrOLV0Q8A==/5639395138885805.jpg"):
-                    pic_url = local_info['pic_url']
-            else:
-                # 使用ffprobe获取基本信息
-                info = playlist_manager.get_song_info(current_song)
-                if not song_name or song_name == os.path.basename(current_song):
-                    song_name = info['title']
-
-                # 如果标题包含分隔符，尝试解析艺术家
-                if " - " in song_name and artist_name == "未知艺术家":
-                    parts = song_name.split(" - ", 1)
-                    song_name = parts[0]
-                    artist_name = parts[1]
-
-        # 获取歌曲时长（如果之前未获取）
-        if not duration or duration == 0:
-            duration = playlist_manager.get_song_duration(current_song)
-            if duration <= 0:
-                duration = 180  # 默认3分钟
-
-        # 获取当前播放进度
-        progress_info = await enhanced_streamer.get_current_progress()
-        current_position = 0
-        if progress_info:
-            current_position = progress_info['current_position']
-
-        # 计算剩余时间
-        remaining_time = max(0, duration - current_position)
+        card_key = f"card_{target_channel_id}"
+        old_msg_id = card_messages.get(target_channel_id)
+        if old_msg_id:
+            # 旧卡片还在频道底部附近时直接修改，避免删除再发送造成闪烁
+            after = outbound.messages_after(msg.ctx.channel.id, old_msg_id)
+            if after is not None and after < CARD_SCROLL_MESSAGES:
+                try:
+                    response = await outbound.update(msg.ctx.channel, old_msg_id, cm, key=card_key)
+                except Exception as e:
+                    logger.warning(f"修改频道 {target_channel_id} 的播放卡片失败，将重新发送: {e}")
+                else:
+                    if response is None:
+                        logger.info(f"频道 {target_channel_id} 的播放卡片已被新卡片取代")
+                    else:
+                        logger.info(f"已更新频道 {target_channel_id} 的播放卡片，消息ID: {old_msg_id}")
+                    return
 
-        # 创建卡片
-        cm = CardMessage()
-        c3 = Card(
-            Module.Header("正在播放： " + song_name),
-            Module.Context(
-                Element.Text(
-                    "歌手： [" + artist_name + "](" + singer_url +
-                    ")  — 专辑： [" + album_name + "](" + album_url + ")",
-                    Types.Text.KMD)),
-            # 添加音频模块，如果有直链就使用，否则只显示信息
-            Module.File(Types.File.AUDIO,
-                        src=audio_url,  # 如果获取到了直链就使用，否则为空
-                        title=song_name,
-                        cover=pic_url),
-            # # 添加当前播放进度信息
-            # Module.Section(
-            #     Element.Text(f"播放进度：{format_time(current_position)} / {format_time(duration)}", Types.Text.KMD)
-            # ),
-            # # 添加进度条
-            # Module.Section(
-            #     Element.Text(get_progress_bar(current_position, duration), Types.Text.KMD)
-            # ),
-            # 使用剩余时间创建倒计时，而不是总时长
-            Module.Countdown(datetime.now() +
-                             timedelta(seconds=int(remaining_time)),
-                             mode=Types.CountdownMode.SECOND),
-            Module.Divider(),
-            Module.Context(
-                Element.Image(
-                    src=
-                    "https://img.kookapp.cn/assets/2022-05/UmCnhm4mlt016016.png"
-                ),
-                Element.Text("网易云音乐  [在网页查看](" + song_url + ")",
-                             Types.Text.KMD)),
-            Module.ActionGroup(
-                Element.Button('下一首', f'NEXT_{target_channel_id}', Types.Click.RETURN_VAL),
-                Element.Button('清空歌单', f'CLEAR_{target_channel_id}', Types.Click.RETURN_VAL),
-                Element.Button('循环模式', f'LOOP_{target_channel_id}', Types.Click.RETURN_VAL),
-                Element.Button('退出频道', f'EXIT_{target_channel_id}', Types.Click.RETURN_VAL)),
-
-            Module.Divider(),
-            Module.Section(
-                Element.Text("👈点歌用户", type=Types.Text.KMD),
-                Element.Image(src=msg.author.avatar, size=Types.Size.SM, circle=True)
-
-            ),
-            color="#6AC629")
-        c3.append(Module.Context(
-            Element.Text(f"{await local_hitokoto()}", Types.Text.KMD)  # 插入本地一言功能
-        ))
-        cm.append(c3)
-
-        # 发送卡片并获取响应
-        response = await msg.ctx.channel.send(cm)
+        # 发送卡片并获取响应，发出之前被同一频道的新卡片取代时不做任何处理
+        response = await outbound.send(msg.ctx.channel, cm, key=card_key, track=True)
+        if response is None:
+            logger.info(f"频道 {target_channel_id} 的播放卡片已被新卡片取代")
+            return
 
         # 保存消息ID，用于后续删除
         msg_id = response['msg_id']
+        old_msg_id = card_messages.get(target_channel_id)
         card_messages[target_channel_id] = msg_id
         logger.info(f"已为频道 {target_channel_id} 发送新播放卡片，消息ID: {msg_id}")
 
+        # 旧卡片已被刷上去或修改失败，新卡片发出后再删除旧卡片
+        if old_msg_id and old_msg_id != msg_id:
+            outbound.delete(old_msg_id, msg.ctx.channel.id)
+
     except Exception as e:
         error_msg = f"生成播放卡片时发生错误: {e}"
         logger.error(error_msg)
@@ -2648,101 +2627,14 @@ async def playing_songcard(msg: Message, channel_id: str = "", auto_mode: bool =
 # region 测试
 
 @bot.command(name='tc', aliases=['testcard'])
+@timed_command
+@counts_reply
 async def test_card(msg: Message, channel_id: str = ""):
     await playing_songcard(msg, channel_id)
 
 
 # endregion
 
-async def monitor_song_completion(msg, channel_id):
-    """
-    监控歌曲播放状态，当歌曲播放完毕时删除卡片
-
-    :param msg: 消息对象
-    :param channel_id: 频道ID
-    """
-    try:
-        if channel_id not in playlist_tasks or channel_id not in card_messages:
-            return
-
-        enhanced_streamer = playlist_tasks[channel_id]
-        # 获取当前播放的歌曲
-        current_song = enhanced_streamer.playlist_manager.current_song
-        if not current_song:
-            return
-
-        logger.info(f"开始监控频道 {channel_id} 的歌曲播放状态")
-
-        # 记录当前的卡片消息ID
-        card_id = card_messages.get(channel_id)
-        if not card_id:
-            return
-
-        # 记录当前监控的歌曲
-        monitoring_song = current_song
-
-        # 每2秒检查一次状态
-        while True:
-            # 检查频道是否仍然存在
-            if channel_id not in playlist_tasks:
-                logger.info(f"频道 {channel_id} 不再存在，停止监控")
-                break
-
-            enhanced_streamer = playlist_tasks[channel_id]
-
-            # 检查当前播放的歌曲是否已更改（说明已经切换到下一首）
-            if enhanced_streamer.playlist_manager.current_song != monitoring_song:
-                logger.info(f"频道 {channel_id} 的歌曲已切换，之前的卡片不需要删除")
-                break
-
-            # 检查推流器状态
-            if not hasattr(enhanced_streamer, "streamer") or enhanced_streamer.streamer is None:
-                logger.info(f"频道 {channel_id} 的推流器已停止，删除卡片")
-                try:
-                    await bot.client.gate.exec_req(api.Message.delete(card_id))
-                    # 从字典中移除该卡片
-                    if channel_id in card_messages and card_messages[channel_id] == card_id:
-                        del card_messages[channel_id]
-                except Exception as e:
-                    logger.error(f"删除卡片时出错: {e}")
-                break
-
-            # 获取当前播放进度
-            progress_info = await enhanced_streamer.get_current_progress()
-
-            # 如果没有进度信息或播放位置为0，可能是歌曲已经播放完毕
-            if not progress_info or progress_info['current_position'] == 0:
-                await asyncio.sleep(2)  # 再等待2秒确认
-                progress_info = await enhanced_streamer.get_current_progress()
-
-                # 再次检查，如果位置仍为0，可能确实是播放完毕了
-                if not progress_info or progress_info['current_position'] == 0:
-                    logger.info(f"检测到频道 {channel_id} 的歌曲可能已播放完毕")
-
-                    # 再次检查当前歌曲是否已更改
-                    if enhanced_streamer.playlist_manager.current_song != monitoring_song:
-                        logger.info(f"歌曲已切换，卡片将保留给新歌曲")
-                        break
-
-                    # 确认歌曲已播放完毕，删除卡片
-                    logger.info(f"频道 {channel_id} 的歌曲已播放完毕，删除卡片")
-                    try:
-                        await bot.client.gate.exec_req(api.Message.delete(card_id))
-                        # 从字典中移除该卡片
-                        if channel_id in card_messages and card_messages[channel_id] == card_id:
-                            del card_messages[channel_id]
-                    except Exception as e:
-                        logger.error(f"删除卡片时出错: {e}")
-                    break
-
-            await asyncio.sleep(2)  # 等待2秒再检查
-
-    except asyncio.CancelledError:
-        logger.info(f"频道 {channel_id} 的歌曲监控任务被取消")
-    except Exception as e:
-        logger.error(f"监控频道 {channel_id} 的歌曲状态时出错: {e}")
-
-
 # region 机器人运行主程序
 # 机器人运行日志 监测运行状态
 logging.basicConfig(level='INFO')
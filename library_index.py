@@ -0,0 +1,256 @@
+import logging
+import os
+import threading
+import unicodedata
+from collections import defaultdict
+
+from audio_cache import audio_lib_cache
+from metadata_store import song_metadata_store
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 模糊匹配时，查询中至少需要命中的二元组比例
+FUZZY_THRESHOLD = 0.6
+
+
+def normalize_text(text: str) -> str:
+    """统一全角/半角、忽略大小写并合并连续空白"""
+    return " ".join(unicodedata.normalize("NFKC", str(text)).casefold().split())
+
+
+def _grams(text: str) -> set:
+    """取去除空白后的二元组（中文歌名通常只有两三个字，二元组比三元组更合适）"""
+    compact = text.replace(" ", "")
+    if len(compact) < 2:
+        return {compact} if compact else set()
+    return {compact[i:i + 2] for i in range(len(compact) - 1)}
+
+
+class LibraryIndex:
+    """
+    本地曲库索引
+
+    以 AudioLib 缓存索引中的文件为文档，文件名为歌曲ID时使用元数据存储中的歌名、艺术家、专辑，
+    否则使用文件名。在内存中维护二元组倒排索引，支持歌名/艺术家/专辑的前缀、子串和模糊查询。
+    文件的下载、淘汰、后台校对以及元数据更新都会通过回调增量更新索引，不再逐次遍历文件夹。
+    """
+
+    def __init__(self, cache=audio_lib_cache, store=song_metadata_store):
+        """
+        :param cache: AudioLib 缓存管理器，提供文件列表和文件变化通知
+        :param store: 歌曲元数据存储，提供歌名等信息和更新通知
+        """
+        self.cache = cache
+        self.store = store
+        self._docs = {}  # 文档编号 -> 文档
+        self._doc_ids = {}  # 文件路径 -> 文档编号
+        self._song_docs = {}  # 歌曲ID -> 文档编号
+        self._grams = defaultdict(set)  # 二元组 -> 文档编号集合
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()  # 只用于串行化首次建立索引，事件循环不会等待它
+        self._built = False
+        self._pending_changes = []  # 建立索引期间收到的变化，建立完成后再应用
+
+        cache.add_listener(self._on_files_changed)
+        if store is not None:
+            store.add_listener(self._on_metadata_updated)
+
+    def ensure_built(self):
+        """首次使用时根据缓存索引中的文件建立索引，耗时较长，应在线程池中调用"""
+        if self._built:
+            return
+        with self._build_lock:
+            if self._built:
+                return
+            # 建立完成之前只有当前线程修改索引，回调只会把变化加入 _pending_changes，不需要持有 _lock
+            for path in self.cache.paths():
+                self._add(path)
+            with self._lock:
+                for apply, args in self._pending_changes:
+                    apply(*args)
+                self._pending_changes = []
+                self._built = True
+        logger.info(f"本地曲库索引已建立，共 {len(self._docs)} 首歌曲")
+
+    def _describe(self, path: str) -> dict:
+        """根据文件路径生成文档"""
+        stem = os.path.splitext(os.path.basename(path))[0]
+        info = self.store.get_song_info(stem) if self.store is not None and stem.isdigit() else None
+        if info:
+            fields = (info['song_name'], info['artist_name'], info['album_name'])
+        else:
+            fields = (stem, "", "")
+        normalized = tuple(normalize_text(field) for field in fields)
+        return {
+            'path': path,
+            'song_id': stem if stem.isdigit() else None,
+            'song_name': fields[0],
+            'artist_name': fields[1],
+            'album_name': fields[2],
+            'fields': normalized + (normalize_text(stem),),
+            'text': " ".join(normalized + (normalize_text(stem),)),
+        }
+
+    def _add(self, path: str):
+        """添加或更新文档，调用方需持有锁"""
+        self._remove(path)
+        doc = self._describe(path)
+        doc_id = self._next_id
+        self._next_id += 1
+        self._docs[doc_id] = doc
+        self._doc_ids[path] = doc_id
+        if doc['song_id']:
+            self._song_docs[doc['song_id']] = doc_id
+        for gram in _grams(doc['text']):
+            self._grams[gram].add(doc_id)
+
+    def _remove(self, path: str):
+        """移除文档，调用方需持有锁"""
+        doc_id = self._doc_ids.pop(path, None)
+        if doc_id is None:
+            return
+        doc = self._docs.pop(doc_id)
+        if doc['song_id'] and self._song_docs.get(doc['song_id']) == doc_id:
+            del self._song_docs[doc['song_id']]
+        for gram in _grams(doc['text']):
+            postings = self._grams.get(gram)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    del self._grams[gram]
+
+    def _on_files_changed(self, added, removed):
+        self._apply_or_defer(self._apply_files_changed, added, removed)
+
+    def _on_metadata_updated(self, song_ids):
+        self._apply_or_defer(self._apply_metadata_updated, song_ids)
+
+    def _apply_or_defer(self, apply, *args):
+        """
+        索引已建立时直接应用变化，否则记录下来等建立完成后再应用
+
+        回调在事件循环中调用，只短暂持有 _lock，不会等待建立索引完成。
+        """
+        with self._lock:
+            if self._built:
+                apply(*args)
+            else:
+                self._pending_changes.append((apply, args))
+
+    def _apply_files_changed(self, added, removed):
+        """调用方需持有锁"""
+        for path in removed:
+            self._remove(path)
+        for path in added:
+            self._add(path)
+
+    def _apply_metadata_updated(self, song_ids):
+        """调用方需持有锁"""
+        for song_id in song_ids:
+            doc_id = self._song_docs.get(str(song_id))
+            if doc_id is not None:
+                self._add(self._docs[doc_id]['path'])
+
+    @staticmethod
+    def _score(doc: dict, tokens: list, query: str) -> int:
+        """完全匹配某个字段得分最高，其次是字段前缀，最后是子串"""
+        if query in doc['fields']:
+            return 3
+        if any(field.startswith(query) for field in doc['fields']):
+            return 2
+        if all(any(field.startswith(token) for field in doc['fields']) for token in tokens):
+            return 2
+        return 1
+
+    def search(self, keyword: str, limit: int = 20) -> list:
+        """
+        搜索本地曲库
+
+        :param keyword: 关键词，多个词之间用空格分隔，需全部匹配
+        :param limit: 最多返回的结果数量，为 None 时返回全部
+        :return: 文档列表（包含 path/song_id/song_name/artist_name/album_name），按匹配程度排序
+        """
+        self.ensure_built()
+        query = normalize_text(keyword)
+        with self._lock:
+            if not query:
+                docs = list(self._docs.values())
+                return [self._public(doc) for doc in docs[:limit]]
+
+            tokens = query.split()
+            candidates = None
+            for token in tokens:
+                if len(token) < 2:
+                    continue
+                postings = set.intersection(*(self._grams.get(gram, set()) for gram in _grams(token)))
+                candidates = postings if candidates is None else candidates & postings
+            if candidates is None:
+                # 只有单字查询时直接扫描全部文档
+                candidates = self._docs.keys()
+
+            matches = []
+            for doc_id in candidates:
+                doc = self._docs[doc_id]
+                if all(token in doc['text'] for token in tokens):
+                    matches.append((self._score(doc, tokens, query), doc_id))
+
+            if not matches:
+                matches = self._fuzzy(query)
+
+            matches.sort(key=lambda item: (-item[0], item[1]))
+            return [self._public(self._docs[doc_id]) for _, doc_id in matches[:limit]]
+
+    def find_confident_match(self, keyword: str):
+        """
+        查找与关键词可信匹配的本地歌曲，用于点歌时优先播放本地缓存
+
+        只有关键词与歌名完全一致，或关键词中有一个词是歌名、其余词都是艺术家/专辑的前缀时才算匹配，
+        并且匹配结果必须唯一，否则交给网络搜索决定。
+
+        :param keyword: 点歌关键词
+        :return: 文档，没有可信匹配时返回None
+        """
+        query = normalize_text(keyword)
+        if not query:
+            return None
+        tokens = query.split()
+
+        matches = {}
+        for doc in self.search(keyword, limit=None):
+            if not doc['song_id']:
+                continue
+            title, artist, album = (normalize_text(doc[key]) for key in ('song_name', 'artist_name', 'album_name'))
+            if title == query:
+                matches[doc['song_id']] = doc
+                continue
+            for i, token in enumerate(tokens):
+                if token != title:
+                    continue
+                others = tokens[:i] + tokens[i + 1:]
+                if all(artist.startswith(other) or album.startswith(other) for other in others):
+                    matches[doc['song_id']] = doc
+                    break
+        return next(iter(matches.values())) if len(matches) == 1 else None
+
+    def _fuzzy(self, query: str) -> list:
+        """按命中的二元组比例进行模糊匹配，调用方需持有锁"""
+        query_grams = _grams(query)
+        if len(query_grams) < 2:
+            return []
+        counts = defaultdict(int)
+        for gram in query_grams:
+            for doc_id in self._grams.get(gram, ()):
+                counts[doc_id] += 1
+        # 模糊结果的得分低于任何子串匹配
+        return [(count / len(query_grams) - 1, doc_id) for doc_id, count in counts.items()
+                if count / len(query_grams) >= FUZZY_THRESHOLD]
+
+    @staticmethod
+    def _public(doc: dict) -> dict:
+        return {key: doc[key] for key in ('path', 'song_id', 'song_name', 'artist_name', 'album_name')}
+
+
+# 全局本地曲库索引
+library_index = LibraryIndex()
@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 歌曲元数据数据库路径
+METADATA_DB_PATH = "./AudioLib/song_metadata.db"
+# 元数据有效期（秒），过期后仍然返回旧数据，同时在后台刷新
+METADATA_TTL = 7 * 24 * 3600
+# 关闭时等待后台线程写完剩余数据的最长时间（秒）
+CLOSE_TIMEOUT = 10.0
+
+
+def slim_song_detail(song: dict) -> dict:
+    """
+    只保留网易云歌曲详情中用到的字段，减少内存和磁盘占用
+
+    :param song: /song/detail 或 /playlist/track/all 返回的原始歌曲详情
+    :return: 仅包含 id/name/ar/al/dt 的歌曲详情
+    """
+    album = song.get('al') or {}
+    return {
+        'id': song.get('id'),
+        'name': song.get('name', ''),
+        'ar': [{'id': artist.get('id', ''), 'name': artist.get('name', '')} for artist in song.get('ar') or []],
+        'al': {'id': album.get('id', ''), 'name': album.get('name', ''), 'picUrl': album.get('picUrl', '')},
+        'dt': song.get('dt', 0),
+    }
+
+
+def to_song_info(song: dict) -> dict:
+    """
+    将歌曲详情转换为播放列表使用的歌曲信息格式
+
+    :param song: 歌曲详情
+    :return: 包含 id/song_name/artist_name/album_name/duration/pic_url 的字典
+    """
+    artists = [artist.get('name') for artist in song.get('ar') or [] if artist.get('name')]
+    album = song.get('al') or {}
+    return {
+        'id': str(song.get('id', '')),
+        'song_name': song.get('name', '未知歌曲'),
+        'artist_name': ", ".join(artists) if artists else "未知艺术家",
+        'album_name': album.get('name', '未知专辑'),
+        'duration': (song.get('dt') or 0) / 1000,  # 转换为秒
+        'pic_url': album.get('picUrl', ''),
+    }
+
+
+class SongMetadataStore:
+    """
+    歌曲元数据持久化存储（SQLite）
+
+    以歌曲ID为键保存歌曲名、艺术家、专辑、封面和时长。启动时一次性加载到内存，
+    读取只访问内存；写入先更新内存，再交给后台线程批量写入数据库，不阻塞事件循环。
+    数据超过 ttl 后视为过期，调用方可以先使用旧数据，同时在后台刷新（stale-while-revalidate）。
+    """
+
+    def __init__(self, db_path: str = METADATA_DB_PATH, ttl: float = METADATA_TTL):
+        """
+        :param db_path: 数据库文件路径
+        :param ttl: 元数据有效期（秒）
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self._records = {}  # song_id -> (歌曲详情, 更新时间)
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._opened = False
+        self._listeners = []
+
+    def open(self):
+        """创建数据表并加载全部元数据到内存"""
+        if self._opened:
+            return
+        self._opened = True
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path)
+            try:
+                self._create_table(conn)
+                for song_id, data, updated_at in conn.execute("SELECT id, data, updated_at FROM songs"):
+                    try:
+                        self._records[song_id] = (json.loads(data), updated_at)
+                    except json.JSONDecodeError:
+                        continue
+            finally:
+                conn.close()
+            logger.info(f"已加载 {len(self._records)} 条歌曲元数据")
+        except sqlite3.Error as e:
+            logger.error(f"打开歌曲元数据库失败，将仅使用内存缓存: {e}")
+            return
+
+        self._writer = threading.Thread(target=self._writer_loop, name="metadata-writer", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def _create_table(conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS songs ("
+            "id TEXT PRIMARY KEY, "
+            "name TEXT, "
+            "artist_name TEXT, "
+            "album_name TEXT, "
+            "pic_url TEXT, "
+            "duration REAL, "
+            "data TEXT NOT NULL, "
+            "updated_at REAL NOT NULL)"
+        )
+        conn.commit()
+
+    def add_listener(self, callback):
+        """
+        注册元数据更新的回调，例如本地曲库索引
+
+        :param callback: callback(song_ids)，参数为更新的歌曲ID列表
+        """
+        self._listeners.append(callback)
+
+    def get(self, song_id):
+        """
+        获取歌曲元数据
+
+        :param song_id: 歌曲ID
+        :return: (歌曲详情或None, 是否已过期)
+        """
+        record = self._records.get(str(song_id))
+        if record is None:
+            return None, False
+        song, updated_at = record
+        return song, time.time() - updated_at > self.ttl
+
+    def get_song_info(self, song_id):
+        """
+        获取播放列表格式的歌曲信息
+
+        :param song_id: 歌曲ID
+        :return: 歌曲信息字典，不存在时返回None
+        """
+        song, _ = self.get(song_id)
+        return to_song_info(song) if song else None
+
+    def put(self, song: dict):
+        """保存单首歌曲的元数据"""
+        self.put_many([song])
+
+    def put_many(self, songs):
+        """
+        批量保存歌曲元数据
+
+        :param songs: 原始歌曲详情列表
+        """
+        now = time.time()
+        rows = []
+        for song in songs:
+            if not song or song.get('id') is None:
+                continue
+            slim = slim_song_detail(song)
+            song_id = str(slim['id'])
+            self._records[song_id] = (slim, now)
+            info = to_song_info(slim)
+            rows.append((song_id, info['song_name'], info['artist_name'], info['album_name'], info['pic_url'],
+                         info['duration'], json.dumps(slim, ensure_ascii=False), now))
+        if rows and self._writer:
+            self._write_queue.put(rows)
+        if rows:
+            song_ids = [row[0] for row in rows]
+            for callback in self._listeners:
+                try:
+                    callback(song_ids)
+                except Exception as e:
+                    logger.error(f"歌曲元数据更新回调出错: {e}")
+
+    def close(self, timeout: float = CLOSE_TIMEOUT):
+        """
+        写入队列中剩余的元数据并停止后台写入线程
+
+        :param timeout: 等待后台线程结束的最长时间（秒）
+        """
+        writer = self._writer
+        if writer is None:
+            return
+        self._writer = None
+        # None 表示队列中的数据已经全部提交，写入线程处理完之前的数据后退出
+        self._write_queue.put(None)
+        writer.join(timeout)
+        if writer.is_alive():
+            logger.warning("歌曲元数据写入线程未能在超时时间内结束，部分数据可能未保存")
+
+    def items(self):
+        """遍历内存中的全部 (song_id, 歌曲详情)"""
+        return [(song_id, record[0]) for song_id, record in list(self._records.items())]
+
+    def __len__(self):
+        return len(self._records)
+
+    def _writer_loop(self):
+        """后台写入线程：合并队列中的写入请求后批量提交"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            stopping = False
+            while not stopping:
+                rows = self._write_queue.get()
+                if rows is None:
+                    break
+                # 合并同一时刻积压的写入
+                while True:
+                    try:
+                        more = self._write_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if more is None:
+                        stopping = True
+                        break
+                    rows.extend(more)
+                try:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO songs "
+                        "(id, name, artist_name, album_name, pic_url, duration, data, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        rows
+                    )
+                    conn.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"写入歌曲元数据失败: {e}")
+        finally:
+            conn.close()
+
+
+# 全局元数据存储，各模块共享
+song_metadata_store = SongMetadataStore()
+song_metadata_store.open()
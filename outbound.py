@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 每个文字频道的发送速率（条/秒）和突发上限
+OUTBOUND_CHANNEL_RATE = 1.0
+OUTBOUND_CHANNEL_BURST = 5
+# 全部频道共享的速率（次/秒）和突发上限，删除消息也计入
+OUTBOUND_GLOBAL_RATE = 5.0
+OUTBOUND_GLOBAL_BURST = 10
+# 没有指定文字频道的删除操作使用的队列
+DEFAULT_LANE = ""
+
+
+class TokenBucket:
+    """令牌桶限速"""
+
+    def __init__(self, rate: float, capacity: int):
+        """
+        :param rate: 每秒补充的令牌数
+        :param capacity: 令牌上限（允许的突发数量）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, count: int = 1) -> float:
+        """获取令牌前还需要等待的时间（秒），为 0 表示可以立即获取"""
+        self._refill()
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / self.rate
+
+    def available(self) -> int:
+        self._refill()
+        return int(self.tokens)
+
+    def consume(self, count: int = 1):
+        self._refill()
+        self.tokens -= count
+
+
+class _Outgoing:
+    """等待发送的消息，msg_id 不为空时表示更新已有消息"""
+    __slots__ = ('channel', 'content', 'key', 'future', 'msg_id', 'track')
+
+    def __init__(self, channel, content, key, future, msg_id=None, track=False):
+        self.channel = channel
+        self.content = content
+        self.key = key
+        self.future = future
+        self.msg_id = msg_id
+        self.track = track
+
+
+class _Outbox:
+    """单个文字频道的待发送队列"""
+
+    def __init__(self, rate: float, burst: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.sends = deque()
+        self.keyed = {}  # key -> 尚未发出的 _Outgoing
+        self.deletes = {}  # 待删除的消息ID（按加入顺序，自动去重）
+        self.task = None
+
+    def is_empty(self) -> bool:
+        return not self.sends and not self.deletes
+
+
+class OutboundQueue:
+    """
+    按文字频道合并、限速的 KOOK 消息发送队列
+
+    每个文字频道一个队列和一个令牌桶，另有一个全部频道共享的令牌桶。带 key 的消息在发出之前会被
+    同 key 的新消息原位取代（例如同一个语音频道只发送最新的播放卡片），被取代的调用返回 None。
+    发送优先于删除，删除在发送之后按可用令牌成批并发执行，重复的删除只执行一次。
+    以 track=True 发送的消息会记录之后频道中又出现了多少条消息，用于判断消息是否已经被刷上去；
+    每个文字频道的每个 key 只记录最新的一条，消息删除后不再记录。
+    """
+
+    def __init__(self, delete_message, update_message=None, rate: float = OUTBOUND_CHANNEL_RATE,
+                 burst: int = OUTBOUND_CHANNEL_BURST, global_rate: float = OUTBOUND_GLOBAL_RATE,
+                 global_burst: int = OUTBOUND_GLOBAL_BURST):
+        """
+        :param delete_message: 协程函数 delete_message(msg_id)，删除一条消息
+        :param update_message: 协程函数 update_message(msg_id, content)，修改一条消息
+        :param rate: 每个文字频道的发送速率（条/秒）
+        :param burst: 每个文字频道的突发上限
+        :param global_rate: 全部频道共享的速率（次/秒）
+        :param global_burst: 全部频道共享的突发上限
+        """
+        self.delete_message = delete_message
+        self.update_message = update_message
+        self.rate = rate
+        self.burst = burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._outboxes = {}
+        self._activity = {}  # 有记录消息的文字频道ID -> 消息计数
+        self._tracked = {}  # 记录的消息ID -> (文字频道ID, key, 发送时的消息计数)
+        self._tracked_keys = {}  # (文字频道ID, key) -> 记录的消息ID
+        self.sent = 0
+        self.updated = 0
+        self.deleted = 0
+        self.merged = 0
+
+    def _outbox(self, channel_id) -> _Outbox:
+        outbox = self._outboxes.get(channel_id)
+        if outbox is None:
+            outbox = _Outbox(self.rate, self.burst)
+            self._outboxes[channel_id] = outbox
+        return outbox
+
+    def _wake(self, channel_id, outbox: _Outbox):
+        if outbox.task is None or outbox.task.done():
+            outbox.task = asyncio.create_task(self._drain(channel_id, outbox))
+
+    async def send(self, channel, content, key=None, track=False):
+        """
+        发送消息到文字频道
+
+        :param channel: 文字频道对象
+        :param content: 消息内容（文本或 CardMessage）
+        :param key: 合并键，发出之前被同 key 的新消息取代时返回 None
+        :param track: 是否记录之后频道中出现的消息数量（见 messages_after），需要同时指定 key，
+                      只用于之后还会修改或删除的消息
+        :return: 发送接口的响应，被取代时返回 None
+        """
+        return await self._enqueue(channel, content, key, track=track and key is not None)
+
+    async def update(self, channel, msg_id, content, key=None):
+        """
+        修改文字频道中已有的消息，失败时抛出异常
+
+        :param channel: 消息所在的文字频道对象
+        :param msg_id: 要修改的消息ID
+        :param content: 新的消息内容
+        :param key: 合并键，与 send 共用，发出之前被同 key 的新消息取代时返回 None
+        :return: {'msg_id': msg_id}，被取代时返回 None
+        """
+        return await self._enqueue(channel, content, key, msg_id)
+
+    async def _enqueue(self, channel, content, key=None, msg_id=None, track=False):
+        outbox = self._outbox(channel.id)
+        future = asyncio.get_running_loop().create_future()
+        pending = outbox.keyed.get(key) if key is not None else None
+        if pending is not None and not pending.future.done():
+            # 旧消息还没有发出，直接替换内容并保持原来的排队位置
+            pending.future.set_result(None)
+            pending.channel = channel
+            pending.content = content
+            pending.msg_id = msg_id
+            pending.track = track
+            pending.future = future
+            self.merged += 1
+        else:
+            item = _Outgoing(channel, content, key, future, msg_id, track)
+            outbox.sends.append(item)
+            if key is not None:
+                outbox.keyed[key] = item
+        self._wake(channel.id, outbox)
+        return await future
+
+    def note_activity(self, channel_id):
+        """记录文字频道中出现了一条其他人发送的消息"""
+        if channel_id in self._activity:
+            self._activity[channel_id] += 1
+
+    def messages_after(self, channel_id, msg_id):
+        """
+        获取以 track=True 发送的消息之后频道中又出现的消息数量
+
+        :param channel_id: 文字频道ID
+        :param msg_id: 消息ID
+        :return: 消息数量，消息不在该频道或没有记录时返回 None
+        """
+        tracked = self._tracked.get(msg_id)
+        if tracked is None or tracked[0] != channel_id:
+            return None
+        return self._activity.get(channel_id, 0) - tracked[2]
+
+    def discard(self, channel_id, key) -> bool:
+        """
+        取消尚未发出的同 key 消息
+
+        :param channel_id: 文字频道ID
+        :param key: 合并键
+        :return: 是否取消了消息
+        """
+        outbox = self._outboxes.get(channel_id)
+        pending = outbox.keyed.pop(key, None) if outbox is not None else None
+        if pending is None or pending.future.done():
+            return False
+        pending.future.set_result(None)
+        self.merged += 1
+        return True
+
+    def delete(self, msg_id, channel_id=None):
+        """
+        删除消息，不等待结果
+
+        :param msg_id: 消息ID
+        :param channel_id: 消息所在的文字频道ID，用于按频道限速
+        """
+        if not msg_id:
+            return
+        self._forget(msg_id)
+        lane = channel_id or DEFAULT_LANE
+        outbox = self._outbox(lane)
+        if msg_id in outbox.deletes:
+            self.merged += 1
+            return
+        outbox.deletes[msg_id] = None
+        self._wake(lane, outbox)
+
+    async def _acquire(self, outbox: _Outbox):
+        while True:
+            wait = max(outbox.bucket.delay(), self.global_bucket.delay())
+            if wait <= 0:
+                outbox.bucket.consume()
+                self.global_bucket.consume()
+                return
+            await asyncio.sleep(wait)
+
+    async def _drain(self, channel_id, outbox: _Outbox):
+        try:
+            while True:
+                # 跳过已被取代或调用方已放弃的消息，不消耗令牌
+                while outbox.sends and outbox.sends[0].future.done():
+                    item = outbox.sends.popleft()
+                    if outbox.keyed.get(item.key) is item:
+                        del outbox.keyed[item.key]
+                if outbox.is_empty():
+                    break
+
+                await self._acquire(outbox)
+                if outbox.sends:
+                    item = outbox.sends.popleft()
+                    if item.key is not None and outbox.keyed.get(item.key) is item:
+                        # 已经开始发送，之后的同 key 消息不能再取代它
+                        del outbox.keyed[item.key]
+                    await self._send(item)
+                elif outbox.deletes:
+                    # 第一个删除已经拿到令牌，其余按当前可用令牌一起发出
+                    extra = min(outbox.bucket.available(), self.global_bucket.available(), len(outbox.deletes) - 1)
+                    if extra > 0:
+                        outbox.bucket.consume(extra)
+                        self.global_bucket.consume(extra)
+                    batch = list(outbox.deletes)[:extra + 1]
+                    for msg_id in batch:
+                        del outbox.deletes[msg_id]
+                    await asyncio.gather(*(self._delete(msg_id) for msg_id in batch))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"处理频道 {channel_id} 的发送队列时出错: {e}")
+        finally:
+            if outbox.is_empty() and self._outboxes.get(channel_id) is outbox:
+                del self._outboxes[channel_id]
+
+    async def _send(self, item: _Outgoing):
+        future = item.future
+        if future.done():
+            return
+        channel_id = item.channel.id
+        try:
+            if item.msg_id is not None:
+                await self.update_message(item.msg_id, item.content)
+                result = {'msg_id': item.msg_id}
+                self.updated += 1
+            else:
+                result = await item.channel.send(item.content)
+                self.sent += 1
+                self.note_activity(channel_id)
+                if item.track and isinstance(result, dict) and result.get('msg_id'):
+                    self._track(channel_id, item.key, result['msg_id'])
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    def _track(self, channel_id, key, msg_id):
+        # 同一频道同一 key 只记录最新的消息，旧消息即使没有删除也不再记录
+        old_msg_id = self._tracked_keys.get((channel_id, key))
+        if old_msg_id is not None:
+            self._tracked.pop(old_msg_id, None)
+        self._tracked_keys[(channel_id, key)] = msg_id
+        self._tracked[msg_id] = (channel_id, key, self._activity.setdefault(channel_id, 0))
+
+    def _forget(self, msg_id):
+        tracked = self._tracked.pop(msg_id, None)
+        if tracked is None:
+            return
+        channel_id, key, _ = tracked
+        if self._tracked_keys.get((channel_id, key)) == msg_id:
+            del self._tracked_keys[(channel_id, key)]
+        if not any(t[0] == channel_id for t in self._tracked.values()):
+            # 频道中已经没有需要判断位置的消息，不再计数
+            self._activity.pop(channel_id, None)
+
+    async def _delete(self, msg_id):
+        try:
+            await self.delete_message(msg_id)
+            self.deleted += 1
+        except Exception as e:
+            logger.error(f"删除消息 {msg_id} 时出错: {e}")
+
+    def stats(self) -> dict:
+        """
+        获取发送队列统计
+
+        :return: {'sent', 'updated', 'deleted', 'merged', 'pending'}
+        """
+        return {
+            'sent': self.sent,
+            'updated': self.updated,
+            'deleted': self.deleted,
+            'merged': self.merged,
+            'pending': sum(len(o.sends) + len(o.deletes) for o in list(self._outboxes.values())),
+        }
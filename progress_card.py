@@ -0,0 +1,161 @@
+import logging
+import time
+
+from idle_timeout import IdleTimeoutScheduler
+from outbound import TokenBucket
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 歌曲开头和结尾多少秒内使用较短的刷新间隔
+PROGRESS_EDGE_WINDOW = 20
+# 开头和结尾的刷新间隔（秒）
+PROGRESS_EDGE_INTERVAL = 5
+# 歌曲中段的最长刷新间隔（秒）
+PROGRESS_MID_INTERVAL = 30
+# 多久没有人互动后暂停刷新（秒），有新的互动时恢复
+PROGRESS_IDLE_PAUSE = 300
+# 全部频道共享的进度卡片刷新预算（次/秒）和突发上限
+PROGRESS_UPDATE_RATE = 1.0
+PROGRESS_UPDATE_BURST = 3
+
+
+def refresh_interval(position: float, duration: float) -> float:
+    """
+    根据播放位置计算下一次刷新的间隔
+
+    开头和结尾刷新得更频繁，中段只在进入结尾区间前刷新，最长不超过 PROGRESS_MID_INTERVAL。
+
+    :param position: 当前播放位置（秒）
+    :param duration: 歌曲总时长（秒）
+    :return: 刷新间隔（秒）
+    """
+    remaining = duration - position
+    if remaining <= PROGRESS_EDGE_WINDOW:
+        # 歌曲结束后尽快刷新，显示下一首
+        return max(1.0, min(PROGRESS_EDGE_INTERVAL, remaining + 1))
+    if position < PROGRESS_EDGE_WINDOW:
+        return PROGRESS_EDGE_INTERVAL
+    return max(PROGRESS_EDGE_INTERVAL, min(PROGRESS_MID_INTERVAL, remaining - PROGRESS_EDGE_WINDOW))
+
+
+class _LiveCard:
+    """一张自动刷新的进度卡片"""
+
+    def __init__(self, channel, msg_id):
+        self.channel = channel
+        self.msg_id = msg_id
+        self.last_interaction = time.monotonic()
+        self.paused = False
+
+
+class ProgressCardRefresher:
+    """
+    自动刷新的播放进度卡片
+
+    每个语音频道最多一张卡片，到期时间保存在共享的最小堆调度器中，刷新间隔随播放位置变化，
+    长时间没有互动时暂停，直到再次有人互动。全部频道共享一个刷新预算，修改消息还会经过发送队列的限速。
+    """
+
+    def __init__(self, outbound, render, rate: float = PROGRESS_UPDATE_RATE, burst: int = PROGRESS_UPDATE_BURST):
+        """
+        :param outbound: OutboundQueue 实例
+        :param render: 协程函数 render(channel_id)，返回 (卡片内容, 播放位置, 歌曲时长)，没有正在播放的歌曲时返回 None
+        :param rate: 全部频道共享的刷新速率（次/秒）
+        :param burst: 刷新预算的突发上限
+        """
+        self.outbound = outbound
+        self.render = render
+        self.budget = TokenBucket(rate, burst)
+        self._cards = {}  # 语音频道ID -> _LiveCard
+        self._timer = IdleTimeoutScheduler()
+
+    def active(self, channel_id) -> bool:
+        return channel_id in self._cards
+
+    async def start(self, channel, channel_id):
+        """
+        发送进度卡片并开始自动刷新，频道已有卡片时替换
+
+        :param channel: 发送卡片的文字频道对象
+        :param channel_id: 语音频道ID
+        :return: 卡片消息ID，失败时返回包含 error 的字典
+        """
+        rendered = await self.render(channel_id)
+        if rendered is None:
+            return {"error": "当前没有正在播放的歌曲"}
+        content, position, duration = rendered
+        response = await self.outbound.send(channel, content)
+
+        self.stop(channel_id)
+        card = _LiveCard(channel, response['msg_id'])
+        self._cards[channel_id] = card
+        self._timer.schedule(channel_id, refresh_interval(position, duration), self._refresh)
+        logger.info(f"频道 {channel_id} 开始自动刷新进度卡片，消息ID: {card.msg_id}")
+        return card.msg_id
+
+    def stop(self, channel_id) -> bool:
+        """
+        停止刷新并删除进度卡片
+
+        :return: 是否存在进度卡片
+        """
+        card = self._cards.pop(channel_id, None)
+        if card is None:
+            return False
+        self._timer.cancel(channel_id)
+        self.outbound.delete(card.msg_id, card.channel.id)
+        logger.info(f"频道 {channel_id} 停止自动刷新进度卡片")
+        return True
+
+    def touch(self, channel_id):
+        """记录语音频道的互动，暂停中的卡片立即恢复刷新"""
+        card = self._cards.get(channel_id)
+        if card is None:
+            return
+        card.last_interaction = time.monotonic()
+        if card.paused:
+            card.paused = False
+            logger.info(f"频道 {channel_id} 有新的互动，恢复刷新进度卡片")
+            self._timer.schedule(channel_id, 0, self._refresh)
+
+    def touch_text_channel(self, text_channel_id):
+        """记录文字频道的互动，恢复发送在该频道中的全部进度卡片"""
+        for channel_id, card in list(self._cards.items()):
+            if card.channel.id == text_channel_id:
+                self.touch(channel_id)
+
+    async def _refresh(self, channel_id):
+        card = self._cards.get(channel_id)
+        if card is None:
+            return
+        if time.monotonic() - card.last_interaction > PROGRESS_IDLE_PAUSE:
+            card.paused = True
+            logger.info(f"频道 {channel_id} 长时间没有互动，暂停刷新进度卡片")
+            return
+
+        # 共享预算用完时推迟到有预算为止
+        wait = self.budget.delay()
+        if wait > 0:
+            self._timer.schedule(channel_id, wait, self._refresh)
+            return
+        self.budget.consume()
+
+        try:
+            rendered = await self.render(channel_id)
+            if rendered is None:
+                # 暂时没有正在播放的歌曲，稍后再检查
+                delay = PROGRESS_MID_INTERVAL
+            else:
+                content, position, duration = rendered
+                await self.outbound.update(card.channel, card.msg_id, content, key=f"progress_{channel_id}")
+                delay = refresh_interval(position, duration)
+        except Exception as e:
+            # 卡片可能已被删除，不再刷新
+            logger.warning(f"刷新频道 {channel_id} 的进度卡片失败，停止刷新: {e}")
+            if self._cards.get(channel_id) is card:
+                del self._cards[channel_id]
+            return
+
+        if self._cards.get(channel_id) is card:
+            self._timer.schedule(channel_id, delay, self._refresh)
@@ -0,0 +1,216 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from khl.card import Card, CardMessage, Element, Module, Types
+
+import NeteaseAPI
+from cache_utils import SingleFlight, TTLCache
+from metadata_store import to_song_info
+
+# 设置日志
+logger = logging.getLogger(__name__)
+
+# 默认封面和链接
+DEFAULT_COVER = "https://p2.music.126.net/6y-UleORITEDbvrOLV0Q8A==/5639395138885805.jpg"
+DEFAULT_SONG_URL = "https://music.163.com/"
+DEFAULT_SINGER_URL = "https://music.163.com/artist"
+DEFAULT_ALBUM_URL = "https://music.163.com/album"
+NETEASE_LOGO = "https://img.kookapp.cn/assets/2022-05/UmCnhm4mlt016016.png"
+# 歌曲时长未知时使用的默认值（秒）
+DEFAULT_DURATION = 180
+# 卡片静态内容缓存的数量和有效期（秒）
+SONG_CARD_CACHE_SIZE = 512
+SONG_CARD_CACHE_TTL = 24 * 3600
+
+
+class SongCardCache:
+    """
+    正在播放卡片的静态内容缓存
+
+    歌名、艺术家、专辑、封面、链接和时长按歌曲ID（本地文件按路径）缓存，可以在预下载时提前生成；
+    发送卡片时只需要填入倒计时、点歌用户和一言等动态内容，不再请求歌曲详情，也不再调用 ffprobe。
+    """
+
+    def __init__(self, maxsize: int = SONG_CARD_CACHE_SIZE, ttl: float = SONG_CARD_CACHE_TTL):
+        """
+        :param maxsize: 最多缓存的歌曲数量
+        :param ttl: 静态内容的有效期（秒）
+        """
+        self._templates = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flight = SingleFlight()
+
+    async def get_template(self, song_path: str, playlist_manager=None) -> dict:
+        """
+        获取歌曲的卡片静态内容
+
+        :param song_path: 歌曲文件路径，文件名为歌曲ID时使用网易云歌曲详情
+        :param playlist_manager: 播放列表管理器，用于获取本地歌曲信息
+        :return: 卡片静态内容字典
+        """
+        song_id = os.path.splitext(os.path.basename(song_path))[0]
+        key = song_id if song_id.isdigit() else ('file', song_path)
+        template = self._templates.get(key)
+        if template is None:
+            template = await self._flight.do(key, lambda: self._build(key, song_id, song_path, playlist_manager))
+        return template
+
+    async def warm(self, song_ids):
+        """
+        预先生成歌曲的卡片静态内容，歌曲详情已在预下载时批量加载
+
+        :param song_ids: 歌曲ID列表
+        """
+        for song_id in song_ids:
+            if self._templates.get(str(song_id)) is None:
+                try:
+                    await self.get_template(f"{song_id}.mp3")
+                except Exception as e:
+                    logger.warning(f"预生成歌曲 {song_id} 的卡片内容失败: {e}")
+
+    async def _build(self, key, song_id: str, song_path: str, playlist_manager) -> dict:
+        template = {
+            'song_id': song_id if song_id.isdigit() else None,
+            'song_name': os.path.basename(song_path),
+            'artist_name': "未知艺术家",
+            'album_name': "未知专辑",
+            'pic_url': DEFAULT_COVER,
+            'song_url': DEFAULT_SONG_URL,
+            'singer_url': DEFAULT_SINGER_URL,
+            'album_url': DEFAULT_ALBUM_URL,
+            'duration': 0,
+        }
+
+        song = None
+        if song_id.isdigit():
+            try:
+                song = await NeteaseAPI.song_detail_loader.load(song_id)
+            except Exception as e:
+                logger.warning(f"获取歌曲 {song_id} 详情失败，使用本地信息: {e}")
+
+        if song:
+            info = to_song_info(song)
+            artists = song.get('ar') or []
+            album = song.get('al') or {}
+            template.update({
+                'song_name': info['song_name'],
+                'artist_name': info['artist_name'],
+                'album_name': info['album_name'],
+                'pic_url': info['pic_url'] or DEFAULT_COVER,
+                'song_url': f"https://music.163.com/#/song?id={song_id}",
+                'duration': info['duration'],
+            })
+            if artists and artists[0].get('id'):
+                template['singer_url'] = f"https://music.163.com/#/artist?id={artists[0]['id']}"
+            if album.get('id'):
+                template['album_url'] = f"https://music.163.com/#/album?id={album['id']}"
+        elif playlist_manager is not None:
+            # 不是网易云歌曲或详情获取失败时使用播放列表中的信息
+            local_info = playlist_manager.get_known_song_info(song_path)
+            if local_info:
+                template['song_name'] = local_info.get('song_name', template['song_name'])
+                template['artist_name'] = local_info.get('artist_name', template['artist_name'])
+                template['album_name'] = local_info.get('album_name', template['album_name'])
+                template['pic_url'] = local_info.get('pic_url') or template['pic_url']
+                template['duration'] = local_info.get('duration') or 0
+            else:
+                # 使用ffprobe获取基本信息，结果随模板缓存
+                info = playlist_manager.get_song_info(song_path)
+                song_name = info['title']
+                # 如果标题包含分隔符，尝试解析艺术家
+                if " - " in song_name:
+                    song_name, template['artist_name'] = song_name.split(" - ", 1)
+                template['song_name'] = song_name
+
+        if not template['duration'] and playlist_manager is not None:
+            template['duration'] = playlist_manager.get_song_duration(song_path)
+        if not template['duration'] or template['duration'] <= 0:
+            template['duration'] = DEFAULT_DURATION
+
+        # 网易云歌曲详情获取失败时不缓存，下次重新获取
+        if song or not song_id.isdigit():
+            self._templates.set(key, template)
+        return template
+
+    @staticmethod
+    async def get_audio_url(song_id) -> str:
+        """
+        获取卡片中音频模块的直链，预下载和之前的播放已缓存链接时不会请求接口
+
+        :param song_id: 歌曲ID，为 None 时返回空字符串
+        :return: 音频直链，获取失败时返回空字符串
+        """
+        if not song_id:
+            return ""
+        try:
+            url = await NeteaseAPI.resolve_song_url(song_id, "play")
+            if not url:
+                url = await NeteaseAPI.resolve_song_url(song_id, "download")
+            return url or ""
+        except Exception as e:
+            logger.warning(f"获取歌曲 {song_id} 的音频链接失败: {e}")
+            return ""
+
+
+def render_song_card(template: dict, channel_id: str, position: float, audio_url: str, avatar: str,
+                     hitokoto: str) -> CardMessage:
+    """
+    使用缓存的静态内容生成正在播放卡片
+
+    :param template: SongCardCache.get_template 返回的静态内容
+    :param channel_id: 语音频道ID，用于按钮
+    :param position: 当前播放位置（秒）
+    :param audio_url: 音频直链
+    :param avatar: 点歌用户头像
+    :param hitokoto: 一言
+    :return: CardMessage
+    """
+    # 使用剩余时间创建倒计时，而不是总时长
+    remaining_time = max(0, template['duration'] - position)
+
+    cm = CardMessage()
+    card = Card(
+        Module.Header("正在播放： " + template['song_name']),
+        Module.Context(
+            Element.Text(
+                "歌手： [" + template['artist_name'] + "](" + template['singer_url'] +
+                ")  — 专辑： [" + template['album_name'] + "](" + template['album_url'] + ")",
+                Types.Text.KMD)),
+        # 添加音频模块，如果有直链就使用，否则只显示信息
+        Module.File(Types.File.AUDIO,
+                    src=audio_url,
+                    title=template['song_name'],
+                    cover=template['pic_url']),
+        Module.Countdown(datetime.now() + timedelta(seconds=int(remaining_time)),
+                         mode=Types.CountdownMode.SECOND),
+        Module.Divider(),
+        Module.Context(
+            Element.Image(src=NETEASE_LOGO),
+            Element.Text("网易云音乐  [在网页查看](" + template['song_url'] + ")", Types.Text.KMD)),
+        Module.ActionGroup(
+            Element.Button('下一首', f'NEXT_{channel_id}', Types.Click.RETURN_VAL),
+            Element.Button('清空歌单', f'CLEAR_{channel_id}', Types.Click.RETURN_VAL),
+            Element.Button('循环模式', f'LOOP_{channel_id}', Types.Click.RETURN_VAL),
+            Element.Button('退出频道', f'EXIT_{channel_id}', Types.Click.RETURN_VAL)),
+        Module.Divider(),
+        Module.Section(
+            Element.Text("👈点歌用户", type=Types.Text.KMD),
+            Element.Image(src=avatar, size=Types.Size.SM, circle=True)
+        ),
+        color="#6AC629")
+    card.append(Module.Context(Element.Text(hitokoto, Types.Text.KMD)))
+    cm.append(card)
+    return cm
+
+
+def current_position(playlist_manager, duration: float) -> float:
+    """根据开始播放的时间计算当前播放位置，不调用 ffprobe"""
+    start_time = getattr(playlist_manager, 'current_song_start_time', None)
+    if not playlist_manager.current_song or start_time is None:
+        return 0
+    return min(max(0.0, time.time() - start_time), duration)
+
+
+# 全局卡片静态内容缓存
+song_card_cache = SongCardCache()
@@ -0,0 +1,34 @@
+import time
+import unittest
+
+from cache_utils import ExpiringDict
+
+
+class ExpiringDictTest(unittest.TestCase):
+    """过期但尚未被定期清理的条目不能出现在遍历结果中"""
+
+    def test_expired_entries_skipped_before_sweep(self):
+        d = ExpiringDict(ttl=0.01, sweep_interval=60.0)
+        d['a'] = 1
+        d['b'] = 2
+        time.sleep(0.02)
+        d['c'] = 3  # 写入时距离上次清理不足 sweep_interval，不会触发清理
+
+        self.assertEqual(list(d), ['c'])
+        self.assertEqual(list(d.items()), [('c', 3)])
+        self.assertEqual(list(d.values()), [3])
+        self.assertEqual(dict(d), {'c': 3})
+        self.assertEqual(len(d), 1)
+        self.assertEqual(repr(d), "ExpiringDict({'c': 3})")
+
+    def test_stale_entries_skipped_before_sweep(self):
+        d = ExpiringDict(is_stale=lambda value: value < 0, sweep_interval=60.0)
+        d['alive'] = 1
+        d['dead'] = -1
+
+        self.assertEqual(list(d.items()), [('alive', 1)])
+        self.assertNotIn('dead', d)
+
+
+if __name__ == '__main__':
+    unittest.main()